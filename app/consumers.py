@@ -1,49 +1,46 @@
-import json
-import boto3
+from collections import deque
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
 from datetime import datetime
 import logging
-from botocore.exceptions import ClientError
-from app.helpers.conversation import create_conversation, send_whatsapp_message
-from app.helpers.dynamodb_helpers import get_dynamodb_resource
+from django.conf import settings
+from app.helpers.conversation import create_conversation, get_conversation_routes, lookup_conversation
+from app.helpers.frame_codec import FrameProtocolMixin
+from app.helpers.inbox import chat_group, inbox_group, is_valid_group, routed_events
+from app.helpers.io_executor import run_io
+from app.helpers.message_writer import get_message_writer
+from app.helpers.messages import fetch_message_history, fetch_recent_history, fetch_recent_since, format_message
+from app.helpers.presence import PRESENCE_STATUSES, presence, presence_throttle, typing_throttle
+from app.helpers.read_receipts import check_read_timestamp, parse_read_timestamp, record_read
+from app.helpers.recent_messages import recent_messages
+from app.helpers.send_buffer import BufferedSendMixin
+from app.helpers.whatsapp_sender import get_whatsapp_sender
+
+async def read_mark_error(customer_id, conversation_id, timestamp):
+    """Why a read mark can't be recorded (it is past the conversation's last message), or None."""
+    try:
+        await run_io(check_read_timestamp, customer_id, conversation_id, timestamp)
+    except ValueError as e:
+        return str(e)
+    except Exception as e:
+        logging.error(f"Error checking read mark for {conversation_id}: {e}")
+        return 'Failed to record read.'
+    return None
+
+class ChatConsumer(FrameProtocolMixin, BufferedSendMixin, AsyncWebsocketConsumer):
+    # Ephemeral frame types; they are only relayed to the chat group, never
+    # stored or sent to WhatsApp
+    EVENT_HANDLERS = {
+        'typing': 'receive_typing',
+        'presence': 'receive_presence',
+        'ping': 'receive_ping',
+    }
 
-class ChatConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.sender_id = None  # Initialize sender_id
-        
-        self.dynamodb = get_dynamodb_resource()
-        
-        # Check if the Messages table exists, if not, create it
-        try:
-            self.table = self.dynamodb.Table('Messages')
-            self.table.load()  # This will raise an exception if the table does not exist
-            logging.info(f"Using existing DynamoDB table: {self.table.name}")
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                logging.info("Table 'Messages' not found, creating it now.")
-                self.table = self.dynamodb.create_table(
-                    TableName='Messages',
-                    KeySchema=[
-                        {'AttributeName': 'customer_id', 'KeyType': 'HASH'},  # Partition key
-                        {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}  # Sort key
-                    ],
-                    AttributeDefinitions=[
-                        {'AttributeName': 'customer_id', 'AttributeType': 'S'},
-                        {'AttributeName': 'timestamp', 'AttributeType': 'S'}
-                    ],
-                    ProvisionedThroughput={
-                        'ReadCapacityUnits': 5,
-                        'WriteCapacityUnits': 5
-                    }
-                )
-                self.table.meta.client.get_waiter('table_exists').wait(TableName='Messages')
-                logging.info("Table 'Messages' created successfully.")
-            else:
-                logging.error(f"Unexpected error: {e}")
-                raise
-
+        self.read_marks = {}  # Newest read mark sent per user on this socket
+        self.present_users = set()  # Users this socket announced presence for
 
     async def connect(self):
         # Extract customer_id from the URL route
@@ -51,18 +48,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.room_group_name = f'chat_{self.customer_id}'
 
         try:
-            self.conversation_id = await sync_to_async(create_conversation)(self.customer_id)
+            self.conversation_id = await run_io(create_conversation, self.customer_id)
             if self.conversation_id is None:
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'error': 'Failed to access Conversations table.'
-                }))
+                })
                 return
             logging.info(f"Using conversation: {self.conversation_id}")
         except Exception as e:
             logging.error(f"Error fetching or creating conversation: {e}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'error': 'Failed to fetch or create conversation.'
-            }))
+            })
             return
 
         # Join room group
@@ -70,94 +67,477 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.room_group_name,
             self.channel_name
         )
+        # While subscribed, group events keep the cached recent messages current
+        recent_messages.subscribe(self.customer_id)
+        self.subscribed = True
 
-        await self.accept()
+        await self.accept(subprotocol=self.negotiate_subprotocol())
 
-        # Fetch message history from DynamoDB
+        params = self.get_query_params()
+        if params.get('since'):
+            # Reconnect: only send what was stored after the last message the client saw
+            await self.send_missed_messages(params['since'], limit=params.get('history_limit'))
+        else:
+            # Send the newest page of message history as a single frame
+            await self.send_history(limit=params.get('history_limit'))
+        users = presence.present(self.customer_id)
+        if users:
+            await self.send_frame({'type': 'presence_snapshot', 'users': users})
+
+    def get_query_params(self):
+        query_string = self.scope.get('query_string', b'').decode()
+        return {key: values[-1] for key, values in parse_qs(query_string).items()}
+
+    async def send_history(self, limit=None, before=None):
         try:
-            response = await sync_to_async(self.table.query)(
-                KeyConditionExpression=boto3.dynamodb.conditions.Key('customer_id').eq(self.customer_id)
-            )
-            messages = response.get('Items', [])
-            # Send message history to the WebSocket
-            for message in messages:
-                await self.send(text_data=json.dumps({
-                    'message': message['message'],
-                    'timestamp': message['timestamp'],
-                    'sender_id': message['sender_id']
-                }))
+            if before:
+                items, next_before = await run_io(
+                    fetch_message_history, self.customer_id, limit=limit, before=before
+                )
+                messages = [format_message(item) for item in items]
+            else:
+                # Newest page: usually served from the recent-message cache
+                messages, next_before = await run_io(fetch_recent_history, self.customer_id, limit=limit)
+            await self.send_frame({
+                'type': 'history',
+                'messages': messages,
+                'before': next_before
+            })
         except Exception as e:
             logging.error(f"Error fetching message history: {e}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'error': 'Failed to fetch message history.'
-            }))
+            })
+
+    async def send_missed_messages(self, since, limit=None):
+        try:
+            messages, next_since = await run_io(
+                fetch_recent_since, self.customer_id, since, limit=limit
+            )
+            await self.send_frame({
+                'type': 'history',
+                'mode': 'resume',
+                'messages': messages,
+                'since': next_since
+            })
+        except Exception as e:
+            logging.error(f"Error fetching missed messages: {e}")
+            await self.send_frame({
+                'error': 'Failed to fetch message history.'
+            })
 
     async def disconnect(self, close_code):
+        if getattr(self, 'subscribed', False):
+            recent_messages.unsubscribe(self.customer_id)
+        for user_id in self.present_users:
+            await self.publish_presence(user_id, 'offline')
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    async def receive(self, text_data):
-        if not text_data.strip():
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is None and not (text_data or '').strip():
             logging.error("Received empty message.")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'error': 'Received empty message.'
-            }))
+            })
             return
 
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.parse_frame(text_data, bytes_data)
+            if text_data_json.get('type') == 'history':
+                # Client is paging back through older messages
+                await self.send_history(
+                    limit=text_data_json.get('limit'),
+                    before=text_data_json.get('before')
+                )
+                return
+            if text_data_json.get('type') == 'resume' and text_data_json.get('since'):
+                # Client is catching up on messages it missed
+                await self.send_missed_messages(
+                    text_data_json['since'],
+                    limit=text_data_json.get('limit')
+                )
+                return
+            if text_data_json.get('type') == 'read':
+                # Client reports how far it has read (coalesced client-side)
+                await self.mark_read(
+                    text_data_json.get('user_id') or self.sender_id,
+                    text_data_json.get('timestamp')
+                )
+                return
+            handler = self.EVENT_HANDLERS.get(text_data_json.get('type'))
+            if handler:
+                await getattr(self, handler)(text_data_json)
+                return
+            if text_data_json.get('type', 'message') != 'message':
+                await self.send_frame({
+                    'error': 'Unknown message type.'
+                })
+                return
             message = text_data_json['message']
             # Extract sender_id from the first message
             self.sender_id = text_data_json.get('sender_id')
 
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON decode error: {e}")
-            await self.send(text_data=json.dumps({
-                'error': 'Invalid JSON format.'
-            }))
+        except ValueError as e:
+            logging.error(f"Frame decode error: {e}")
+            await self.send_frame({
+                'error': 'Invalid JSON format.' if bytes_data is None else 'Invalid frame format.'
+            })
             return
 
-        # Store message in DynamoDB with timestamp and conversation_id
+        # Queue the message for write-behind persistence with timestamp and conversation_id
+        timestamp = datetime.now().isoformat()
         try:
-            await sync_to_async(self.table.put_item)(
-                Item={
-                    'customer_id': self.customer_id,
-                    'conversation_id': self.conversation_id,
-                    'sender_id': self.sender_id,  # Use the extracted sender_id
-                    'message': message,
-                    'timestamp': datetime.now().isoformat()
-                }
-            )
+            await get_message_writer().aenqueue({
+                'customer_id': self.customer_id,
+                'conversation_id': self.conversation_id,
+                'sender_id': self.sender_id,  # Use the extracted sender_id
+                'message': message,
+                'timestamp': timestamp
+            })
+            recent_messages.add(self.customer_id, [
+                {'message': message, 'timestamp': timestamp, 'sender_id': self.sender_id}
+            ])
         except Exception as e:
             logging.error(f"Error storing message: {e}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'error': 'Failed to store message.'
-            }))
+            })
 
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
+        # Send message to room group and to the inbox groups watching this conversation
+        try:
+            routes = await run_io(get_conversation_routes, [self.conversation_id])
+        except Exception as e:
+            logging.error(f"Error fetching conversation routing: {e}")
+            routes = {}
+        events = routed_events(
             {
                 'type': 'chat_message',
                 'message': message,
-                'sender_id': self.sender_id
-            }
+                'sender_id': self.sender_id,
+                'timestamp': timestamp
+            },
+            self.customer_id, self.conversation_id, routes.get(self.conversation_id)
         )
-        # Send WhatsApp message after storing in DynamoDB
+        for group, event in events:
+            await self.channel_layer.group_send(group, event)
+        # Queue the WhatsApp delivery; a slow Graph API no longer stalls this socket
         phone_number = self.customer_id
-        whatsapp_response = await sync_to_async(send_whatsapp_message)(phone_number, message)
-        logging.info(f"WhatsApp response: {whatsapp_response}")
+        await get_whatsapp_sender().send(phone_number, message)
+
+    async def mark_read(self, user_id, timestamp):
+        if not user_id or not isinstance(timestamp, str):
+            await self.send_frame({
+                'error': 'A read needs a user_id and a timestamp.'
+            })
+            return
+        try:
+            timestamp = parse_read_timestamp(timestamp)
+        except ValueError:
+            await self.send_frame({
+                'error': 'A read timestamp must be an ISO timestamp.'
+            })
+            return
+        if timestamp <= self.read_marks.get(user_id, ''):
+            return  # Read marks only move forward
+        error = await read_mark_error(self.customer_id, self.conversation_id, timestamp)
+        if error:
+            await self.send_frame({
+                'error': error
+            })
+            return
+        self.read_marks[user_id] = timestamp
+        group, event = record_read(self.customer_id, self.conversation_id, str(user_id), timestamp)
+        await self.channel_layer.group_send(group, event)
+
+    def event_user_id(self, data):
+        user_id = data.get('user_id') or self.sender_id
+        return str(user_id) if user_id else None
+
+    async def receive_typing(self, data):
+        user_id = self.event_user_id(data)
+        if not user_id:
+            await self.send_frame({'error': 'A typing event needs a user_id.'})
+            return
+        typing = bool(data.get('typing', True))
+        if not typing_throttle.allow((self.customer_id, user_id), typing):
+            return
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'user_typing',
+            'customer_id': self.customer_id,
+            'user_id': user_id,
+            'typing': typing,
+            'origin': self.channel_name,
+        })
+
+    async def receive_presence(self, data):
+        user_id = self.event_user_id(data)
+        status = data.get('status', 'online')
+        if not user_id or status not in PRESENCE_STATUSES:
+            await self.send_frame({
+                'error': f"A presence event needs a user_id and a status of {', '.join(PRESENCE_STATUSES)}."
+            })
+            return
+        if status == 'offline':
+            self.present_users.discard(user_id)
+        else:
+            self.present_users.add(user_id)
+        await self.publish_presence(user_id, status)
+
+    async def publish_presence(self, user_id, status):
+        # Update this process right away; other processes apply the group event
+        presence.update(self.customer_id, user_id, status)
+        if not presence_throttle.allow((self.customer_id, user_id), status):
+            return
+        await self.channel_layer.group_send(self.room_group_name, {
+            'type': 'user_presence',
+            'customer_id': self.customer_id,
+            'user_id': user_id,
+            'status': status,
+            'origin': self.channel_name,
+        })
+
+    async def receive_ping(self, data):
+        # Keepalive/latency probe answered by this process only
+        await self.send_frame({
+            'type': 'pong',
+            'id': data.get('id'),
+            'timestamp': datetime.now().isoformat()
+        })
 
     async def chat_message(self, event):
         message = event['message']
         sender_id = event['sender_id']
+        # Events from older processes carry no timestamp
+        timestamp = event.get('timestamp') or datetime.now().isoformat()
+        recent_messages.add(self.customer_id, [
+            {'message': message, 'timestamp': timestamp, 'sender_id': sender_id}
+        ])
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'message': message,
             'sender_id': sender_id,
-            'timestamp': datetime.now().isoformat()
-        }))
\ No newline at end of file
+            'timestamp': timestamp
+        })
+
+    async def chat_message_batch(self, event):
+        # Several messages from one webhook delivery; one frame per message
+        recent_messages.add(self.customer_id, event['messages'])
+        for message in event['messages']:
+            await self.send_frame({
+                'message': message['message'],
+                'sender_id': message['sender_id'],
+                'timestamp': message['timestamp']
+            })
+
+    async def message_status(self, event):
+        # Delivery status (sent/delivered/read/failed) of a message sent to WhatsApp
+        await self.send_frame({
+            'type': 'status',
+            'message_id': event['message_id'],
+            'status': event['status'],
+            'timestamp': event['timestamp']
+        })
+
+    async def read_receipt(self, event):
+        # A user's read mark for this conversation moved forward
+        await self.send_frame({
+            'type': 'read',
+            'user_id': event['user_id'],
+            'timestamp': event['timestamp']
+        })
+
+    async def user_typing(self, event):
+        if event.get('origin') == self.channel_name:
+            return
+        await self.send_frame({
+            'type': 'typing',
+            'user_id': event['user_id'],
+            'typing': event['typing']
+        }, coalesce_key=('typing', event['user_id']))
+
+    async def user_presence(self, event):
+        presence.update(event['customer_id'], event['user_id'], event['status'])
+        if event.get('origin') == self.channel_name:
+            return
+        await self.send_frame({
+            'type': 'presence',
+            'user_id': event['user_id'],
+            'status': event['status']
+        }, coalesce_key=('presence', event['user_id']))
+
+
+class InboxConsumer(FrameProtocolMixin, BufferedSendMixin, AsyncWebsocketConsumer):
+    """One socket for an agent's whole inbox.
+
+    Joins the inbox groups named by the vendor_id, team_id and user_id query
+    parameters (comma separated for several), which receive the events of
+    every conversation routed to them. Individual chats are followed with
+    in-band {"type": "subscribe", "customer_ids": [...]} and "unsubscribe"
+    messages, which only join or leave the chat group. Read marks are sent as
+    {"type": "read", "customer_id", "conversation_id", "user_id", "timestamp"}.
+    """
+
+    async def connect(self):
+        params = {key: values[-1] for key, values in parse_qs(self.scope.get('query_string', b'').decode()).items()}
+        self.inbox_groups = [
+            inbox_group(kind, value)
+            for kind in ('vendor', 'team', 'user')
+            for value in params.get(f'{kind}_id', '').split(',') if value
+        ]
+        self.inbox_groups = [group for group in self.inbox_groups if is_valid_group(group)]
+        self.subscriptions = set()
+        # Ids of recently delivered events; one event can reach several of our groups
+        self.recent_event_ids = deque(maxlen=1000)
+        self.read_marks = {}
+        if not self.inbox_groups:
+            await self.close(code=4400)
+            return
+        for group in self.inbox_groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        await self.accept(subprotocol=self.negotiate_subprotocol())
+
+    async def disconnect(self, close_code):
+        for group in getattr(self, 'inbox_groups', []) + [chat_group(customer_id) for customer_id in getattr(self, 'subscriptions', ())]:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.parse_frame(text_data, bytes_data)
+        except ValueError:
+            await self.send_frame({'error': 'Invalid JSON format.' if bytes_data is None else 'Invalid frame format.'})
+            return
+        if data.get('type') == 'read':
+            await self.mark_read(data)
+            return
+        if data.get('type') == 'ping':
+            await self.send_frame({'type': 'pong', 'id': data.get('id'), 'timestamp': datetime.now().isoformat()})
+            return
+        customer_ids = data.get('customer_ids') or ([data['customer_id']] if data.get('customer_id') else [])
+        if not isinstance(customer_ids, list):
+            customer_ids = []
+        customer_ids = [str(customer_id) for customer_id in customer_ids if is_valid_group(chat_group(str(customer_id)))]
+        if data.get('type') == 'subscribe':
+            customer_ids = [customer_id for customer_id in customer_ids if customer_id not in self.subscriptions]
+            if len(self.subscriptions) + len(customer_ids) > settings.INBOX_MAX_SUBSCRIPTIONS:
+                await self.send_frame({'error': f'At most {settings.INBOX_MAX_SUBSCRIPTIONS} subscriptions per socket.'})
+                return
+            for customer_id in customer_ids:
+                await self.channel_layer.group_add(chat_group(customer_id), self.channel_name)
+            self.subscriptions.update(customer_ids)
+        elif data.get('type') == 'unsubscribe':
+            for customer_id in customer_ids:
+                if customer_id in self.subscriptions:
+                    await self.channel_layer.group_discard(chat_group(customer_id), self.channel_name)
+                    self.subscriptions.discard(customer_id)
+        else:
+            await self.send_frame({'error': 'Unknown message type.'})
+            return
+        await self.send_frame({'type': 'subscriptions', 'customer_ids': sorted(self.subscriptions)})
+
+    async def mark_read(self, data):
+        customer_id = str(data.get('customer_id') or '')
+        conversation_id = data.get('conversation_id')
+        user_id = data.get('user_id')
+        timestamp = data.get('timestamp')
+        if not (is_valid_group(chat_group(customer_id)) and conversation_id and user_id and isinstance(timestamp, str)):
+            await self.send_frame({'error': 'A read needs a customer_id, conversation_id, user_id and timestamp.'})
+            return
+        try:
+            timestamp = parse_read_timestamp(timestamp)
+        except ValueError:
+            await self.send_frame({'error': 'A read timestamp must be an ISO timestamp.'})
+            return
+        key = (str(conversation_id), str(user_id))
+        if timestamp <= self.read_marks.get(key, ''):
+            return  # Read marks only move forward
+        try:
+            # The client names both; the mark is checked against one and stored on the other
+            customer_conversation_id = await run_io(lookup_conversation, customer_id)
+        except Exception as e:
+            logging.error(f"Error looking up the conversation of {customer_id}: {e}")
+            await self.send_frame({'error': 'Failed to record read.'})
+            return
+        if customer_conversation_id != key[0]:
+            await self.send_frame({'error': "conversation_id is not the customer's conversation."})
+            return
+        error = await read_mark_error(customer_id, key[0], timestamp)
+        if error:
+            await self.send_frame({'error': error})
+            return
+        self.read_marks[key] = timestamp
+        group, event = record_read(customer_id, *key, timestamp)
+        await self.channel_layer.group_send(group, event)
+
+    def is_duplicate(self, event):
+        event_id = event.get('event_id')
+        if event_id is None:
+            return False
+        if event_id in self.recent_event_ids:
+            return True
+        self.recent_event_ids.append(event_id)
+        return False
+
+    async def chat_message(self, event):
+        if self.is_duplicate(event):
+            return
+        await self.send_frame({
+            'type': 'message',
+            'customer_id': event.get('customer_id'),
+            'conversation_id': event.get('conversation_id'),
+            'message': event['message'],
+            'sender_id': event['sender_id'],
+            'timestamp': event.get('timestamp')
+        })
+
+    async def chat_message_batch(self, event):
+        if self.is_duplicate(event):
+            return
+        for message in event['messages']:
+            await self.send_frame({
+                'type': 'message',
+                'customer_id': event.get('customer_id'),
+                'conversation_id': event.get('conversation_id'),
+                'message': message['message'],
+                'sender_id': message['sender_id'],
+                'timestamp': message['timestamp']
+            })
+
+    async def message_status(self, event):
+        await self.send_frame({
+            'type': 'status',
+            'customer_id': event.get('customer_id'),
+            'message_id': event['message_id'],
+            'status': event['status'],
+            'timestamp': event['timestamp']
+        })
+
+    async def read_receipt(self, event):
+        await self.send_frame({
+            'type': 'read',
+            'customer_id': event['customer_id'],
+            'conversation_id': event['conversation_id'],
+            'user_id': event['user_id'],
+            'timestamp': event['timestamp']
+        })
+
+    async def user_typing(self, event):
+        await self.send_frame({
+            'type': 'typing',
+            'customer_id': event['customer_id'],
+            'user_id': event['user_id'],
+            'typing': event['typing']
+        }, coalesce_key=('typing', event['customer_id'], event['user_id']))
+
+    async def user_presence(self, event):
+        presence.update(event['customer_id'], event['user_id'], event['status'])
+        await self.send_frame({
+            'type': 'presence',
+            'customer_id': event['customer_id'],
+            'user_id': event['user_id'],
+            'status': event['status']
+        }, coalesce_key=('presence', event['customer_id'], event['user_id']))
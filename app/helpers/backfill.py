@@ -0,0 +1,312 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from app.helpers.dynamodb_helpers import TABLE_DEFINITIONS, get_dynamodb_resource, get_table
+from app.helpers.messages import BUCKETED_MESSAGES_TABLE, add_message_key, record_message_buckets
+
+# BatchWriteItem accepts at most 25 put requests per call
+MAX_BATCH_SIZE = 25
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+def conversation_updated_at(item):
+    """Give conversations created before the vendor_id-updated_at index an updated_at."""
+    if item.get('updated_at'):
+        return None
+    update = {
+        'UpdateExpression': 'SET updated_at = :updated_at',
+        'ExpressionAttributeValues': {':updated_at': item.get('started_at') or datetime.now().isoformat()},
+    }
+    if 'updated_at' in item:
+        update['ConditionExpression'] = 'updated_at = :previous'
+        update['ExpressionAttributeValues'][':previous'] = item['updated_at']
+    else:
+        update['ConditionExpression'] = 'attribute_exists(conversation_id) AND attribute_not_exists(updated_at)'
+    return update
+
+def colab_users_set(item):
+    """Rewrite a legacy list-typed colab_users as a string set (removed when empty)."""
+    colab_users = item.get('colab_users')
+    if not isinstance(colab_users, list):
+        return None
+    if not colab_users:
+        return {
+            'UpdateExpression': 'REMOVE colab_users',
+            'ConditionExpression': 'colab_users = :previous',
+            'ExpressionAttributeValues': {':previous': colab_users},
+        }
+    return {
+        'UpdateExpression': 'SET colab_users = :colab_users',
+        'ConditionExpression': 'colab_users = :previous',
+        'ExpressionAttributeValues': {':colab_users': set(colab_users), ':previous': colab_users},
+    }
+
+# Named backfills. Copies scan `source` and pass each item to `transform`,
+# which returns the item to write to `target` (None to skip it); `before_write`
+# runs ahead of each batch. In-place backfills pass each item to `update`
+# instead, which returns the UpdateItem arguments (None to skip it): they set
+# only the migrated attribute and are conditioned on the item still having
+# its old shape, so updates the app makes while the backfill runs are kept.
+TRANSFORMS = {
+    'conversation-updated-at': {
+        'source': 'Conversations',
+        'target': 'Conversations',
+        'update': conversation_updated_at,
+    },
+    'colab-users-set': {
+        'source': 'Conversations',
+        'target': 'Conversations',
+        'update': colab_users_set,
+    },
+    'message-buckets': {
+        'source': 'Messages',
+        'target': BUCKETED_MESSAGES_TABLE,
+        'transform': add_message_key,
+        'before_write': record_message_buckets,
+    },
+}
+
+class CapacityLimiter:
+    """Keeps consumed capacity units under `rate` per second (no limit when rate is None).
+
+    Callers report what each request consumed; once the budget is overdrawn
+    they sleep until it has refilled.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated_at = time.monotonic()
+        self.consumed = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, units):
+        with self._lock:
+            self.consumed += units
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate) - units
+            self.updated_at = now
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+def consumed_units(response):
+    capacity = response.get('ConsumedCapacity') or []
+    if isinstance(capacity, dict):
+        capacity = [capacity]
+    return sum(entry.get('CapacityUnits', 0) for entry in capacity)
+
+class Backfill:
+    """Parallel segmented Scan of `source`, transformed and written to `target` with BatchWriteItem.
+
+    With `update` instead of `transform`, each item is migrated in place with
+    a conditional UpdateItem; items the app changed since they were scanned
+    fail the condition and are counted as skipped. Each of `segments` threads scans one segment. After every page the
+    segment's LastEvaluatedKey is saved to `checkpoint_path` (JSON), so an
+    interrupted run continues where it stopped when started again with the
+    same checkpoint. Reads and writes are throttled to max_read_units and
+    max_write_units consumed capacity units per second.
+    """
+
+    def __init__(self, source, target, transform=None, before_write=None, segments=4, page_size=500,
+                 checkpoint_path=None, max_read_units=None, max_write_units=None, dry_run=False,
+                 max_retries=8, update=None):
+        if (transform is None) == (update is None):
+            raise TypeError('Pass exactly one of transform or update')
+        if update is not None and source != target:
+            raise TypeError('update backfills run in place (source == target)')
+        self.source = source
+        self.target = target
+        self.transform = transform
+        self.update = update
+        self.before_write = before_write
+        self.segments = segments
+        self.page_size = page_size
+        self.checkpoint_path = checkpoint_path
+        self.dry_run = dry_run
+        self.max_retries = max_retries
+        self.key_fields = [key['AttributeName'] for key in TABLE_DEFINITIONS[target]['KeySchema']]
+        self.read_limiter = CapacityLimiter(max_read_units)
+        self.write_limiter = CapacityLimiter(max_write_units)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.state = self._load_checkpoint()
+        self.started_at = None
+        self.resumed_from = 0
+
+    def _new_state(self):
+        return {
+            'source': self.source,
+            'target': self.target,
+            'segments': {str(segment): {'last_key': None, 'done': False, 'scanned': 0, 'written': 0, 'skipped': 0}
+                         for segment in range(self.segments)},
+        }
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return self._new_state()
+        with open(self.checkpoint_path) as f:
+            state = json.load(f)
+        if (state['source'], state['target'], len(state['segments'])) != (self.source, self.target, self.segments):
+            raise ValueError(
+                f"Checkpoint {self.checkpoint_path} is for {state['source']} -> {state['target']} "
+                f"with {len(state['segments'])} segments"
+            )
+        return state
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        temporary_path = f'{self.checkpoint_path}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def progress(self):
+        with self._lock:
+            segments = list(self.state['segments'].values())
+        scanned = sum(segment['scanned'] for segment in segments)
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return {
+            'scanned': scanned,
+            'written': sum(segment['written'] for segment in segments),
+            'skipped': sum(segment['skipped'] for segment in segments),
+            'segments_done': sum(1 for segment in segments if segment['done']),
+            'segments': len(segments),
+            # Rate of this run only, not of the runs the checkpoint resumes
+            'items_per_second': round((scanned - self.resumed_from) / elapsed, 1) if elapsed else 0.0,
+            'read_units': round(self.read_limiter.consumed, 1),
+            'write_units': round(self.write_limiter.consumed, 1),
+        }
+
+    def stop(self):
+        """Stop after the pages in flight; the checkpoint allows resuming."""
+        self._stopping.set()
+
+    def run(self):
+        self.started_at = time.monotonic()
+        self.resumed_from = self.progress()['scanned']
+        pending = [int(segment) for segment, state in self.state['segments'].items() if not state['done']]
+        with ThreadPoolExecutor(max_workers=self.segments, thread_name_prefix='backfill') as executor:
+            futures = [executor.submit(self._run_segment, segment) for segment in pending]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Let the other segments stop at a page boundary, then re-raise
+                self.stop()
+                raise
+        return self.progress()
+
+    def _run_segment(self, segment):
+        table = get_table(self.source)
+        state = self.state['segments'][str(segment)]
+        scan_kwargs = {
+            'Segment': segment,
+            'TotalSegments': self.segments,
+            'Limit': self.page_size,
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+        while not self._stopping.is_set():
+            if state['last_key']:
+                scan_kwargs['ExclusiveStartKey'] = {
+                    key: _deserializer.deserialize(value) for key, value in state['last_key'].items()
+                }
+            response = table.scan(**scan_kwargs)
+            self.read_limiter.consume(consumed_units(response))
+            items = response.get('Items', [])
+            if self.update:
+                written = self._update_items(table, items)
+            else:
+                written = self._copy_items(items)
+            last_key = response.get('LastEvaluatedKey')
+            with self._lock:
+                state['scanned'] += len(items)
+                state['written'] += written
+                state['skipped'] += len(items) - written
+                state['last_key'] = {key: _serializer.serialize(value) for key, value in last_key.items()} if last_key else None
+                state['done'] = last_key is None
+                self._save_checkpoint()
+            if last_key is None:
+                return
+
+    def _copy_items(self, items):
+        """Transform a page and batch-write it to the target; returns the number of items written."""
+        transformed = [item for item in map(self.transform, items) if item is not None]
+        if transformed and not self.dry_run:
+            if self.before_write:
+                self.before_write(transformed)
+            for start in range(0, len(transformed), MAX_BATCH_SIZE):
+                self._write_batch(transformed[start:start + MAX_BATCH_SIZE])
+        return len(transformed)
+
+    def _update_items(self, table, items):
+        """Migrate a page in place; returns the number of items updated."""
+        updated = 0
+        for item in items:
+            update = self.update(item)
+            if update is None:
+                continue
+            if self.dry_run or self._update_item(table, item, update):
+                updated += 1
+        return updated
+
+    def _update_item(self, table, item, update):
+        key = {field: item[field] for field in self.key_fields}
+        attempt = 0
+        while True:
+            try:
+                response = table.update_item(Key=key, ReturnConsumedCapacity='TOTAL', **update)
+                self.write_limiter.consume(consumed_units(response))
+                return True
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ConditionalCheckFailedException':
+                    # Changed (or deleted) since it was scanned; the app wrote the new shape itself
+                    logging.info(f"Skipping {key} in {self.target}: changed since it was scanned")
+                    return False
+                if code not in ('ProvisionedThroughputExceededException', 'ThrottlingException'):
+                    raise
+                logging.warning(f"UpdateItem on {self.target} throttled: {e}")
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RuntimeError(f"Update of {key} in {self.target} still throttled after {self.max_retries} retries")
+            self._backoff(attempt)
+
+    def _write_batch(self, items):
+        # BatchWriteItem rejects two requests for the same key; keep the last one
+        unique = {tuple(item[field] for field in self.key_fields): item for item in items}
+        requests = [{'PutRequest': {'Item': item}} for item in unique.values()]
+        dynamodb = get_dynamodb_resource()
+        attempt = 0
+        while requests:
+            try:
+                response = dynamodb.batch_write_item(
+                    RequestItems={self.target: requests}, ReturnConsumedCapacity='TOTAL'
+                )
+                self.write_limiter.consume(consumed_units(response))
+                requests = response.get('UnprocessedItems', {}).get(self.target, [])
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('ProvisionedThroughputExceededException', 'ThrottlingException'):
+                    raise
+                logging.warning(f"BatchWriteItem on {self.target} throttled: {e}")
+            if not requests:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                raise RuntimeError(f"{len(requests)} items for {self.target} still unprocessed after {self.max_retries} retries")
+            self._backoff(attempt)
+
+    def _backoff(self, attempt):
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(5, 0.1 * 2 ** attempt)))
@@ -0,0 +1,262 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+from django.conf import settings
+from app.helpers.conversation import update_collaborators
+from app.helpers.dynamodb_helpers import get_conversations_table, get_dynamodb_resource, get_table
+
+# TransactWriteItems accepts at most 100 actions per call
+MAX_TRANSACTION_SIZE = 100
+
+_serializer = TypeSerializer()
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_bulk_executor():
+    """Bounded thread pool shared by the bulk conversation updates."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.BULK_UPDATE_CONCURRENCY,
+                    thread_name_prefix='bulk-update'
+                )
+    return _executor
+
+def unique_ids(ids):
+    """Drop duplicate ids, keeping the first occurrence (transactions reject duplicates)."""
+    return list(dict.fromkeys(ids))
+
+def summarize(results):
+    succeeded = sum(1 for result in results.values() if result['status'] == 'updated')
+    return {'results': results, 'updated': succeeded, 'failed': len(results) - succeeded}
+
+def run_concurrently(ids, update):
+    """Call update(id) for every id on the bulk executor; returns per-id results.
+
+    update raises ClientError on failure; ConditionalCheckFailedException is
+    reported as not_found since updates are conditioned on the item existing.
+    """
+    def apply(item_id):
+        try:
+            update(item_id)
+            return {'status': 'updated'}
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                return {'status': 'not_found'}
+            return {'status': 'error', 'error': code}
+
+    ids = unique_ids(ids)
+    return dict(zip(ids, get_bulk_executor().map(apply, ids)))
+
+def run_transactions(ids, build_update):
+    """Apply build_update(id) actions in TransactWriteItems chunks of 100.
+
+    Each chunk is all-or-nothing; when a chunk is cancelled the items that
+    caused it are reported as not_found/error and the rest as rolled_back.
+    """
+    client = get_dynamodb_resource().meta.client
+    results = {}
+    ids = unique_ids(ids)
+    for start in range(0, len(ids), MAX_TRANSACTION_SIZE):
+        chunk = ids[start:start + MAX_TRANSACTION_SIZE]
+        try:
+            client.transact_write_items(TransactItems=[{'Update': build_update(item_id)} for item_id in chunk])
+            results.update({item_id: {'status': 'updated'} for item_id in chunk})
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons')
+            if not reasons:
+                error = e.response['Error']['Code']
+                results.update({item_id: {'status': 'error', 'error': error} for item_id in chunk})
+                continue
+            for item_id, reason in zip(chunk, reasons):
+                code = reason.get('Code', 'None')
+                if code == 'None':
+                    results[item_id] = {'status': 'rolled_back'}
+                elif code == 'ConditionalCheckFailed':
+                    results[item_id] = {'status': 'not_found'}
+                else:
+                    results[item_id] = {'status': 'error', 'error': code}
+    return results
+
+def set_conversation_statuses(conversation_ids, is_open, atomic=False):
+    """Set is_open on many conversations and return per-id results.
+
+    atomic=True applies them in TransactWriteItems batches of 100, otherwise
+    each update runs on its own on the bounded bulk executor.
+    """
+    table = get_conversations_table()
+
+    if atomic:
+        def build_update(conversation_id):
+            return {
+                'TableName': table.name,
+                'Key': {'conversation_id': _serializer.serialize(conversation_id)},
+                'UpdateExpression': 'SET is_open = :is_open',
+                'ConditionExpression': 'attribute_exists(conversation_id)',
+                'ExpressionAttributeValues': {':is_open': _serializer.serialize(is_open)},
+            }
+        return summarize(run_transactions(conversation_ids, build_update))
+
+    def update(conversation_id):
+        table.update_item(
+            Key={'conversation_id': conversation_id},
+            UpdateExpression='SET is_open = :is_open',
+            ConditionExpression='attribute_exists(conversation_id)',
+            ExpressionAttributeValues={
+                ':is_open': is_open
+            }
+        )
+    return summarize(run_concurrently(conversation_ids, update))
+
+def apply_collaborator_changes(changes):
+    """Apply many collaborator changes concurrently; returns one result per change.
+
+    Each change is {'conversation_id': ..., 'add': [...], 'remove': [...]}. Add
+    and remove are separate UpdateItems since one expression cannot both ADD
+    to and DELETE from the same attribute.
+    """
+    def apply(change):
+        result = {'conversation_id': change['conversation_id']}
+        try:
+            if change.get('remove'):
+                update_collaborators(change['conversation_id'], change['remove'], 'remove')
+            if change.get('add'):
+                update_collaborators(change['conversation_id'], change['add'], 'add')
+            result['status'] = 'updated'
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ConditionalCheckFailedException':
+                result['status'] = 'not_found'
+            else:
+                result.update({'status': 'error', 'error': code})
+        return result
+
+    results = list(get_bulk_executor().map(apply, changes))
+    succeeded = sum(1 for result in results if result['status'] == 'updated')
+    return {'results': results, 'updated': succeeded, 'failed': len(results) - succeeded}
+
+class BulkJobs:
+    """Background bulk jobs, addressable by id until they expire.
+
+    A job runs in the process that accepted it, but its status is kept in the
+    BulkJobs table (deleted by DynamoDB TTL after `ttl` seconds), so any
+    process can report it. Per-item results are stored as JSON; when they
+    would not fit in an item, only the ones that did not succeed are kept.
+
+    While a job is queued or running, its process refreshes heartbeat_at
+    (and expires_at) every `heartbeat` seconds; a running job whose heartbeat
+    is older than STALE_AFTER_HEARTBEATS of them is reported as failed, since
+    the process running it has stopped.
+    """
+
+    # Stay well under DynamoDB's 400 KB item size
+    MAX_RESULTS_SIZE = 300000
+    STALE_AFTER_HEARTBEATS = 3
+
+    def __init__(self, ttl=3600, heartbeat=30):
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='bulk-job')
+        self._live_jobs = set()
+        self._live_lock = threading.Lock()
+        self._heartbeat_thread = None
+
+    def _save(self, job):
+        item = {key: value for key, value in job.items() if key != 'results'}
+        if 'results' in job:
+            results = json.dumps(job['results'])
+            if len(results) > self.MAX_RESULTS_SIZE:
+                results = json.dumps({
+                    key: value for key, value in job['results'].items() if value.get('status') != 'updated'
+                })
+                item['results_truncated'] = True
+            item['results'] = results
+        item['expires_at'] = int(time.time()) + self.ttl
+        get_table('BulkJobs').put_item(Item=item)
+
+    def _send_heartbeats(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self._live_lock:
+                job_ids = list(self._live_jobs)
+            for job_id in job_ids:
+                try:
+                    get_table('BulkJobs').update_item(
+                        Key={'job_id': job_id},
+                        UpdateExpression='SET heartbeat_at = :now, expires_at = :expires_at',
+                        # Never touch a job whose outcome was stored meanwhile
+                        ConditionExpression='#status = :running',
+                        ExpressionAttributeNames={'#status': 'status'},
+                        ExpressionAttributeValues={
+                            ':now': int(time.time()),
+                            ':expires_at': int(time.time()) + self.ttl,
+                            ':running': 'running',
+                        }
+                    )
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        logging.warning(f"Could not refresh the heartbeat of bulk job {job_id}: {e}")
+
+    def _start_heartbeats(self):
+        with self._live_lock:
+            if self._heartbeat_thread is None:
+                self._heartbeat_thread = threading.Thread(
+                    target=self._send_heartbeats, name='bulk-job-heartbeat', daemon=True
+                )
+                self._heartbeat_thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        job_id = str(uuid.uuid4())
+        job = {
+            'job_id': job_id,
+            'status': 'running',
+            'created_at': datetime.now().isoformat(),
+            'heartbeat_at': int(time.time()),
+        }
+        self._save(job)
+        with self._live_lock:
+            self._live_jobs.add(job_id)
+        self._start_heartbeats()
+
+        def run():
+            try:
+                job.update(func(*args, **kwargs))
+                job['status'] = 'done'
+            except Exception as e:
+                logging.error(f"Bulk job {job_id} failed: {e}")
+                job.update({'status': 'failed', 'error': str(e)})
+            job['finished_at'] = datetime.now().isoformat()
+            try:
+                self._save(job)
+            except Exception as e:
+                logging.error(f"Could not store the outcome of bulk job {job_id}: {e}")
+            finally:
+                with self._live_lock:
+                    self._live_jobs.discard(job_id)
+
+        self._executor.submit(run)
+        return job_id
+
+    def get(self, job_id):
+        item = get_table('BulkJobs').get_item(Key={'job_id': job_id}).get('Item')
+        if item is None or item['expires_at'] < time.time():
+            return None  # TTL deletion can lag behind expiry
+        del item['expires_at']
+        stale_before = time.time() - self.STALE_AFTER_HEARTBEATS * self.heartbeat
+        if item['status'] == 'running' and item.get('heartbeat_at', 0) < stale_before:
+            item.update({'status': 'failed', 'error': 'The job stopped sending heartbeats; the process running it exited'})
+        if 'results' in item:
+            item['results'] = json.loads(item['results'])
+        return {key: int(value) if isinstance(value, Decimal) else value for key, value in item.items()}
+
+bulk_jobs = BulkJobs(ttl=settings.BULK_JOB_TTL, heartbeat=settings.BULK_JOB_HEARTBEAT)
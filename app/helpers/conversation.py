@@ -1,10 +1,17 @@
-from botocore.exceptions import ClientError
-import boto3
+import logging
+import random
+import time
 import uuid
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import BotoCoreError, ClientError
 from datetime import datetime
+from decimal import Decimal
 from decouple import config
+from django.conf import settings
 import requests
-from app.helpers.dynamodb_helpers import get_dynamodb_resource
+from app.helpers.dynamodb_helpers import decode_cursor, encode_cursor, get_conversations_table, get_dynamodb_resource, projection_kwargs
+from app.helpers.mem_cache import LRUCache
+from app.helpers.metrics import register_metrics
 
 WA_ACCESS_TOKEN = config("WA_ACCESS_TOKEN")
 SPOUT_PHONE_NUMBER_ID = config("SPOUT_PHONE_NUMBER_ID")
@@ -12,106 +19,367 @@ SPOUT_PHONE_NUMBER_ID = config("SPOUT_PHONE_NUMBER_ID")
 # SPOUT_PHONE_NUMBER_ID = "146917221848578"
 WA_CONFIG_TOKEN = config("WA_CONFIG_TOKEN")
 
-# Initialize DynamoDB resource
-dynamodb = get_dynamodb_resource()
+# customer_id -> conversation_id for recently seen customers. Only the id is
+# cached and a customer's conversation never changes or gets deleted, so
+# updates to status, assignment or collaborators leave it valid (routing data
+# is cached separately in _route_cache and invalidated on those updates).
+_conversation_cache = LRUCache(maxsize=settings.CONVERSATION_CACHE_SIZE, ttl=settings.CONVERSATION_CACHE_TTL)
+register_metrics('conversation_cache', _conversation_cache.stats)
 
-def create_tables_if_not_exist():
-    """Ensure that the required DynamoDB tables exist."""
-    # Create Conversations table if it doesn't exist
-    try:
-        conversations_table = dynamodb.Table('Conversations')
-        conversations_table.load()  # Check if the table exists
-    except ClientError as e:
-        if e.response['Error']['Code'] == 'ResourceNotFoundException':
-            print("Table 'Conversations' not found, creating it now.")
-            conversations_table = dynamodb.create_table(
-                TableName='Conversations',
-                KeySchema=[
-                    {'AttributeName': 'conversation_id', 'KeyType': 'HASH'}  # Partition key
-                ],
-                AttributeDefinitions=[
-                    {'AttributeName': 'conversation_id', 'AttributeType': 'S'}
-                ],
-                ProvisionedThroughput={
-                    'ReadCapacityUnits': 5,
-                    'WriteCapacityUnits': 5
-                }
-            )
-            conversations_table.meta.client.get_waiter('table_exists').wait(TableName='Conversations')
-            print("Table 'Conversations' created successfully.")
+# conversation_id -> who should see its events in their inbox (see get_conversation_routes)
+ROUTE_FIELDS = ['conversation_id', 'vendor_id', 'assigned_user_id', 'assigned_team_id', 'colab_users']
+_route_cache = LRUCache(maxsize=settings.CONVERSATION_CACHE_SIZE, ttl=settings.INBOX_ROUTE_CACHE_TTL)
+register_metrics('conversation_route_cache', _route_cache.stats)
+ROUTE_MAX_RETRIES = 5
+
+def get_conversation_routes(conversation_ids):
+    """Map conversation ids to their vendor_id, assignees and colab_users.
+
+    Cached conversations are answered in memory; the rest are read with
+    BatchGetItem (100 keys per call). Entries expire after
+    INBOX_ROUTE_CACHE_TTL seconds and are dropped when this process changes
+    an assignment, so other processes may route to stale groups that long.
+    Raises RuntimeError when keys are still unprocessed after
+    ROUTE_MAX_RETRIES retries.
+    """
+    routes = {}
+    misses = []
+    for conversation_id in dict.fromkeys(conversation_ids):
+        route = _route_cache.get(conversation_id)
+        if route is None:
+            misses.append(conversation_id)
         else:
-            print(f"Unexpected error: {e}")
-            return None  # Indicate failure
+            routes[conversation_id] = route
+    if not misses:
+        return routes
+    table_name = get_conversations_table().name
+    dynamodb = get_dynamodb_resource()
+    for start in range(0, len(misses), 100):
+        request = {
+            table_name: {
+                'Keys': [{'conversation_id': conversation_id} for conversation_id in misses[start:start + 100]],
+                **projection_kwargs(ROUTE_FIELDS),
+            }
+        }
+        attempt = 0
+        while True:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table_name, []):
+                route = format_conversation(item)
+                routes[item['conversation_id']] = route
+                _route_cache.set(item['conversation_id'], route)
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            attempt += 1
+            if attempt > ROUTE_MAX_RETRIES:
+                unprocessed = [key['conversation_id'] for key in request[table_name]['Keys']]
+                logging.error(f"Conversation routes still unprocessed after {ROUTE_MAX_RETRIES} retries: {unprocessed}")
+                raise RuntimeError(f'Failed to read the routes of {len(unprocessed)} conversations')
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(1, 0.05 * 2 ** attempt)))
+    return routes
 
-    # Create Messages table if it doesn't exist
+def find_conversation_id(customer_id):
+    """Look up the conversation of a customer through the customer_id index."""
+    conversations_table = get_conversations_table()
     try:
-        messages_table = dynamodb.Table('Messages')
-        messages_table.load()  # Check if the table exists
+        response = conversations_table.query(
+            IndexName='customer_id-index',
+            KeyConditionExpression=Key('customer_id').eq(customer_id),
+            Limit=1
+        )
+        items = response.get('Items', [])
+        return items[0]['conversation_id'] if items else None
     except ClientError as e:
-        if e.response['Error']['Code'] == 'ResourceNotFoundException':
-            print("Table 'Messages' not found, creating it now.")
-            messages_table = dynamodb.create_table(
-                TableName='Messages',
-                KeySchema=[
-                    {'AttributeName': 'customer_id', 'KeyType': 'HASH'},  # Partition key
-                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}  # Sort key
-                ],
-                AttributeDefinitions=[
-                    {'AttributeName': 'customer_id', 'AttributeType': 'S'},
-                    {'AttributeName': 'timestamp', 'AttributeType': 'S'}
-                ],
-                ProvisionedThroughput={
-                    'ReadCapacityUnits': 5,
-                    'WriteCapacityUnits': 5
-                }
-            )
-            messages_table.meta.client.get_waiter('table_exists').wait(TableName='Messages')
-            print("Table 'Messages' created successfully.")
-        else:
-            print(f"Unexpected error: {e}")
-            return None  # Indicate failure
+        if e.response['Error']['Code'] != 'ValidationException':
+            raise
+    # The index is still being built: fall back to scanning every page
+    scan_kwargs = {'FilterExpression': Attr('customer_id').eq(customer_id)}
+    while True:
+        response = conversations_table.scan(**scan_kwargs)
+        if response['Items']:
+            return response['Items'][0]['conversation_id']
+        if 'LastEvaluatedKey' not in response:
+            return None
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def lookup_conversation(customer_id):
+    """The conversation_id of a customer (None if they have none), without creating one."""
+    conversation_id = _conversation_cache.get(customer_id)
+    if conversation_id is None:
+        conversation_id = find_conversation_id(customer_id)
+        if conversation_id is not None:
+            _conversation_cache.set(customer_id, conversation_id)
+    return conversation_id
+
+# New conversations get an id derived from the customer_id, so concurrent
+# creations for one customer write the same item (see create_conversation)
+CONVERSATION_ID_NAMESPACE = uuid.UUID('8a0481aa-f2a1-471b-bbef-58f74f6ab201')
 
 def create_conversation(customer_id):
     """Ensure that a conversation exists for the given customer_id.
     If not, create a new conversation item in the Conversations table.
+
+    The item is put only if its id (derived from the customer_id) is free,
+    so callers racing to create it, or missing a just created one in the
+    eventually consistent customer_id-index, all end up with one conversation.
     """
-    # Ensure required tables exist
-    create_tables_if_not_exist()
+    conversation_id = _conversation_cache.get(customer_id)
+    if conversation_id is not None:
+        return conversation_id
 
     # Check if customer_id exists in Conversations table
-    conversations_table = dynamodb.Table('Conversations')
-    response = conversations_table.scan(
-        FilterExpression=boto3.dynamodb.conditions.Attr('customer_id').eq(customer_id)
-    )
-    if not response['Items']:
+    conversation_id = find_conversation_id(customer_id)
+    if conversation_id is None:
         # Create a new conversation item
         # admin vendor_id -> channel_id (1), channel_id (2)
         # Spa 1 (vendor 1) -> channel 1(channel 1) <- customer
-        conversation_id = str(uuid.uuid4())  # Generate a new conversation_id
-        conversations_table.put_item(
-            Item={
-                'conversation_id': conversation_id,
-                'customer_id': customer_id,
-                # 'channel_id': channel_id,
-                'vendor_id': 'your_vendor_id',  # Replace with actual vendorId logic
-                'started_at': datetime.now().isoformat(),
-                'updated_at': datetime.now().isoformat(),
-                'is_open': True,
-                'assigned_user_id': None,
-                'assigned_team_id': None,
-                'colab_users': [],
-            }
+        conversation_id = str(uuid.uuid5(CONVERSATION_ID_NAMESPACE, customer_id))
+        try:
+            get_conversations_table().put_item(
+                Item={
+                    'conversation_id': conversation_id,
+                    'customer_id': customer_id,
+                    # 'channel_id': channel_id,
+                    'vendor_id': 'your_vendor_id',  # Replace with actual vendorId logic
+                    'started_at': datetime.now().isoformat(),
+                    'updated_at': datetime.now().isoformat(),
+                    'is_open': True,
+                    'assigned_user_id': None,
+                    'assigned_team_id': None,
+                    # colab_users is a string set, added on first collaborator (sets can't be empty)
+                },
+                ConditionExpression='attribute_not_exists(conversation_id)'
+            )
+            print(f"New conversation {conversation_id} created for customer_id {customer_id}.")
+        except ClientError as e:
+            # Otherwise it was created meanwhile by another request for this customer
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    _conversation_cache.set(customer_id, conversation_id)
+    return conversation_id
+
+def resolve_conversations(customer_ids, executor):
+    """Map every customer_id to its conversation_id, creating missing conversations.
+
+    Cached customers are answered in memory; the remaining lookups (one index
+    Query each, since BatchGetItem cannot read an index) run concurrently on
+    `executor`.
+    """
+    customer_ids = list(dict.fromkeys(customer_ids))
+    conversations = {}
+    misses = []
+    for customer_id in customer_ids:
+        conversation_id = _conversation_cache.get(customer_id)
+        if conversation_id is None:
+            misses.append(customer_id)
+        else:
+            conversations[customer_id] = conversation_id
+    if misses:
+        conversations.update(zip(misses, executor.map(create_conversation, misses)))
+    return conversations
+
+# Attributes of a conversation shown in the inbox list
+INBOX_FIELDS = [
+    'conversation_id', 'customer_id', 'vendor_id', 'is_open', 'assigned_user_id', 'assigned_team_id',
+    'last_message', 'last_sender_id', 'updated_at', 'unread_count',
+]
+
+def list_conversations_by_vendor(vendor_id, limit, cursor=None, fields=None):
+    """Return one page of a vendor's conversations, most recently updated first.
+
+    Reads the vendor_id-updated_at index with a single Query. `cursor` is the
+    value returned for the previous page; `fields` limits the attributes
+    returned. Returns (conversations, next_cursor).
+    """
+    query_kwargs = {
+        'IndexName': 'vendor_id-updated_at-index',
+        'KeyConditionExpression': Key('vendor_id').eq(vendor_id),
+        'ScanIndexForward': False,
+        'Limit': limit,
+        **projection_kwargs(fields),
+    }
+    if cursor:
+        query_kwargs['ExclusiveStartKey'] = decode_cursor(cursor)
+    response = get_conversations_table().query(**query_kwargs)
+    conversations = [format_conversation(item) for item in response.get('Items', [])]
+    return conversations, encode_cursor(response.get('LastEvaluatedKey'))
+
+def format_conversation(item):
+    """Make a Conversations item JSON serializable (string sets become sorted lists, numbers ints)."""
+    def serializable(value):
+        if isinstance(value, set):
+            return sorted(value)
+        if isinstance(value, Decimal):
+            return int(value)
+        return value
+    return {key: serializable(value) for key, value in item.items()}
+
+# Errors worth retrying a summary update for; anything else is raised straight away
+SUMMARY_RETRY_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded', 'InternalServerError')
+SUMMARY_MAX_RETRIES = 3
+
+def _update_conversation(**kwargs):
+    """UpdateItem on Conversations, retrying throttling and connection errors with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return get_conversations_table().update_item(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in SUMMARY_RETRY_ERRORS or attempt >= SUMMARY_MAX_RETRIES:
+                raise
+            error = e
+        except BotoCoreError as e:
+            if attempt >= SUMMARY_MAX_RETRIES:
+                raise
+            error = e
+        attempt += 1
+        logging.warning(f"Retrying update of conversation {kwargs['Key']['conversation_id']}: {error}")
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(1, 0.05 * 2 ** attempt)))
+
+def _update_summary(conversation_id, messages):
+    """Apply a run of new messages (oldest first) to a conversation's inbox summary.
+
+    One UpdateItem sets last_message, last_sender_id and updated_at from the
+    newest message and bumps unread_count by the customer messages; a reply
+    from an agent marks what came before it as read.
+    """
+    last = messages[-1]
+    replied = any(message['sender_id'] != message['customer_id'] for message in messages)
+    unread = 0
+    for message in messages:
+        unread = unread + 1 if message['sender_id'] == message['customer_id'] else 0
+    values = {
+        ':message': last.get('message'),
+        ':sender': last.get('sender_id'),
+        ':updated_at': last['timestamp'],
+        ':unread': unread,
+    }
+    try:
+        _update_conversation(
+            Key={'conversation_id': conversation_id},
+            UpdateExpression=(
+                'SET last_message = :message, last_sender_id = :sender, updated_at = :updated_at'
+                + (', unread_count = :unread' if replied else ' ADD unread_count :unread')
+            ),
+            # Never move the summary back to an older message written late by another process
+            ConditionExpression='attribute_exists(conversation_id) AND (attribute_not_exists(updated_at) OR updated_at <= :updated_at)',
+            ExpressionAttributeValues=values
         )
-        print(f"New conversation {conversation_id} created for customer_id {customer_id}.")
-        return conversation_id  # Return the new conversation_id
-    else:
-        return response['Items'][0]['conversation_id']  # Return existing conversation_id
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if replied or not unread:
+            return
+        # A newer message already set the summary; still count the unread ones
+        try:
+            _update_conversation(
+                Key={'conversation_id': conversation_id},
+                UpdateExpression='ADD unread_count :unread',
+                ConditionExpression='attribute_exists(conversation_id)',
+                ExpressionAttributeValues={':unread': unread}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+def update_conversation_summaries(items):
+    """Maintain the inbox summary fields of the conversations of newly stored messages.
+
+    Runs on the message writer thread after each batch (including the batches
+    drained at exit, when executors no longer accept work), so the updates are
+    made inline; messages of one conversation in the batch are folded into a
+    single UpdateItem. A conversation whose update fails is logged and does
+    not hold back the others.
+    """
+    by_conversation = {}
+    for item in sorted(items, key=lambda item: item['timestamp']):
+        if item.get('conversation_id'):
+            by_conversation.setdefault(item['conversation_id'], []).append(item)
+    for conversation_id, messages in by_conversation.items():
+        try:
+            _update_summary(conversation_id, messages)
+        except Exception as e:
+            logging.error(
+                f"Error updating the summary of conversation {conversation_id} for messages at "
+                f"{[message['timestamp'] for message in messages]}: {e}"
+            )
+
+def assign_conversation(conversation_id, user_id=None, team_id=None):
+    """Set the assigned user and/or team of a conversation."""
+    update_expression = []
+    expression_attribute_values = {}
+    if user_id:
+        update_expression.append("assigned_user_id = :u")
+        expression_attribute_values[':u'] = user_id
+    if team_id:
+        update_expression.append("assigned_team_id = :t")
+        expression_attribute_values[':t'] = team_id
+    get_conversations_table().update_item(
+        Key={'conversation_id': conversation_id},
+        UpdateExpression="set " + ", ".join(update_expression),
+        ExpressionAttributeValues=expression_attribute_values
+    )
+    _route_cache.delete(conversation_id)
+
+def _convert_colab_users_to_set(conversation_id):
+    """Rewrite a legacy list-typed colab_users attribute as a string set."""
+    table = get_conversations_table()
+    item = table.get_item(Key={'conversation_id': conversation_id}).get('Item', {})
+    colab_users = item.get('colab_users')
+    if not isinstance(colab_users, list):
+        return
+    try:
+        if colab_users:
+            table.update_item(
+                Key={'conversation_id': conversation_id},
+                UpdateExpression='SET colab_users = :users',
+                ConditionExpression='colab_users = :old',
+                ExpressionAttributeValues={':users': set(colab_users), ':old': colab_users}
+            )
+        else:
+            table.update_item(
+                Key={'conversation_id': conversation_id},
+                UpdateExpression='REMOVE colab_users',
+                ConditionExpression='colab_users = :old',
+                ExpressionAttributeValues={':old': colab_users}
+            )
+    except ClientError as e:
+        # Someone else converted it in the meantime
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def update_collaborators(conversation_id, user_ids, action):
+    """Add or remove collaborators with a single atomic UpdateItem.
+
+    colab_users is a DynamoDB string set, so ADD ignores users already present
+    and DELETE needs no read first. Raises ClientError with
+    ConditionalCheckFailedException when the conversation does not exist.
+    """
+    operation = 'ADD' if action == 'add' else 'DELETE'
+    for attempt in range(2):
+        try:
+            get_conversations_table().update_item(
+                Key={'conversation_id': conversation_id},
+                UpdateExpression=f'{operation} colab_users :users',
+                ConditionExpression='attribute_exists(conversation_id)',
+                ExpressionAttributeValues={':users': set(user_ids)}
+            )
+            _route_cache.delete(conversation_id)
+            return
+        except ClientError as e:
+            # Conversations written before colab_users became a set still hold a list
+            if e.response['Error']['Code'] != 'ValidationException' or attempt:
+                raise
+            _convert_colab_users_to_set(conversation_id)
 
 def send_whatsapp_message(to_phone_id, message):
     if not WA_ACCESS_TOKEN or not SPOUT_PHONE_NUMBER_ID:
         print("Error: Access token or phone number ID is not defined.")
         return {"error": "Missing credentials"}
-    url = f"https://graph.facebook.com/v20.0/{SPOUT_PHONE_NUMBER_ID}/messages"
+    url = f"{settings.WA_GRAPH_API_URL}/{SPOUT_PHONE_NUMBER_ID}/messages"
     headers = {
         "Authorization": f"Bearer {WA_ACCESS_TOKEN}", 
         "Content-Type": "application/json"
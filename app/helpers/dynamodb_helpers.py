@@ -1,22 +1,292 @@
+import base64
+import json
+import logging
+import threading
 import boto3
+from botocore.exceptions import ClientError
 from decouple import config
 
-# Local testing: 
-# dynamodb = boto3.resource(
-#     'dynamodb',
-#     region_name=config('DYNAMODB_REGION', default='ap-southeast-1'),
-#     endpoint_url=config('DYNAMODB_ENDPOINT_URL', default='http://localhost:8002')
-# )
-
+# Set DYNAMODB_ENDPOINT_URL (e.g. http://localhost:8002) to use DynamoDB Local
 dynamodb = boto3.resource(
     'dynamodb',
     aws_access_key_id=config('AWS_ACCESS_KEY_ID'),
     aws_secret_access_key=config('AWS_SECRET_ACCESS_KEY'),
-    region_name=config('AWS_DEFAULT_REGION')
+    region_name=config('AWS_DEFAULT_REGION'),
+    endpoint_url=config('DYNAMODB_ENDPOINT_URL', default=None)
 )
 
+# Schema of every DynamoDB table the app relies on. ensure_tables() checks
+# (and if needed creates) each of them once per process.
+TABLE_DEFINITIONS = {
+    'Conversations': {
+        'KeySchema': [
+            {'AttributeName': 'conversation_id', 'KeyType': 'HASH'}  # Partition key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'},
+            {'AttributeName': 'customer_id', 'AttributeType': 'S'},
+            {'AttributeName': 'vendor_id', 'AttributeType': 'S'},
+            {'AttributeName': 'updated_at', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [
+            {
+                # Conversation lookup by customer (see create_conversation)
+                'IndexName': 'customer_id-index',
+                'KeySchema': [
+                    {'AttributeName': 'customer_id', 'KeyType': 'HASH'}
+                ],
+                'Projection': {'ProjectionType': 'KEYS_ONLY'},
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            },
+            {
+                # A vendor's conversations, most recently updated first
+                'IndexName': 'vendor_id-updated_at-index',
+                'KeySchema': [
+                    {'AttributeName': 'vendor_id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'updated_at', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'Messages': {
+        'KeySchema': [
+            {'AttributeName': 'customer_id', 'KeyType': 'HASH'},  # Partition key
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}  # Sort key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'customer_id', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [
+            {
+                # A conversation's transcript in time order
+                'IndexName': 'conversation_id-timestamp-index',
+                'KeySchema': [
+                    {'AttributeName': 'conversation_id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'MessagesByMonth': {
+        # Messages keyed by customer and month (MESSAGE_KEY_SCHEME=monthly), so
+        # one customer's history is spread over many partitions
+        'KeySchema': [
+            {'AttributeName': 'bucket', 'KeyType': 'HASH'},  # Partition key: <customer_id>#<YYYYMM>
+            {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}  # Sort key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'bucket', 'AttributeType': 'S'},
+            {'AttributeName': 'timestamp', 'AttributeType': 'S'},
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'}
+        ],
+        'GlobalSecondaryIndexes': [
+            {
+                # A conversation's transcript in time order
+                'IndexName': 'conversation_id-timestamp-index',
+                'KeySchema': [
+                    {'AttributeName': 'conversation_id', 'KeyType': 'HASH'},
+                    {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}
+                ],
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'MessageBucketIndex': {
+        # The months (string set) each customer has messages in, in MessagesByMonth
+        'KeySchema': [
+            {'AttributeName': 'customer_id', 'KeyType': 'HASH'}  # Partition key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'customer_id', 'AttributeType': 'S'}
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'ConversationReads': {
+        # How far each user has read a conversation (last_read_timestamp)
+        'KeySchema': [
+            {'AttributeName': 'conversation_id', 'KeyType': 'HASH'},  # Partition key
+            {'AttributeName': 'user_id', 'KeyType': 'RANGE'}  # Sort key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'conversation_id', 'AttributeType': 'S'},
+            {'AttributeName': 'user_id', 'AttributeType': 'S'}
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'BulkJobs': {
+        # Status and results of background bulk updates, readable from any process
+        'KeySchema': [
+            {'AttributeName': 'job_id', 'KeyType': 'HASH'}  # Partition key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'job_id', 'AttributeType': 'S'}
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+    'ProcessedWebhookMessages': {
+        # WhatsApp message ids already ingested, for webhook deduplication
+        'KeySchema': [
+            {'AttributeName': 'message_id', 'KeyType': 'HASH'}  # Partition key
+        ],
+        'AttributeDefinitions': [
+            {'AttributeName': 'message_id', 'AttributeType': 'S'}
+        ],
+        'ProvisionedThroughput': {
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    },
+}
+
+# Attribute (epoch seconds) after which DynamoDB deletes an item, per table
+TABLE_TIME_TO_LIVE = {
+    'ProcessedWebhookMessages': 'expires_at',
+    'BulkJobs': 'expires_at',
+}
+
+# Table handles that have been verified by ensure_tables()
+_tables = {}
+_tables_lock = threading.Lock()
+
 def get_dynamodb_resource():
     return dynamodb
 
+def _ensure_indexes(table, definition):
+    """Start building a global secondary index the existing table is missing.
+
+    DynamoDB builds one new index at a time, so at most one creation is started
+    per call; the rest are picked up by the next ensure_tables() run. Queries
+    against an index that is not ACTIVE yet fail with a ValidationException,
+    which callers treat as "fall back to the slower read".
+    """
+    existing = {index['IndexName']: index['IndexStatus'] for index in table.global_secondary_indexes or []}
+    if 'CREATING' in existing.values():
+        logging.info(f"An index on '{table.name}' is still being built.")
+        return
+    attribute_types = {attribute['AttributeName']: attribute for attribute in definition['AttributeDefinitions']}
+    for index in definition.get('GlobalSecondaryIndexes', []):
+        if index['IndexName'] in existing:
+            continue
+        logging.info(f"Index '{index['IndexName']}' missing on '{table.name}', creating it now.")
+        try:
+            table.meta.client.update_table(
+                TableName=table.name,
+                AttributeDefinitions=[attribute_types[key['AttributeName']] for key in index['KeySchema']],
+                GlobalSecondaryIndexUpdates=[{'Create': index}]
+            )
+        except ClientError as e:
+            logging.error(f"Could not create index '{index['IndexName']}' on '{table.name}': {e}")
+        return
+
+def _ensure_table(name, definition):
+    table = dynamodb.Table(name)
+    try:
+        table.load()  # Raises ResourceNotFoundException if the table does not exist
+        logging.info(f"Using existing DynamoDB table: {name}")
+        _ensure_indexes(table, definition)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        logging.info(f"Table '{name}' not found, creating it now.")
+        table = dynamodb.create_table(TableName=name, **definition)
+        table.meta.client.get_waiter('table_exists').wait(TableName=name)
+        if name in TABLE_TIME_TO_LIVE:
+            table.meta.client.update_time_to_live(
+                TableName=name,
+                TimeToLiveSpecification={'Enabled': True, 'AttributeName': TABLE_TIME_TO_LIVE[name]}
+            )
+        logging.info(f"Table '{name}' created successfully.")
+    return table
+
+def ensure_tables(force=False):
+    """Check (and create if missing) every table in TABLE_DEFINITIONS.
+
+    Runs the DescribeTable/CreateTable calls only once per process; later
+    calls are no-ops unless force=True.
+    """
+    with _tables_lock:
+        for name, definition in TABLE_DEFINITIONS.items():
+            if force or name not in _tables:
+                _tables[name] = _ensure_table(name, definition)
+    return dict(_tables)
+
+def get_table(name):
+    """Return a ready table handle without any per-request control-plane call."""
+    table = _tables.get(name)
+    if table is None:
+        # Startup provisioning did not run in this process (e.g. runserver or a
+        # shell), so do it lazily on first use.
+        table = ensure_tables()[name]
+    return table
+
 def get_conversations_table():
-    return dynamodb.Table('Conversations')
+    return get_table('Conversations')
+
+def get_messages_table():
+    return get_table('Messages')
+
+def encode_cursor(last_evaluated_key):
+    """Turn a LastEvaluatedKey into an opaque pagination cursor (None when there is no next page)."""
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, default=str).encode()).decode()
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(key, dict):
+        raise ValueError('Invalid cursor')
+    return key
+
+def projection_kwargs(fields):
+    """Build ProjectionExpression arguments for a list of attribute names."""
+    if not fields:
+        return {}
+    names = {f'#f{index}': field for index, field in enumerate(fields)}
+    return {
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+    }
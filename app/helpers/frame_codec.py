@@ -0,0 +1,162 @@
+"""Compact binary WebSocket frames (subprotocol "spout.msgpack.v1").
+
+Clients that ask for BINARY_SUBPROTOCOL when connecting get every frame as
+a binary MessagePack map instead of JSON text, and may send theirs the same
+way. Field names are replaced by the small integer codes in FIELD_CODES and
+the timestamp fields carry integer microseconds since 1970-01-01T00:00 on
+the server's clock (the stored timestamps are naive ISO strings, so this
+round-trips them exactly). Any MessagePack library can read the frames;
+the server uses the C implementation of the msgpack package.
+"""
+import json
+from datetime import datetime, timedelta
+import msgpack
+
+BINARY_SUBPROTOCOL = 'spout.msgpack.v1'
+
+FIELD_CODES = {
+    'type': 0,
+    'message': 1,
+    'sender_id': 2,
+    'timestamp': 3,
+    'messages': 4,
+    'before': 5,
+    'since': 6,
+    'mode': 7,
+    'error': 8,
+    'customer_id': 9,
+    'conversation_id': 10,
+    'message_id': 11,
+    'status': 12,
+    'user_id': 13,
+    'typing': 14,
+    'users': 15,
+    'id': 16,
+    'customer_ids': 17,
+    'limit': 18,
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+TIMESTAMP_FIELDS = {'timestamp', 'before', 'since'}
+# Deepest nesting of arrays and maps accepted from clients; real frames use 4
+MAX_DEPTH = 16
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+def to_epoch_us(value):
+    """ISO timestamp -> integer microseconds; other values are returned unchanged."""
+    if not isinstance(value, str):
+        return value
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if moment.tzinfo is not None:
+        return value
+    return (moment - _EPOCH) // _MICROSECOND
+
+def from_epoch_us(value):
+    """Integer microseconds -> ISO timestamp; raises ValueError when out of datetime's range.
+
+    MessagePack's own timestamp extension is accepted too, read on the same
+    clock as the integers.
+    """
+    if isinstance(value, msgpack.Timestamp):
+        value = value.to_unix_nano() // 1000
+    if isinstance(value, int) and not isinstance(value, bool):
+        try:
+            return (_EPOCH + timedelta(microseconds=value)).isoformat()
+        except OverflowError as e:
+            raise ValueError(f'Timestamp {value} out of range') from e
+    return value
+
+def _compact(value, field=None):
+    if isinstance(value, dict):
+        if field == 'users':
+            # Keyed by user id, not by field name
+            return {key: _compact(item) for key, item in value.items()}
+        return {FIELD_CODES.get(key, key): _compact(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    if field in TIMESTAMP_FIELDS:
+        return to_epoch_us(value)
+    return value
+
+def _expand(value, field=None, depth=0):
+    if isinstance(value, (dict, list)) and depth >= MAX_DEPTH:
+        raise ValueError(f'Frame nested deeper than {MAX_DEPTH} levels')
+    if isinstance(value, dict):
+        if field == 'users':
+            return {key: _expand(item, depth=depth + 1) for key, item in value.items()}
+        expanded = {}
+        for key, item in value.items():
+            name = FIELD_NAMES.get(key, key) if isinstance(key, int) else key
+            expanded[name] = _expand(item, name, depth + 1)
+        return expanded
+    if isinstance(value, list):
+        return [_expand(item, depth=depth + 1) for item in value]
+    if field in TIMESTAMP_FIELDS:
+        return from_epoch_us(value)
+    if isinstance(value, msgpack.Timestamp):
+        raise ValueError(f'Timestamp extension in {field or "a value"} that is not a timestamp field')
+    return value
+
+def _default(value):
+    """msgpack hook for values it can't encode itself: naive datetimes become epoch microseconds."""
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return (value - _EPOCH) // _MICROSECOND
+    raise TypeError(f'Cannot encode {type(value).__name__}')
+
+def packb(value):
+    return msgpack.packb(value, default=_default)
+
+def _ext_hook(code, data):
+    raise ValueError(f'Unsupported MessagePack extension type {code}')
+
+def unpackb(data):
+    """Decode one MessagePack value; raises ValueError for malformed data."""
+    try:
+        # Field codes are integer map keys, which strict_map_key would refuse
+        return msgpack.unpackb(data, strict_map_key=False, ext_hook=_ext_hook)
+    except msgpack.StackError as e:
+        raise ValueError('Frame nested too deeply') from e
+    except (TypeError, msgpack.UnpackException) as e:
+        # TypeError: an array or map used as a map key
+        raise ValueError('Malformed frame') from e
+
+def encode_frame(frame):
+    return packb(_compact(frame))
+
+def decode_frame(data):
+    frame = _expand(unpackb(data))
+    if not isinstance(frame, dict):
+        raise ValueError('Frame must be a map')
+    return frame
+
+class FrameProtocolMixin:
+    """JSON text frames by default, BINARY_SUBPROTOCOL frames when the client asks for it."""
+
+    binary_frames = False
+
+    def negotiate_subprotocol(self):
+        """Subprotocol to pass to accept(): BINARY_SUBPROTOCOL if requested, else None (JSON)."""
+        self.binary_frames = BINARY_SUBPROTOCOL in self.scope.get('subprotocols', [])
+        return BINARY_SUBPROTOCOL if self.binary_frames else None
+
+    async def send_frame(self, frame, **kwargs):
+        if self.binary_frames:
+            await self.send(bytes_data=encode_frame(frame), **kwargs)
+        else:
+            await self.send(text_data=json.dumps(frame), **kwargs)
+
+    def parse_frame(self, text_data=None, bytes_data=None):
+        """The received frame as a dict; raises ValueError when it can't be decoded."""
+        if bytes_data is not None:
+            return decode_frame(bytes_data)
+        try:
+            frame = json.loads(text_data)
+        except RecursionError as e:
+            raise ValueError('Frame nested too deeply') from e
+        if not isinstance(frame, dict):
+            raise ValueError('Frame must be an object')
+        return frame
@@ -0,0 +1,42 @@
+import re
+import uuid
+
+# Channel layer group names: ASCII letters, digits, hyphens, underscores and periods, under 100 characters
+_GROUP_NAME = re.compile(r'^[a-zA-Z\d\-_.]{1,99}$')
+
+def is_valid_group(name):
+    return bool(_GROUP_NAME.match(name))
+
+def chat_group(customer_id):
+    return f'chat_{customer_id}'
+
+def inbox_group(kind, value):
+    """Group of the inbox sockets watching a vendor, team or user."""
+    return f'inbox_{kind}_{value}'
+
+def inbox_groups(route):
+    """Every inbox group that should see the events of a conversation route."""
+    groups = []
+    if route.get('vendor_id'):
+        groups.append(inbox_group('vendor', route['vendor_id']))
+    if route.get('assigned_team_id'):
+        groups.append(inbox_group('team', route['assigned_team_id']))
+    users = set(route.get('colab_users') or [])
+    if route.get('assigned_user_id'):
+        users.add(route['assigned_user_id'])
+    groups.extend(inbox_group('user', user_id) for user_id in sorted(users))
+    return [group for group in groups if is_valid_group(group)]
+
+def conversation_event(event, customer_id, conversation_id):
+    """Tag a chat event with its conversation and an id inbox sockets use to drop duplicates.
+
+    An inbox socket can be in several groups that receive the same event (its
+    vendor, its team, its user and a subscribed chat group).
+    """
+    return {**event, 'customer_id': customer_id, 'conversation_id': conversation_id, 'event_id': uuid.uuid4().hex}
+
+def routed_events(event, customer_id, conversation_id, route):
+    """(group, event) pairs delivering a chat event to the chat group and the inbox groups."""
+    event = conversation_event(event, customer_id, conversation_id)
+    groups = [chat_group(customer_id)] + (inbox_groups(route) if route else [])
+    return [(group, event) for group in groups]
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from app.helpers.metrics import register_metrics
+
+class IOExecutor:
+    """Sized thread pool for blocking DynamoDB/HTTP calls made from async code.
+
+    Unlike sync_to_async's default thread_sensitive mode, calls run in
+    parallel instead of queueing behind the one shared sync thread, so a slow
+    call only occupies its own worker. Tracks utilisation and how long calls
+    wait for a free worker.
+    """
+
+    def __init__(self, workers, name='io'):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=1000)
+        self._created_at = time.monotonic()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, func, *args, **kwargs):
+        submitted_at = time.monotonic()
+        with self._lock:
+            self.queued += 1
+
+        def call():
+            started_at = time.monotonic()
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self._waits.append(started_at - submitted_at)
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self.busy_seconds += time.monotonic() - started_at
+
+        return self._executor.submit(call)
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            uptime = time.monotonic() - self._created_at
+
+            def percentile(pct):
+                return round(waits[min(len(waits) - 1, int(len(waits) * pct / 100))] * 1000, 1) if waits else None
+
+            return {
+                'workers': self.workers,
+                'active': self.active,
+                'queued': self.queued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'utilization': round(self.active / self.workers, 3),
+                # Share of the pool's capacity spent running calls since startup
+                'busy_ratio': round(self.busy_seconds / (uptime * self.workers), 3) if uptime else 0.0,
+                'queue_wait_ms_p50': percentile(50),
+                'queue_wait_ms_p95': percentile(95),
+                'queue_wait_ms_p99': percentile(99),
+            }
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_io_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = IOExecutor(settings.IO_EXECUTOR_WORKERS)
+                register_metrics('io_executor', _executor.stats)
+    return _executor
+
+async def run_io(func, *args, **kwargs):
+    """Await func(*args, **kwargs) run on the I/O executor."""
+    return await get_io_executor().run(func, *args, **kwargs)
@@ -0,0 +1,229 @@
+import asyncio
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from botocore.exceptions import BotoCoreError, ClientError
+from django.conf import settings
+from app.helpers.conversation import update_conversation_summaries
+from app.helpers.dynamodb_helpers import TABLE_DEFINITIONS, get_dynamodb_resource
+from app.helpers.messages import add_message_key, message_keys_bucketed, messages_table_name, record_message_buckets
+from app.helpers.metrics import register_metrics
+
+# BatchWriteItem accepts at most 25 put requests per call
+MAX_BATCH_SIZE = 25
+
+_STOP = object()
+
+class MessageWriter:
+    """Write-behind queue that persists items with BatchWriteItem.
+
+    Producers only wait for the item to be queued. A background thread groups
+    queued items into batches of up to 25 (waiting at most flush_interval for a
+    batch to fill), retries unprocessed items with backoff, and drains the
+    queue when the process exits. The queue is bounded: when it is full,
+    enqueue() blocks for up to enqueue_timeout and then raises queue.Full.
+    Callers that must know an item was stored use submit(), whose Future
+    resolves once BatchWriteItem has accepted it and fails if it was dropped.
+
+    prepare(item) is applied to items as they are queued (e.g. to add derived
+    key attributes); before_write(items) runs on the writer thread before each
+    batch and after_write(items) after it, with the items that were stored.
+    """
+
+    def __init__(self, table_name='Messages', max_queue_size=10000, flush_interval=0.05,
+                 enqueue_timeout=5, max_retries=5, prepare=None, before_write=None,
+                 after_write=None):
+        self.table_name = table_name
+        self.prepare = prepare
+        self.before_write = before_write
+        self.after_write = after_write
+        self.key_fields = [key['AttributeName'] for key in TABLE_DEFINITIONS[table_name]['KeySchema']]
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'{self.table_name}-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def enqueue(self, item, timeout=None, future=None):
+        self.start()
+        if self.prepare:
+            item = self.prepare(item)
+        self.queue.put((item, future), timeout=self.enqueue_timeout if timeout is None else timeout)
+
+    def submit(self, item, timeout=None):
+        """Queue an item; the returned Future resolves when it is stored and raises if it was dropped."""
+        future = Future()
+        self.enqueue(item, timeout=timeout, future=future)
+        return future
+
+    def enqueue_many(self, items, timeout=None):
+        """Queue several items back to back so the writer can put them in the same batches."""
+        for item in items:
+            self.enqueue(item, timeout=timeout)
+
+    async def aenqueue(self, item):
+        """Queue an item from async code; only blocks a worker thread when the queue is full."""
+        self.start()
+        try:
+            self.queue.put_nowait((self.prepare(item) if self.prepare else item, None))
+        except queue.Full:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.enqueue, item)
+
+    def flush(self):
+        """Block until every queued item has been written (or given up on)."""
+        self.queue.join()
+
+    def close(self, timeout=30):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logging.error(f"Writer for {self.table_name} did not drain before shutdown")
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'written': self.written,
+            'failed': self.failed,
+            'batches': self.batches,
+            'retries': self.retries,
+        }
+
+    def _next_batch(self, stopping):
+        """Collect up to MAX_BATCH_SIZE queued (item, future) pairs; returns (batch, stopping)."""
+        batch = []
+        deadline = None
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                if stopping:
+                    # Shutting down: drain what is left without waiting
+                    entry = self.queue.get_nowait()
+                elif not batch:
+                    entry = self.queue.get()
+                    deadline = time.monotonic() + self.flush_interval
+                else:
+                    entry = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                self.queue.task_done()
+                stopping = True
+                continue
+            batch.append(entry)
+        return batch, stopping
+
+    def _run(self):
+        stopping = False
+        while True:
+            batch, stopping = self._next_batch(stopping)
+            if not batch:
+                if stopping:
+                    break
+                continue
+            items = [item for item, _ in batch]
+            try:
+                if self.before_write:
+                    self.before_write(items)
+                dropped = self._write_batch(items)
+            except Exception as e:
+                self.failed += len(items)
+                logging.error(f"Error writing batch to {self.table_name}: {e}; dropped items: {items}")
+                for _, future in batch:
+                    if future is not None:
+                        future.set_exception(e)
+            else:
+                for item, future in batch:
+                    if future is None:
+                        continue
+                    if self._key(item) in dropped:
+                        future.set_exception(RuntimeError(f"Item for {self.table_name} dropped after {self.max_retries} retries"))
+                    else:
+                        future.set_result(True)
+                stored = [item for item in items if self._key(item) not in dropped]
+                if self.after_write and stored:
+                    try:
+                        self.after_write(stored)
+                    except Exception as e:
+                        logging.error(f"Error after writing batch to {self.table_name}: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _key(self, item):
+        return tuple(item[field] for field in self.key_fields)
+
+    def _write_batch(self, items):
+        """Write items with BatchWriteItem; returns the keys of the items given up on."""
+        # BatchWriteItem rejects two requests for the same key; keep the last one
+        unique = {self._key(item): item for item in items}
+        requests = [{'PutRequest': {'Item': item}} for item in unique.values()]
+        dynamodb = get_dynamodb_resource()
+        attempt = 0
+        while requests:
+            try:
+                response = dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+                self.batches += 1
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            except (BotoCoreError, ClientError) as e:
+                # Connection errors and timeouts are as transient as throttling
+                logging.warning(f"BatchWriteItem on {self.table_name} failed: {e}")
+                unprocessed = requests
+            self.written += len(requests) - len(unprocessed)
+            requests = unprocessed
+            if not requests:
+                break
+            attempt += 1
+            if attempt > self.max_retries:
+                self.failed += len(requests)
+                logging.error(
+                    f"Dropping {len(requests)} items for {self.table_name} after {self.max_retries} retries: "
+                    f"{[request['PutRequest']['Item'] for request in requests]}"
+                )
+                return {self._key(request['PutRequest']['Item']) for request in requests}
+            self.retries += len(requests)
+            # Exponential backoff with full jitter
+            time.sleep(random.uniform(0, min(2, 0.05 * 2 ** attempt)))
+        return set()
+
+_message_writer = None
+_message_writer_lock = threading.Lock()
+
+def get_message_writer():
+    global _message_writer
+    if _message_writer is None:
+        with _message_writer_lock:
+            if _message_writer is None:
+                _message_writer = MessageWriter(
+                    table_name=messages_table_name(),
+                    max_queue_size=settings.MESSAGE_WRITE_QUEUE_SIZE,
+                    flush_interval=settings.MESSAGE_WRITE_FLUSH_INTERVAL,
+                    enqueue_timeout=settings.MESSAGE_WRITE_ENQUEUE_TIMEOUT,
+                    prepare=add_message_key if message_keys_bucketed() else None,
+                    before_write=record_message_buckets if message_keys_bucketed() else None,
+                    after_write=update_conversation_summaries,
+                )
+                register_metrics('message_writer', _message_writer.stats)
+    return _message_writer
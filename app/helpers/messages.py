@@ -0,0 +1,193 @@
+from boto3.dynamodb.conditions import Key
+from django.conf import settings
+from app.helpers.dynamodb_helpers import decode_cursor, encode_cursor, get_messages_table, get_table, projection_kwargs
+from app.helpers.mem_cache import LRUCache
+from app.helpers.recent_messages import recent_messages
+
+BUCKETED_MESSAGES_TABLE = 'MessagesByMonth'
+
+# (customer_id, month) pairs already recorded in MessageBucketIndex by this process
+_recorded_buckets = LRUCache(maxsize=100000, ttl=86400)
+
+def message_keys_bucketed():
+    return settings.MESSAGE_KEY_SCHEME == 'monthly'
+
+def messages_table_name():
+    return BUCKETED_MESSAGES_TABLE if message_keys_bucketed() else 'Messages'
+
+def message_month(timestamp):
+    """YYYYMM of an ISO timestamp."""
+    return timestamp[:4] + timestamp[5:7]
+
+def message_bucket(customer_id, month):
+    return f'{customer_id}#{month}'
+
+def add_message_key(item):
+    """Add the MessagesByMonth partition key to a Messages item."""
+    return {**item, 'bucket': message_bucket(item['customer_id'], message_month(item['timestamp']))}
+
+def record_message_buckets(items):
+    """Add the months of new messages to MessageBucketIndex (once per customer and month)."""
+    months = {}
+    for item in items:
+        month = message_month(item['timestamp'])
+        if _recorded_buckets.get((item['customer_id'], month)) is None:
+            months.setdefault(item['customer_id'], set()).add(month)
+    index = get_table('MessageBucketIndex')
+    for customer_id, customer_months in months.items():
+        index.update_item(
+            Key={'customer_id': customer_id},
+            UpdateExpression='ADD months :months',
+            ExpressionAttributeValues={':months': customer_months}
+        )
+        for month in customer_months:
+            _recorded_buckets.set((customer_id, month), True)
+
+def message_months(customer_id):
+    """The months a customer has messages in, oldest first."""
+    item = get_table('MessageBucketIndex').get_item(Key={'customer_id': customer_id}).get('Item', {})
+    return sorted(item.get('months', ()))
+
+def _query_buckets(customer_id, months, condition, forward, limit):
+    """Query the month buckets in the given order until `limit` items are found.
+
+    Returns the items and whether more may follow the last one.
+    """
+    table = get_table(BUCKETED_MESSAGES_TABLE)
+    items = []
+    for index, month in enumerate(months):
+        key_condition = Key('bucket').eq(message_bucket(customer_id, month))
+        query_kwargs = {
+            'KeyConditionExpression': key_condition & condition if condition is not None else key_condition,
+            'ScanIndexForward': forward,
+        }
+        while True:
+            response = table.query(Limit=limit - len(items), **query_kwargs)
+            items.extend(response.get('Items', []))
+            if len(items) >= limit:
+                return items, 'LastEvaluatedKey' in response or index < len(months) - 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items, False
+
+def clamp_history_limit(limit):
+    """Parse a client supplied page size, falling back to the default and capping it."""
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return settings.MESSAGE_HISTORY_PAGE_SIZE
+    return max(1, min(limit, settings.MESSAGE_HISTORY_MAX_PAGE_SIZE))
+
+def format_message(item):
+    """Shape a Messages item the way it is sent over the WebSocket."""
+    return {
+        'message': item.get('message'),
+        'timestamp': item.get('timestamp'),
+        'sender_id': item.get('sender_id')
+    }
+
+def fetch_message_history(customer_id, limit=None, before=None):
+    """Return one page of the newest messages for a customer.
+
+    Reads at most `limit` items newest first (older than the `before` timestamp
+    when given) in a single Query, or with MESSAGE_KEY_SCHEME=monthly one Query
+    per month bucket, newest month first, stopping once the page is full.
+    Returns the page in chronological order and the cursor for the next older
+    page, or None when there is nothing older.
+    """
+    limit = clamp_history_limit(limit)
+    if message_keys_bucketed():
+        months = [month for month in reversed(message_months(customer_id))
+                  if not before or month <= message_month(before)]
+        condition = Key('timestamp').lt(before) if before else None
+        items, has_more = _query_buckets(customer_id, months, condition, forward=False, limit=limit)
+        next_before = items[-1]['timestamp'] if items and has_more else None
+        items.reverse()
+        return items, next_before
+
+    condition = Key('customer_id').eq(customer_id)
+    if before:
+        condition &= Key('timestamp').lt(before)
+
+    response = get_messages_table().query(
+        KeyConditionExpression=condition,
+        ScanIndexForward=False,
+        Limit=limit
+    )
+    items = response.get('Items', [])
+    next_before = items[-1]['timestamp'] if items and 'LastEvaluatedKey' in response else None
+    items.reverse()
+    return items, next_before
+
+def fetch_messages_since(customer_id, since, limit=None):
+    """Return the messages stored after the `since` timestamp, oldest first.
+
+    Used when a client reconnects with the sort key of the last message it saw,
+    so only the missed messages are read. The second value is the cursor to
+    resume from when more than `limit` messages were missed, otherwise None.
+    """
+    limit = clamp_history_limit(limit)
+    if message_keys_bucketed():
+        months = [month for month in message_months(customer_id) if month >= message_month(since)]
+        items, has_more = _query_buckets(customer_id, months, Key('timestamp').gt(since), forward=True, limit=limit)
+        return items, items[-1]['timestamp'] if items and has_more else None
+
+    response = get_messages_table().query(
+        KeyConditionExpression=Key('customer_id').eq(customer_id) & Key('timestamp').gt(since),
+        ScanIndexForward=True,
+        Limit=limit
+    )
+    items = response.get('Items', [])
+    next_since = items[-1]['timestamp'] if items and 'LastEvaluatedKey' in response else None
+    return items, next_since
+
+def list_conversation_messages(conversation_id, limit=None, cursor=None, direction='asc', fields=None):
+    """Return one page of a conversation's messages from the conversation_id-timestamp index.
+
+    direction is 'asc' (oldest first) or 'desc'; `cursor` is the value returned
+    for the previous page and `fields` limits the attributes returned. Raises
+    ValueError for a malformed cursor. Returns (messages, next_cursor).
+    """
+    query_kwargs = {
+        'IndexName': 'conversation_id-timestamp-index',
+        'KeyConditionExpression': Key('conversation_id').eq(conversation_id),
+        'ScanIndexForward': direction != 'desc',
+        'Limit': clamp_history_limit(limit),
+        **projection_kwargs(fields),
+    }
+    if cursor:
+        query_kwargs['ExclusiveStartKey'] = decode_cursor(cursor)
+    response = get_table(messages_table_name()).query(**query_kwargs)
+    return response.get('Items', []), encode_cursor(response.get('LastEvaluatedKey'))
+
+def fetch_recent_history(customer_id, limit=None):
+    """fetch_message_history for the newest page, served from the recent-message cache when possible.
+
+    Returns formatted messages. On a miss the newest cache-sized page is read
+    from DynamoDB and kept for the next connection.
+    """
+    limit = clamp_history_limit(limit)
+    if limit > recent_messages.size:
+        items, next_before = fetch_message_history(customer_id, limit=limit)
+        return [format_message(item) for item in items], next_before
+    cached = recent_messages.history(customer_id, limit)
+    if cached is not None:
+        return cached
+    recent_messages.begin_load(customer_id)
+    items, next_before = fetch_message_history(customer_id, limit=recent_messages.size)
+    messages = [format_message(item) for item in items]
+    recent_messages.finish_load(customer_id, messages, has_older=next_before is not None)
+    page = messages[-limit:]
+    if len(messages) > limit:
+        next_before = page[0]['timestamp']
+    return page, next_before
+
+def fetch_recent_since(customer_id, since, limit=None):
+    """fetch_messages_since served from the recent-message cache when it covers `since`."""
+    limit = clamp_history_limit(limit)
+    cached = recent_messages.since(customer_id, since, limit)
+    if cached is not None:
+        return cached
+    items, next_since = fetch_messages_since(customer_id, since, limit=limit)
+    return [format_message(item) for item in items], next_since
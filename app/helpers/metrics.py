@@ -0,0 +1,15 @@
+import threading
+
+# Subsystems (write-behind queue, outbound sender, caches, ...) register a
+# callable returning a dict of their current counters; /metrics reports them.
+_providers = {}
+_providers_lock = threading.Lock()
+
+def register_metrics(name, provider):
+    with _providers_lock:
+        _providers[name] = provider
+
+def collect_metrics():
+    with _providers_lock:
+        providers = dict(_providers)
+    return {name: provider() for name, provider in providers.items()}
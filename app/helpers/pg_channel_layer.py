@@ -0,0 +1,358 @@
+import asyncio
+import json
+import logging
+import queue
+import random
+import string
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import psycopg2
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.conf import settings
+
+# pg_notify payloads must stay below 8000 bytes; bigger messages go through
+# the ChannelLayerMessage table and only their id is notified.
+MAX_NOTIFY_PAYLOAD = 7900
+
+class PostgresChannelLayer(BaseChannelLayer):
+    """Channel layer that fans messages out across processes with LISTEN/NOTIFY.
+
+    Every process LISTENs on its own Postgres channel and hands out channel
+    names that embed its id, so a message for a channel is a NOTIFY to the
+    owning process. Group membership lives in the ChannelLayerGroup table and
+    expires after group_expiry seconds unless the process that added it is
+    still running and refreshes it (every group_refresh seconds, a third of
+    group_expiry by default); per-channel queues are bounded by capacity and
+    messages older than expiry seconds are dropped. Statements run on up to
+    pool_size connections at once.
+
+    Channels without a "!" (not created by new_channel) are only delivered
+    inside the current process.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(
+        self,
+        database='default',
+        prefix='spout',
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        pool_size=4,
+        group_refresh=None,
+        **kwargs
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.database = database
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.group_refresh = group_refresh or group_expiry / 3
+        self.pool_size = pool_size
+        self.client_id = uuid.uuid4().hex[:12]
+        self.notify_channel = f'{prefix}_{self.client_id}'
+        self.channels = {}
+        self._loop = None
+        self._listen_connection = None
+        self._idle_connections = queue.LifoQueue()
+        self._connection_slots = threading.BoundedSemaphore(pool_size)
+        self._memberships = defaultdict(set)
+        self._refresh_task = None
+        self._last_cleanup = 0
+
+    # Connections
+
+    def _connect(self):
+        db = settings.DATABASES[self.database]
+        connection = psycopg2.connect(
+            dbname=db['NAME'],
+            user=db['USER'],
+            password=db['PASSWORD'],
+            host=db['HOST'],
+            port=db['PORT'],
+        )
+        connection.autocommit = True
+        return connection
+
+    def _acquire_connection(self):
+        """Take an idle pooled connection, or open one while fewer than pool_size are in use."""
+        self._connection_slots.acquire()
+        try:
+            while True:
+                try:
+                    connection = self._idle_connections.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if not connection.closed:
+                    return connection
+        except BaseException:
+            self._connection_slots.release()
+            raise
+
+    def _release_connection(self, connection):
+        if not connection.closed:
+            self._idle_connections.put(connection)
+        self._connection_slots.release()
+
+    def _execute(self, sql, params=None, fetch=False):
+        """Run a statement on a pooled connection (called from an executor)."""
+        connection = self._acquire_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchall() if fetch else None
+        except psycopg2.OperationalError:
+            # Drop the broken connection so the next call reconnects
+            connection.close()
+            raise
+        finally:
+            self._release_connection(connection)
+
+    async def _run(self, sql, params=None, fetch=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._execute, sql, params, fetch)
+
+    def _ensure_listener(self):
+        loop = asyncio.get_running_loop()
+        if self._listen_connection is not None and self._loop is loop:
+            return
+        if self._listen_connection is not None:
+            self._stop_listener()
+        connection = self._connect()
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.notify_channel}"')
+        self._listen_connection = connection
+        self._loop = loop
+        loop.add_reader(connection.fileno(), self._on_notify)
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        self._refresh_task = loop.create_task(self._refresh_groups())
+
+    def _stop_listener(self):
+        if self._listen_connection is None:
+            return
+        try:
+            self._loop.remove_reader(self._listen_connection.fileno())
+        except Exception:
+            pass
+        self._listen_connection.close()
+        self._listen_connection = None
+
+    def _on_notify(self):
+        connection = self._listen_connection
+        try:
+            connection.poll()
+        except psycopg2.OperationalError as e:
+            logging.error(f"Channel layer listener lost its connection: {e}")
+            self._stop_listener()
+            self._loop.call_later(1, self._restart_listener)
+            return
+        while connection.notifies:
+            notify = connection.notifies.pop(0)
+            envelope = json.loads(notify.payload)
+            if 'r' in envelope:
+                # Large payload parked in the ChannelLayerMessage table
+                asyncio.ensure_future(self._deliver_stored(envelope))
+            else:
+                self._deliver_envelope(envelope)
+
+    def _restart_listener(self):
+        try:
+            self._ensure_listener()
+        except psycopg2.OperationalError as e:
+            logging.error(f"Channel layer listener reconnect failed: {e}")
+            self._loop.call_later(1, self._restart_listener)
+
+    # Local delivery
+
+    def _is_local(self, channel):
+        return '!' not in channel or self._owner(channel) == self.client_id
+
+    def _owner(self, channel):
+        """Return the process id embedded in a specific channel name."""
+        return self.non_local_name(channel)[:-1].rsplit('.', 1)[-1]
+
+    def _put(self, channel, message, expires_at):
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((expires_at, message))
+
+    def _deliver_local(self, channel, message, expires_at):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self._loop is not None and running_loop is not self._loop:
+            # Called from another event loop (e.g. async_to_sync in a sync view);
+            # hand the message to the loop that owns the queues.
+            self._loop.call_soon_threadsafe(self._deliver_envelope, {'c': [channel], 'm': message, 'e': expires_at})
+            return
+        self._put(channel, message, expires_at)
+
+    def _deliver_envelope(self, envelope):
+        for channel in envelope['c']:
+            try:
+                self._put(channel, envelope['m'], envelope['e'])
+            except ChannelFull:
+                logging.warning(f"Channel layer dropped a message for full channel {channel}")
+
+    async def _deliver_stored(self, envelope):
+        rows = await self._run(
+            'DELETE FROM "ChannelLayerMessage" WHERE id = %s RETURNING payload',
+            [envelope['r']],
+            fetch=True
+        )
+        if rows:
+            self._deliver_envelope({'c': envelope['c'], 'm': json.loads(rows[0][0]), 'e': envelope['e']})
+
+    # Remote delivery
+
+    async def _notify(self, owner, channels, message, expires_at):
+        payload = json.dumps({'c': channels, 'm': message, 'e': expires_at})
+        if len(payload.encode()) > MAX_NOTIFY_PAYLOAD:
+            rows = await self._run(
+                'INSERT INTO "ChannelLayerMessage" (payload, expires_at) VALUES (%s, to_timestamp(%s)) RETURNING id',
+                [json.dumps(message), expires_at],
+                fetch=True
+            )
+            payload = json.dumps({'c': channels, 'r': rows[0][0], 'e': expires_at})
+        await self._run('SELECT pg_notify(%s, %s)', [f'{self.prefix}_{owner}', payload])
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        assert '__asgi_channel__' not in message
+        expires_at = time.time() + self.expiry
+        if self._is_local(channel):
+            self._deliver_local(channel, message, expires_at)
+        else:
+            await self._notify(self._owner(channel), [channel], message, expires_at)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self._ensure_listener()
+        while True:
+            # Looked up on every pass: the finally below drops an emptied queue,
+            # and later messages for the channel go to a new one
+            queue = self.channels.setdefault(channel, asyncio.Queue())
+            try:
+                expires_at, message = await queue.get()
+            finally:
+                if queue.empty() and self.channels.get(channel) is queue:
+                    del self.channels[channel]
+            if expires_at >= time.time():
+                return message
+
+    async def new_channel(self, prefix='specific'):
+        return '%s.%s!%s' % (
+            prefix,
+            self.client_id,
+            ''.join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        await self._run(
+            'INSERT INTO "ChannelLayerGroup" (group_name, channel_name, expires_at) '
+            'VALUES (%s, %s, now() + make_interval(secs => %s)) '
+            'ON CONFLICT (group_name, channel_name) DO UPDATE SET expires_at = EXCLUDED.expires_at',
+            [group, channel, self.group_expiry]
+        )
+        self._memberships[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), 'Invalid channel name'
+        assert self.valid_group_name(group), 'Invalid group name'
+        channels = self._memberships.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._memberships[group]
+        await self._run(
+            'DELETE FROM "ChannelLayerGroup" WHERE group_name = %s AND channel_name = %s',
+            [group, channel]
+        )
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        await self._clean_expired()
+        rows = await self._run(
+            'SELECT channel_name FROM "ChannelLayerGroup" WHERE group_name = %s AND expires_at > now()',
+            [group],
+            fetch=True
+        )
+        expires_at = time.time() + self.expiry
+        # One NOTIFY per owning process, however many of its channels are in the group
+        remote = defaultdict(list)
+        for (channel,) in rows:
+            if self._is_local(channel):
+                try:
+                    self._deliver_local(channel, message, expires_at)
+                except ChannelFull:
+                    pass
+            else:
+                remote[self._owner(channel)].append(channel)
+        for owner, channels in remote.items():
+            await self._notify(owner, channels, message, expires_at)
+
+    async def _refresh_groups(self):
+        while True:
+            await asyncio.sleep(self.group_refresh)
+            try:
+                await self.refresh_memberships()
+            except psycopg2.Error as e:
+                logging.error(f"Channel layer failed to refresh group memberships: {e}")
+
+    async def refresh_memberships(self):
+        """Push back the expiry of the memberships added by this process and not discarded yet."""
+        pairs = [(group, channel) for group, channels in self._memberships.items() for channel in channels]
+        if not pairs:
+            return
+        groups, channels = zip(*pairs)
+        await self._run(
+            'INSERT INTO "ChannelLayerGroup" (group_name, channel_name, expires_at) '
+            'SELECT group_name, channel_name, now() + make_interval(secs => %s) '
+            'FROM unnest(%s::text[], %s::text[]) AS membership(group_name, channel_name) '
+            'ON CONFLICT (group_name, channel_name) DO UPDATE SET expires_at = EXCLUDED.expires_at',
+            [self.group_expiry, list(groups), list(channels)]
+        )
+
+    async def _clean_expired(self):
+        """Remove expired group memberships and unclaimed large payloads, at most once a minute."""
+        if time.time() - self._last_cleanup < 60:
+            return
+        self._last_cleanup = time.time()
+        await self._run('DELETE FROM "ChannelLayerGroup" WHERE expires_at < now()')
+        await self._run('DELETE FROM "ChannelLayerMessage" WHERE expires_at < now()')
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self._memberships.clear()
+        await self._run('DELETE FROM "ChannelLayerGroup"')
+        await self._run('DELETE FROM "ChannelLayerMessage"')
+
+    async def close(self):
+        self._stop_listener()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                break
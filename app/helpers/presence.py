@@ -0,0 +1,93 @@
+import threading
+import time
+from django.conf import settings
+from app.helpers.mem_cache import LRUCache
+from app.helpers.metrics import register_metrics
+
+PRESENCE_STATUSES = ('online', 'away', 'offline')
+
+class PresenceRegistry:
+    """Who is present in each chat, kept in memory by this process.
+
+    Users expire `ttl` seconds after their last presence event unless it is
+    refreshed, so a client that vanishes without saying "offline" drops out
+    on its own. Every consumer of a chat group applies the presence events it
+    receives, which keeps the registries of all processes serving that chat
+    in step without any storage.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._rooms = {}  # customer_id -> {user_id: (status, expires_at)}
+        self._lock = threading.Lock()
+
+    def update(self, customer_id, user_id, status):
+        """Record a user's status ("offline" removes them); returns the previous one (None if absent)."""
+        now = time.monotonic()
+        with self._lock:
+            users = self._rooms.setdefault(customer_id, {})
+            previous = users.get(user_id)
+            previous_status = previous[0] if previous and previous[1] > now else None
+            if status == 'offline':
+                users.pop(user_id, None)
+            else:
+                users[user_id] = (status, now + self.ttl)
+            if not users:
+                del self._rooms[customer_id]
+        return previous_status
+
+    def present(self, customer_id):
+        """{user_id: status} of the users present in a chat."""
+        now = time.monotonic()
+        with self._lock:
+            users = self._rooms.get(customer_id, {})
+            for user_id in [user_id for user_id, (_, expires_at) in users.items() if expires_at <= now]:
+                del users[user_id]
+            if not users:
+                self._rooms.pop(customer_id, None)
+            return {user_id: status for user_id, (status, _) in users.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._rooms),
+                'users': sum(len(users) for users in self._rooms.values()),
+            }
+
+class EventThrottle:
+    """Coalesces repeated ephemeral events (typing, presence) per key.
+
+    allow(key, state) is True when the state differs from the last allowed
+    one or `interval` seconds have passed since it, so a client repeating
+    "typing" on every keystroke is broadcast at most once per interval while
+    a switch to "stopped typing" goes out straight away.
+    """
+
+    def __init__(self, interval=1.0, maxsize=100000):
+        self._last = LRUCache(maxsize=maxsize, ttl=interval)
+        self.allowed = 0
+        self.dropped = 0
+
+    def allow(self, key, state):
+        if self._last.get(key, _MISSING) == state:
+            self.dropped += 1
+            return False
+        self._last.set(key, state)
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {'allowed': self.allowed, 'dropped': self.dropped}
+
+_MISSING = object()
+
+presence = PresenceRegistry(ttl=settings.PRESENCE_TTL)
+# Presence is re-broadcast at half the TTL so the other processes' registries
+# don't expire a user who is still there
+presence_throttle = EventThrottle(interval=settings.PRESENCE_TTL / 2)
+typing_throttle = EventThrottle(interval=settings.TYPING_EVENT_INTERVAL)
+register_metrics('presence', lambda: {
+    **presence.stats(),
+    'typing': typing_throttle.stats(),
+    'presence_events': presence_throttle.stats(),
+})
@@ -0,0 +1,250 @@
+import atexit
+import logging
+import threading
+from datetime import datetime
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from django.conf import settings
+from app.helpers.bulk_updates import get_bulk_executor
+from app.helpers.dynamodb_helpers import get_table
+from app.helpers.inbox import chat_group
+from app.helpers.messages import messages_table_name
+from app.helpers.metrics import register_metrics
+from app.helpers.recent_messages import recent_messages
+
+class ReadMarkWriter:
+    """Coalesces read marks and stores them every flush_interval seconds.
+
+    Only the newest mark per (conversation, user) is kept between flushes, so
+    each pair costs at most one conditional UpdateItem per interval however
+    often clients report reads. The condition keeps marks from moving back.
+    Marks that fail to store go back into the queue (unless a newer one for
+    the same pair arrived meanwhile) and are given up after max_retries
+    flushes.
+    """
+
+    def __init__(self, flush_interval=5, max_retries=5):
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._pending = {}
+        self._attempts = {}  # (conversation_id, user_id) -> failed flushes of its pending mark
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.received = 0
+        self.written = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='read-mark-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def mark(self, conversation_id, user_id, timestamp):
+        self.start()
+        with self._lock:
+            self.received += 1
+            key = (conversation_id, user_id)
+            if timestamp > self._pending.get(key, ''):
+                self._pending[key] = timestamp
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'received': self.received,
+            'written': self.written,
+            'retried': self.retried,
+            'failed': self.failed,
+        }
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error flushing read marks: {e}")
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        failed = {}
+        try:
+            table = get_table('ConversationReads')
+        except Exception as e:
+            logging.error(f"Error opening ConversationReads: {e}")
+            self._requeue(pending)
+            return
+        for key, timestamp in pending.items():
+            conversation_id, user_id = key
+            try:
+                table.update_item(
+                    Key={'conversation_id': conversation_id, 'user_id': user_id},
+                    UpdateExpression='SET last_read_timestamp = :timestamp',
+                    ConditionExpression='attribute_not_exists(last_read_timestamp) OR last_read_timestamp < :timestamp',
+                    ExpressionAttributeValues={':timestamp': timestamp}
+                )
+            except Exception as e:
+                if not (isinstance(e, ClientError) and e.response['Error']['Code'] == 'ConditionalCheckFailedException'):
+                    logging.error(f"Error storing read mark for {conversation_id}/{user_id}: {e}")
+                    failed[key] = timestamp
+                    continue
+                # Otherwise already read further
+            else:
+                self.written += 1
+            with self._lock:
+                self._attempts.pop(key, None)
+        self._requeue(failed)
+
+    def _requeue(self, failed):
+        """Put marks that failed to store back, unless a newer mark for the pair is already queued."""
+        with self._lock:
+            for key, timestamp in failed.items():
+                attempts = self._attempts.get(key, 0) + 1
+                if attempts > self.max_retries:
+                    self._attempts.pop(key, None)
+                    self.failed += 1
+                    logging.error(f"Dropping read mark {timestamp} for {key[0]}/{key[1]} after {self.max_retries} retries")
+                    continue
+                self._attempts[key] = attempts
+                self.retried += 1
+                if timestamp > self._pending.get(key, ''):
+                    self._pending[key] = timestamp
+
+_read_mark_writer = None
+_read_mark_writer_lock = threading.Lock()
+
+def get_read_mark_writer():
+    global _read_mark_writer
+    if _read_mark_writer is None:
+        with _read_mark_writer_lock:
+            if _read_mark_writer is None:
+                _read_mark_writer = ReadMarkWriter(flush_interval=settings.READ_RECEIPT_FLUSH_INTERVAL)
+                register_metrics('read_receipts', _read_mark_writer.stats)
+    return _read_mark_writer
+
+def parse_read_timestamp(value):
+    """Normalise a client's read mark to the stored message timestamp format; raises ValueError."""
+    if not isinstance(value, str):
+        raise ValueError('A read timestamp must be a string.')
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        # Message timestamps are naive; an offset would compare wrongly with them
+        raise ValueError('A read timestamp must not have a UTC offset.')
+    return moment.isoformat()
+
+def latest_message_timestamp(customer_id, conversation_id):
+    """Timestamp of the conversation's newest message (None if it has none).
+
+    Taken from the recent message cache when it is current, which also knows
+    the messages still in the write-behind queue; otherwise one Query.
+    """
+    latest = recent_messages.peek_latest(customer_id)
+    if latest is not None:
+        return latest['timestamp']
+    response = get_table(messages_table_name()).query(
+        IndexName='conversation_id-timestamp-index',
+        KeyConditionExpression=Key('conversation_id').eq(conversation_id),
+        ScanIndexForward=False,
+        Limit=1,
+        ProjectionExpression='#timestamp',
+        ExpressionAttributeNames={'#timestamp': 'timestamp'},
+    )
+    items = response.get('Items', [])
+    return items[0]['timestamp'] if items else None
+
+def check_read_timestamp(customer_id, conversation_id, timestamp):
+    """Raise ValueError for a read mark past the conversation's newest message."""
+    latest = latest_message_timestamp(customer_id, conversation_id)
+    if latest is None or timestamp > latest:
+        raise ValueError("A read can't be later than the conversation's last message.")
+
+def record_read(customer_id, conversation_id, user_id, timestamp):
+    """Queue a user's read mark and return the (group, event) announcing it.
+
+    The event goes to the conversation's chat group; nothing is written to
+    the Messages table.
+    """
+    get_read_mark_writer().mark(conversation_id, user_id, timestamp)
+    return chat_group(customer_id), {
+        'type': 'read_receipt',
+        'customer_id': customer_id,
+        'conversation_id': conversation_id,
+        'user_id': user_id,
+        'timestamp': timestamp,
+    }
+
+def get_read_marks(conversation_id):
+    """Every user's last_read_timestamp for a conversation."""
+    response = get_table('ConversationReads').query(
+        KeyConditionExpression=Key('conversation_id').eq(conversation_id)
+    )
+    return {item['user_id']: item['last_read_timestamp'] for item in response.get('Items', [])}
+
+def count_unread(conversation_id, last_read_timestamp):
+    """Customer messages after a read mark that no agent has replied to, up to UNREAD_COUNT_CAP.
+
+    An agent reply marks what came before it as read, like the conversation
+    summary's shared unread_count; the read mark is the user's own, so each
+    user's count is independent of what other agents have read.
+    Reads the conversation_id-timestamp index newest first and stops at the
+    first agent message, so a long unread backlog doesn't cost a long read.
+    """
+    condition = Key('conversation_id').eq(conversation_id)
+    if last_read_timestamp:
+        condition &= Key('timestamp').gt(last_read_timestamp)
+    query_kwargs = {
+        'IndexName': 'conversation_id-timestamp-index',
+        'KeyConditionExpression': condition,
+        'ScanIndexForward': False,
+        'ProjectionExpression': 'sender_id, customer_id',
+    }
+    table = get_table(messages_table_name())
+    count = 0
+    while count < settings.UNREAD_COUNT_CAP:
+        response = table.query(Limit=settings.UNREAD_COUNT_CAP - count, **query_kwargs)
+        for item in response.get('Items', []):
+            if item.get('sender_id') != item.get('customer_id'):
+                return count
+            count += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return count
+
+def get_read_mark(conversation_id, user_id):
+    item = get_table('ConversationReads').get_item(
+        Key={'conversation_id': conversation_id, 'user_id': user_id}
+    ).get('Item')
+    return item['last_read_timestamp'] if item else None
+
+def add_user_unread_counts(conversations, user_id):
+    """Replace each inbox conversation's unread_count with what one user has left unread.
+
+    Counted per conversation from the user's own read mark (see
+    count_unread), concurrently on the bulk executor; conversations read up to
+    their last message cost only the mark lookup. Returns the conversations.
+    """
+    def user_unread(conversation):
+        mark = get_read_mark(conversation['conversation_id'], user_id)
+        if mark and conversation.get('updated_at') and mark >= conversation['updated_at']:
+            return 0
+        return count_unread(conversation['conversation_id'], mark)
+
+    for conversation, unread in zip(conversations, get_bulk_executor().map(user_unread, conversations)):
+        conversation['unread_count'] = unread
+    return conversations
+
+def get_read_state(conversation_id, user_id=None):
+    """Read marks of a conversation, plus what is unread from one user's mark (see count_unread)."""
+    reads = get_read_marks(conversation_id)
+    state = {'reads': [{'user_id': key, 'last_read_timestamp': value} for key, value in sorted(reads.items())]}
+    if user_id:
+        state['last_read_timestamp'] = reads.get(user_id)
+        state['unread_count'] = count_unread(conversation_id, reads.get(user_id))
+    return state
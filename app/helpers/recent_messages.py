@@ -0,0 +1,173 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict, deque
+from django.conf import settings
+from app.helpers.metrics import register_metrics
+
+class _Entry:
+    __slots__ = ('messages', 'timestamps', 'has_older', 'loaded', 'subscribers', 'expires_at')
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)
+        self.timestamps = deque(maxlen=size)
+        self.has_older = False
+        self.loaded = False
+        self.subscribers = 0
+        self.expires_at = None
+
+class RecentMessageCache:
+    """The last `size` messages of up to `maxsize` customers, newest conversations kept (LRU).
+
+    An entry is filled from DynamoDB on the first miss and then kept current
+    write-through: by the code that stores a message in this process and by
+    the consumers of the customer's chat group, which see every message sent
+    to the group by any process. It is only trusted while a consumer in this
+    process is subscribed to the group, and for `ttl` seconds after the last
+    one leaves, since messages sent meanwhile may never reach this process.
+
+    Messages are the dicts sent over the WebSocket (see format_message), kept
+    in timestamp order; writes with an already buffered timestamp are ignored.
+    """
+
+    def __init__(self, maxsize=1000, size=50, ttl=30):
+        self.maxsize = maxsize
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entry(self, customer_id):
+        entry = self._entries.get(customer_id)
+        if entry is None:
+            entry = self._entries[customer_id] = _Entry(self.size)
+            self._evict()
+        self._entries.move_to_end(customer_id)
+        return entry
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _is_fresh(self, entry):
+        if entry is None or not entry.loaded:
+            return False
+        return entry.subscribers > 0 or entry.expires_at > time.monotonic()
+
+    @staticmethod
+    def _insert(entry, message):
+        timestamp = message['timestamp']
+        if not entry.timestamps or timestamp > entry.timestamps[-1]:
+            if len(entry.messages) == entry.messages.maxlen:
+                entry.has_older = True
+            entry.messages.append(message)
+            entry.timestamps.append(timestamp)
+            return
+        index = bisect.bisect_left(entry.timestamps, timestamp)
+        if entry.timestamps[index] == timestamp:
+            return
+        if len(entry.messages) == entry.messages.maxlen:
+            if index == 0:
+                return  # Older than everything buffered
+            entry.messages.popleft()
+            entry.timestamps.popleft()
+            entry.has_older = True
+            index -= 1
+        entry.messages.insert(index, message)
+        entry.timestamps.insert(index, timestamp)
+
+    def subscribe(self, customer_id):
+        with self._lock:
+            self._entry(customer_id).subscribers += 1
+
+    def unsubscribe(self, customer_id):
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is not None and entry.subscribers:
+                entry.subscribers -= 1
+                entry.expires_at = time.monotonic() + self.ttl
+
+    def add(self, customer_id, messages):
+        """Write-through of newly stored messages; ignored for customers not cached."""
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if entry is None:
+                return
+            for message in messages:
+                self._insert(entry, message)
+
+    def begin_load(self, customer_id):
+        """Start buffering writes for a customer whose history is about to be read."""
+        with self._lock:
+            entry = self._entry(customer_id)
+            entry.loaded = False
+
+    def finish_load(self, customer_id, messages, has_older):
+        """Merge the newest stored messages (chronological) into the buffer."""
+        with self._lock:
+            entry = self._entry(customer_id)
+            for message in messages:
+                self._insert(entry, message)
+            entry.has_older = entry.has_older or has_older
+            entry.loaded = True
+            entry.expires_at = time.monotonic() + self.ttl
+
+    def history(self, customer_id, limit):
+        """(messages, next_before) for the newest `limit` messages, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if not self._is_fresh(entry) or (limit > len(entry.messages) and entry.has_older):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(customer_id)
+            self.hits += 1
+            messages = list(entry.messages)[-limit:]
+            has_more = len(entry.messages) > limit or entry.has_older
+            return messages, messages[0]['timestamp'] if messages and has_more else None
+
+    def since(self, customer_id, since, limit):
+        """(messages, next_since) for messages after `since`, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if not self._is_fresh(entry) or (entry.has_older and (not entry.timestamps or since < entry.timestamps[0])):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(customer_id)
+            self.hits += 1
+            index = bisect.bisect_right(entry.timestamps, since)
+            messages = list(entry.messages)[index:index + limit]
+            more = len(entry.messages) - index > limit
+            return messages, messages[-1]['timestamp'] if more else None
+
+    def peek_latest(self, customer_id):
+        """Newest buffered message while the entry is current, else None.
+
+        For lookups that are not history reads: doesn't count as a hit or
+        miss and doesn't refresh the entry's LRU position.
+        """
+        with self._lock:
+            entry = self._entries.get(customer_id)
+            if not self._is_fresh(entry) or not entry.messages:
+                return None
+            return entry.messages[-1]
+
+    def stats(self):
+        return {
+            'conversations': len(self._entries),
+            'maxsize': self.maxsize,
+            'messages_per_conversation': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+recent_messages = RecentMessageCache(
+    maxsize=settings.RECENT_MESSAGE_CACHE_CONVERSATIONS,
+    size=settings.RECENT_MESSAGE_CACHE_SIZE,
+    ttl=settings.RECENT_MESSAGE_CACHE_TTL,
+)
+register_metrics('recent_message_cache', recent_messages.stats)
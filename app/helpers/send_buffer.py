@@ -0,0 +1,228 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from app.helpers.metrics import register_metrics
+
+SEND_BUFFER_POLICIES = ('drop_oldest', 'coalesce', 'close')
+
+# Live BufferedSendMixin consumers of this process, for the reaper and /metrics
+_connections = set()
+_connections_lock = threading.Lock()
+_totals = {'dropped': 0, 'coalesced': 0, 'overflow_closes': 0, 'idle_closes': 0, 'stalled_closes': 0}
+_reaper_task = None
+
+class _Frame:
+    __slots__ = ('key', 'text_data', 'bytes_data', 'size')
+
+    def __init__(self, key, text_data, bytes_data):
+        self.key = key
+        self.text_data = text_data
+        self.bytes_data = bytes_data
+        self.size = len(text_data or '') + len(bytes_data or b'')
+
+class BufferedSendMixin:
+    """Bounded outgoing buffer for AsyncWebsocketConsumer subclasses.
+
+    send() only queues the frame; one task per connection writes the queue
+    out in order, so a slow client holds back its own frames and nobody
+    else's. When WS_SEND_BUFFER_SIZE frames are waiting, WS_SEND_BUFFER_POLICY
+    decides what happens to the next one:
+
+    - drop_oldest: the oldest queued frame is discarded.
+    - coalesce: frames sent with a coalesce_key (typing, presence) replace the
+      queued frame with the same key at any time; when the buffer is full the
+      oldest keyed frame is discarded, and the connection is closed with
+      WS_SEND_BUFFER_CLOSE_CODE if there is none.
+    - close: the connection is closed with WS_SEND_BUFFER_CLOSE_CODE.
+
+    A reaper task closes connections whose queue has not moved for
+    WS_STALL_TIMEOUT seconds, and (when WS_IDLE_TIMEOUT is set) connections
+    that sent nothing for that long.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_buffer_size = settings.WS_SEND_BUFFER_SIZE
+        self.send_buffer_policy = settings.WS_SEND_BUFFER_POLICY
+        if self.send_buffer_policy not in SEND_BUFFER_POLICIES:
+            raise ValueError(f"WS_SEND_BUFFER_POLICY must be one of {', '.join(SEND_BUFFER_POLICIES)}")
+        self._send_queue = deque()
+        self._keyed_frames = {}
+        self._send_ready = asyncio.Event()
+        self._sender_task = None
+        self._send_closed = False
+        self.queued_bytes = 0
+        self.max_queued = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.frames_coalesced = 0
+        self.last_received_at = self.last_progress_at = time.monotonic()
+
+    async def websocket_connect(self, message):
+        with _connections_lock:
+            _connections.add(self)
+        _start_reaper()
+        await super().websocket_connect(message)
+
+    async def websocket_receive(self, message):
+        self.last_received_at = time.monotonic()
+        await super().websocket_receive(message)
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            self._stop_sending()
+
+    async def send(self, text_data=None, bytes_data=None, close=False, coalesce_key=None):
+        if close:
+            self._stop_sending()
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+        if text_data is None and bytes_data is None:
+            raise ValueError("You must pass one of bytes_data or text_data")
+        if self._send_closed:
+            return
+        if coalesce_key is not None and self.send_buffer_policy == 'coalesce':
+            frame = self._keyed_frames.get(coalesce_key)
+            if frame is not None:
+                replacement = _Frame(coalesce_key, text_data, bytes_data)
+                frame.text_data, frame.bytes_data = replacement.text_data, replacement.bytes_data
+                self.queued_bytes += replacement.size - frame.size
+                frame.size = replacement.size
+                self.frames_coalesced += 1
+                _totals['coalesced'] += 1
+                return
+        if len(self._send_queue) >= self.send_buffer_size and not self._make_room():
+            logging.warning(f"Closing {self.scope.get('path')}: send buffer full ({len(self._send_queue)} frames)")
+            _totals['overflow_closes'] += 1
+            await self.close(code=settings.WS_SEND_BUFFER_CLOSE_CODE)
+            return
+        frame = _Frame(coalesce_key, text_data, bytes_data)
+        if not self._send_queue:
+            # The stall clock runs from the moment frames start waiting
+            self.last_progress_at = time.monotonic()
+        self._send_queue.append(frame)
+        if coalesce_key is not None and self.send_buffer_policy == 'coalesce':
+            self._keyed_frames[coalesce_key] = frame
+        self.queued_bytes += frame.size
+        self.max_queued = max(self.max_queued, len(self._send_queue))
+        self._send_ready.set()
+        if self._sender_task is None:
+            self._sender_task = asyncio.get_running_loop().create_task(self._write_frames())
+
+    async def close(self, code=None, reason=None):
+        self._stop_sending()
+        await super().close(code=code, reason=reason)
+
+    def _make_room(self):
+        """Discard a queued frame according to the policy; False when the connection should close."""
+        if self.send_buffer_policy == 'drop_oldest':
+            self._discard(self._send_queue[0])
+            return True
+        if self.send_buffer_policy == 'coalesce':
+            frame = next((frame for frame in self._send_queue if frame.key is not None), None)
+            if frame is not None:
+                self._discard(frame)
+                return True
+        return False
+
+    def _discard(self, frame):
+        self._send_queue.remove(frame)
+        self._forget(frame)
+        self.frames_dropped += 1
+        _totals['dropped'] += 1
+
+    def _forget(self, frame):
+        self.queued_bytes -= frame.size
+        if frame.key is not None and self._keyed_frames.get(frame.key) is frame:
+            del self._keyed_frames[frame.key]
+
+    def _stop_sending(self):
+        if self._send_closed:
+            return
+        self._send_closed = True
+        self._send_queue.clear()
+        self._keyed_frames.clear()
+        self.queued_bytes = 0
+        if self._sender_task is not None and self._sender_task is not asyncio.current_task():
+            self._sender_task.cancel()
+        with _connections_lock:
+            _connections.discard(self)
+
+    async def _write_frames(self):
+        try:
+            while not self._send_closed:
+                await self._send_ready.wait()
+                self._send_ready.clear()
+                while self._send_queue:
+                    frame = self._send_queue.popleft()
+                    self._forget(frame)
+                    await super().send(text_data=frame.text_data, bytes_data=frame.bytes_data)
+                    self.frames_sent += 1
+                    self.last_progress_at = time.monotonic()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Error sending to {self.scope.get('path')}: {e}")
+            self._stop_sending()
+
+    def send_buffer_stats(self):
+        now = time.monotonic()
+        return {
+            # Chat paths carry the customer's phone number; a digest still matches repeated entries
+            'consumer': type(self).__name__,
+            'path_hash': hashlib.sha256((self.scope.get('path') or '').encode()).hexdigest()[:12],
+            'queued': len(self._send_queue),
+            'queued_bytes': self.queued_bytes,
+            'max_queued': self.max_queued,
+            'sent': self.frames_sent,
+            'dropped': self.frames_dropped,
+            'coalesced': self.frames_coalesced,
+            'idle_seconds': round(now - self.last_received_at, 1),
+        }
+
+async def _reap():
+    while True:
+        await asyncio.sleep(settings.WS_REAPER_INTERVAL)
+        now = time.monotonic()
+        with _connections_lock:
+            connections = list(_connections)
+        for connection in connections:
+            if connection._send_queue and now - connection.last_progress_at > settings.WS_STALL_TIMEOUT:
+                reason, code = 'stalled_closes', settings.WS_SEND_BUFFER_CLOSE_CODE
+            elif settings.WS_IDLE_TIMEOUT and now - connection.last_received_at > settings.WS_IDLE_TIMEOUT:
+                reason, code = 'idle_closes', settings.WS_IDLE_CLOSE_CODE
+            else:
+                continue
+            _totals[reason] += 1
+            try:
+                await connection.close(code=code)
+            except Exception as e:
+                logging.error(f"Error closing {connection.scope.get('path')}: {e}")
+
+def _start_reaper():
+    """Start the reaper on the running event loop, once per loop."""
+    global _reaper_task
+    loop = asyncio.get_running_loop()
+    if _reaper_task is None or _reaper_task.done() or _reaper_task.get_loop() is not loop:
+        _reaper_task = loop.create_task(_reap())
+
+def connection_stats():
+    with _connections_lock:
+        connections = [connection.send_buffer_stats() for connection in _connections]
+    connections.sort(key=lambda stats: stats['queued_bytes'], reverse=True)
+    return {
+        'connections': len(connections),
+        'queued': sum(stats['queued'] for stats in connections),
+        'queued_bytes': sum(stats['queued_bytes'] for stats in connections),
+        **_totals,
+        # The connections holding the most unsent data
+        'largest': connections[:10],
+    }
+
+register_metrics('websocket_connections', connection_stats)
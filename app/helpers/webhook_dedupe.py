@@ -0,0 +1,63 @@
+import time
+from botocore.exceptions import ClientError
+from django.conf import settings
+from app.helpers.dynamodb_helpers import get_table
+from app.helpers.mem_cache import LRUCache
+from app.helpers.metrics import register_metrics
+
+# WhatsApp message ids this process has already ingested (fast path)
+_seen_messages = LRUCache(maxsize=settings.WEBHOOK_DEDUPE_CACHE_SIZE, ttl=settings.WEBHOOK_DEDUPE_TTL)
+register_metrics('webhook_dedupe_cache', _seen_messages.stats)
+
+def is_known_duplicate(message_id):
+    """In-memory check only; True means the message was already ingested here."""
+    return _seen_messages.get(message_id) is not None
+
+def claim_message(message_id):
+    """Claim a WhatsApp message id for ingestion; False if it was already stored or is being ingested.
+
+    The durable record is a conditional put on the ProcessedWebhookMessages
+    table (expired by DynamoDB TTL), so redeliveries handled by another process
+    are caught too. The claim starts as a lease of WEBHOOK_CLAIM_LEASE
+    seconds: confirm_message() makes it permanent once the message is stored
+    and release_message() drops it when storing failed. A lease left behind
+    by a process that died expires, so the retry of its payload can claim the
+    message again.
+    """
+    if is_known_duplicate(message_id):
+        return False
+    now = int(time.time())
+    try:
+        get_table('ProcessedWebhookMessages').put_item(
+            Item={
+                'message_id': message_id,
+                'claim_state': 'pending',
+                'lease_until': now + settings.WEBHOOK_CLAIM_LEASE,
+                'expires_at': now + settings.WEBHOOK_DEDUPE_TTL,
+            },
+            # Claims written before leases existed have no claim_state and count as stored
+            ConditionExpression='attribute_not_exists(message_id) OR (claim_state = :pending AND lease_until < :now)',
+            ExpressionAttributeValues={':pending': 'pending', ':now': now},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if e.response.get('Item', {}).get('claim_state', {}).get('S') != 'pending':
+            _seen_messages.set(message_id, True)
+        return False
+    return True
+
+def confirm_message(message_id):
+    """Make the claim of a message permanent once it is stored."""
+    get_table('ProcessedWebhookMessages').update_item(
+        Key={'message_id': message_id},
+        UpdateExpression='SET claim_state = :stored REMOVE lease_until',
+        ExpressionAttributeValues={':stored': 'stored'},
+    )
+    _seen_messages.set(message_id, True)
+
+def release_message(message_id):
+    """Forget a claimed id whose ingestion failed, so a redelivery is processed."""
+    _seen_messages.delete(message_id)
+    get_table('ProcessedWebhookMessages').delete_item(Key={'message_id': message_id})
@@ -0,0 +1,365 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from app.helpers.bulk_updates import get_bulk_executor
+from app.helpers.conversation import get_conversation_routes, resolve_conversations
+from app.helpers.inbox import chat_group, routed_events
+from app.helpers.message_writer import get_message_writer
+from app.helpers.metrics import register_metrics
+from app.helpers.recent_messages import recent_messages
+from app.helpers.webhook_dedupe import claim_message, confirm_message, is_known_duplicate, release_message
+from app.models.webhook_event import WebhookEvent
+
+def validate_payload(data):
+    """Reject payloads that are not WhatsApp webhook notifications."""
+    if not isinstance(data, dict) or not isinstance(data.get('entry'), list):
+        raise ValueError('Payload must be an object with an entry list')
+
+def message_body(message):
+    """Text of an inbound WhatsApp message (None for media without a caption)."""
+    if message.get('type') == 'text':
+        return message.get('text', {}).get('body')
+    return message.get(message.get('type'), {}).get('caption')
+
+def extract_changes(data):
+    """Collect every message and status from every entry and change of a payload."""
+    messages = []
+    statuses = []
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+            contacts = value.get('contacts', [])
+            for message in value.get('messages', []):
+                # Older payload samples only carry the sender on contacts[0]
+                customer_id = message.get('from') or (contacts[0].get('wa_id') if contacts else None)
+                if customer_id:
+                    messages.append((customer_id, message))
+            statuses.extend(status for status in value.get('statuses', []) if status.get('recipient_id'))
+    return messages, statuses
+
+def release_claims(messages):
+    """Release the claimed ids of messages that were not ingested after all."""
+    for _, message in messages:
+        if not message.get('id'):
+            continue
+        try:
+            release_message(message['id'])
+        except Exception as e:
+            logging.error(f"Could not release webhook message {message['id']}: {e}")
+
+def confirm_claims(messages):
+    """Make the claims of stored messages permanent (see webhook_dedupe.claim_message)."""
+    for _, message in messages:
+        if not message.get('id'):
+            continue
+        try:
+            confirm_message(message['id'])
+        except Exception as e:
+            # The lease expires and a redelivery would store the message again
+            logging.error(f"Could not confirm webhook message {message['id']}: {e}")
+
+def claim_new_messages(messages):
+    """Drop messages that were already ingested (Meta redelivers slow webhooks).
+
+    Each id is claimed with a conditional put, concurrently on the bulk
+    executor. Messages without an id are always kept. If any claim fails, the
+    ones that succeeded are released before the error is raised, so the
+    redelivery still ingests them.
+    """
+    def claim(message):
+        try:
+            return (not message.get('id') or claim_message(message['id'])), None
+        except Exception as e:
+            return False, e
+
+    outcomes = list(get_bulk_executor().map(claim, [message for _, message in messages]))
+    errors = [error for _, error in outcomes if error is not None]
+    if errors:
+        release_claims([entry for entry, (is_new, _) in zip(messages, outcomes) if is_new])
+        raise errors[0]
+    return [entry for entry, (is_new, _) in zip(messages, outcomes) if is_new]
+
+def ingest_payload(data):
+    """Resolve conversations and store every new message of a payload.
+
+    Redelivered messages are dropped first (see claim_new_messages), so a
+    retry costs only the claims. Conversations for the remaining senders are
+    resolved in one batched lookup and the messages are queued together so
+    they share BatchWriteItem calls; this waits until the message writer has
+    stored them and raises if it could not, so the payload is retried. Returns the
+    (group, event) pairs to fan out over the channel layer: one event per
+    customer, carrying all of that customer's messages, for the customer's
+    chat group and the inbox groups of the conversation's vendor, team and
+    users.
+    """
+    messages, statuses = extract_changes(data)
+    # Ids this process already ingested are dropped before any DynamoDB call
+    messages = [(customer_id, message) for customer_id, message in messages
+                if not message.get('id') or not is_known_duplicate(message['id'])]
+    messages = claim_new_messages(messages)
+    try:
+        conversations = resolve_conversations([customer_id for customer_id, _ in messages], get_bulk_executor())
+        for customer_id, _ in messages:
+            if conversations.get(customer_id) is None:
+                raise RuntimeError('Failed to access Conversations table')
+        routes = get_conversation_routes([conversations[customer_id] for customer_id, _ in messages])
+    except Exception:
+        # Nothing was queued; let the retry of this payload ingest them
+        release_claims(messages)
+        raise
+
+    received_at = datetime.now()
+    items = []
+    by_customer = {}
+    for index, (customer_id, message) in enumerate(messages):
+        conversation_id = conversations[customer_id]
+        # Offset by the position so messages of one delivery get distinct sort keys
+        timestamp = (received_at + timedelta(microseconds=index)).isoformat()
+        body = message_body(message)
+        items.append({
+            'customer_id': customer_id,
+            'conversation_id': conversation_id,
+            'message': body,
+            'timestamp': timestamp,
+            'sender_id': customer_id,
+            'whatsapp_message_id': message.get('id'),
+        })
+        by_customer.setdefault(customer_id, []).append({
+            'message': body,
+            'sender_id': customer_id,
+            'timestamp': timestamp,
+        })
+    # Queue the messages for the DynamoDB Messages table (written in batches)
+    writer = get_message_writer()
+    futures = []
+    for index, item in enumerate(items):
+        try:
+            futures.append(writer.submit(item))
+        except Exception:
+            # Let the retry of this payload pick up the messages that were not queued
+            release_claims(messages[index:])
+            raise
+    stored, failed, error = [], [], None
+    for entry, future in zip(messages, futures):
+        try:
+            future.result(timeout=settings.WEBHOOK_WRITE_TIMEOUT)
+            stored.append(entry)
+        except Exception as e:
+            failed.append(entry)
+            error = error or e
+    confirm_claims(stored)
+    if error:
+        # The retry of this payload stores the rest; the stored ones are now duplicates
+        release_claims(failed)
+        raise error
+    for customer_id, customer_messages in by_customer.items():
+        recent_messages.add(customer_id, customer_messages)
+
+    events = []
+    for customer_id, customer_messages in by_customer.items():
+        conversation_id = conversations[customer_id]
+        events.extend(routed_events(
+            {'type': 'chat_message_batch', 'messages': customer_messages},
+            customer_id, conversation_id, routes.get(conversation_id)
+        ))
+    for status in statuses:
+        # Delivery/read receipts for messages we sent to the customer
+        events.append((chat_group(status['recipient_id']), {
+            'type': 'message_status',
+            'customer_id': status['recipient_id'],
+            'message_id': status.get('id'),
+            'status': status.get('status'),
+            'timestamp': status.get('timestamp'),
+        }))
+    return events
+
+async def fan_out(events):
+    channel_layer = get_channel_layer()
+    for group, event in events:
+        await channel_layer.group_send(group, event)
+
+def process_payload(data):
+    """Handle one webhook payload end to end: conversation, persistence, fan-out."""
+    events = ingest_payload(data)
+    if events:
+        async_to_sync(fan_out)(events)
+
+class WebhookWorkerPool:
+    """Threads that drain the WebhookEvent table.
+
+    Events are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several pools
+    (web processes and `manage.py process_webhooks`) can share the queue.
+    Failed events are retried up to max_attempts; events claimed by a worker
+    that died are picked up again after claim_timeout seconds.
+    """
+
+    def __init__(self, workers=4, batch_size=10, poll_interval=1.0, max_attempts=5,
+                 claim_timeout=300, retention=86400):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        self.retention = retention
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stopping = False
+        self._last_cleanup = 0
+        self._latencies = deque(maxlen=1000)
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(target=self._run, name=f'webhook-worker-{index}', daemon=True)
+                    for index in range(self.workers)
+                ]
+                for thread in self._threads:
+                    thread.start()
+
+    def stop(self, timeout=30):
+        self._stopping = True
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(pct):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * pct / 100))] * 1000, 1) if latencies else None
+
+        try:
+            pending = WebhookEvent.objects.filter(status=WebhookEvent.PENDING).count()
+        except DatabaseError:
+            pending = None
+        return {
+            'workers': len(self._threads),
+            'pending': pending,
+            'processed': self.processed,
+            'failed': self.failed,
+            'latency_ms_p50': percentile(50),
+            'latency_ms_p95': percentile(95),
+            'latency_ms_p99': percentile(99),
+        }
+
+    def claim_events(self):
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.claim_timeout)
+        with transaction.atomic():
+            events = list(
+                WebhookEvent.objects.select_for_update(skip_locked=True)
+                .filter(Q(status=WebhookEvent.PENDING) | Q(status=WebhookEvent.PROCESSING, claimed_at__lt=stale))
+                .order_by('received_at')[:self.batch_size]
+            )
+            WebhookEvent.objects.filter(id__in=[event.id for event in events]).update(
+                status=WebhookEvent.PROCESSING, claimed_at=now, attempts=F('attempts') + 1
+            )
+        return events
+
+    def _run(self):
+        while not self._stopping:
+            close_old_connections()
+            try:
+                self._cleanup()
+                events = self.claim_events()
+            except DatabaseError as e:
+                logging.error(f"Error claiming webhook events: {e}")
+                time.sleep(self.poll_interval)
+                continue
+            if not events:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            for event in events:
+                try:
+                    self._process(event)
+                except DatabaseError as e:
+                    # Left in processing; reclaimed after claim_timeout
+                    logging.error(f"Error updating webhook event {event.id}: {e}")
+
+    def _process(self, event):
+        try:
+            process_payload(event.payload)
+        except Exception as e:
+            attempts = event.attempts + 1
+            status = WebhookEvent.FAILED if attempts >= self.max_attempts else WebhookEvent.PENDING
+            logging.error(f"Error processing webhook event {event.id} (attempt {attempts}): {e}")
+            WebhookEvent.objects.filter(id=event.id).update(status=status, last_error=str(e))
+            if status == WebhookEvent.FAILED:
+                self.failed += 1
+            return
+        processed_at = timezone.now()
+        WebhookEvent.objects.filter(id=event.id).update(
+            status=WebhookEvent.DONE, processed_at=processed_at, last_error=None
+        )
+        self.processed += 1
+        # End-to-end latency: received by the webhook -> persisted and fanned out
+        self._latencies.append((processed_at - event.received_at).total_seconds())
+
+    def _cleanup(self):
+        """Delete processed events older than the retention period, every ten minutes."""
+        if time.monotonic() - self._last_cleanup < 600:
+            return
+        self._last_cleanup = time.monotonic()
+        WebhookEvent.objects.filter(
+            status=WebhookEvent.DONE,
+            processed_at__lt=timezone.now() - timedelta(seconds=self.retention)
+        ).delete()
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+def get_webhook_worker_pool(workers=None):
+    global _worker_pool
+    if _worker_pool is None:
+        with _worker_pool_lock:
+            if _worker_pool is None:
+                _worker_pool = WebhookWorkerPool(
+                    workers=settings.WEBHOOK_INGEST_WORKERS if workers is None else workers,
+                    max_attempts=settings.WEBHOOK_MAX_ATTEMPTS,
+                )
+                register_metrics('webhook_pipeline', _worker_pool.stats)
+    return _worker_pool
+
+def start_webhook_workers():
+    """Start this process's webhook workers (called when the server starts).
+
+    Their first pass claims any events left pending by a previous run, so
+    nothing waits for the next webhook to arrive.
+    """
+    pool = get_webhook_worker_pool()
+    if settings.WEBHOOK_INGEST_MODE == 'queued' and pool.workers:
+        pool.start()
+
+def enqueue_webhook(data):
+    """Store a validated payload for background processing and wake the local workers."""
+    WebhookEvent.objects.create(payload=data)
+    pool = get_webhook_worker_pool()
+    if pool.workers:
+        pool.start()
+        pool.notify()
+
+async def aenqueue_webhook(data):
+    """enqueue_webhook for async views."""
+    await WebhookEvent.objects.acreate(payload=data)
+    pool = get_webhook_worker_pool()
+    if pool.workers:
+        pool.start()
+        pool.notify()
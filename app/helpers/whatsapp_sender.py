@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from app.helpers.conversation import WA_ACCESS_TOKEN, SPOUT_PHONE_NUMBER_ID
+from app.helpers.metrics import register_metrics
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Async token bucket allowing `rate` acquisitions per second (bursts up to `rate`)."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(1, rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class WhatsAppSender:
+    """Outbound delivery queue for the WhatsApp Graph API.
+
+    Each recipient has its own queue, so messages to the same recipient are
+    sent strictly in order while `workers` tasks send to different
+    recipients in parallel. A message that gets a 429/5xx response (or a
+    connection error) is retried with jittered backoff without holding a
+    worker: its recipient is parked until the retry is due and the workers
+    carry on with everyone else. Requests go through one keep-alive
+    requests.Session (run on a small thread pool) and are rate limited per
+    phone number id. At most queue_size * workers messages wait in total;
+    send() blocks beyond that.
+    """
+
+    def __init__(self, phone_number_id, access_token, base_url, workers=4, queue_size=1000,
+                 rate_per_second=20, max_retries=5, timeout=10, retry_base_delay=0.5):
+        self.phone_number_id = phone_number_id
+        self.access_token = access_token
+        self.url = f"{base_url.rstrip('/')}/{phone_number_id}/messages"
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rate_per_second = rate_per_second
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.retry_base_delay = retry_base_delay
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='whatsapp-sender')
+        self._loop = None
+        self._pending = {}  # recipient -> deque of [message, attempts]; present while queued, in flight or parked
+        self._ready = None  # Recipients whose next message can be sent now
+        self._capacity = None
+        self._tasks = []
+        self._rate_limiter = None
+        self.in_flight = 0
+        self.parked = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # Queues and the rate limiter belong to the event loop that uses them
+        self._loop = loop
+        self._pending = {}
+        self._ready = asyncio.Queue()
+        self._capacity = asyncio.Semaphore(self.queue_size * self.workers)
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._rate_limiter = TokenBucket(self.rate_per_second)
+
+    async def send(self, to_phone_id, message):
+        """Queue a text message; waits only when the total queue is full."""
+        if not self.access_token or not self.phone_number_id:
+            logging.error("Access token or phone number ID is not defined.")
+            return
+        self._ensure_started()
+        await self._capacity.acquire()
+        messages = self._pending.get(to_phone_id)
+        if messages is None:
+            self._pending[to_phone_id] = deque([[message, 0]])
+            self._ready.put_nowait(to_phone_id)
+        else:
+            # The recipient is already queued, in flight or parked; keep the order
+            messages.append([message, 0])
+
+    def stats(self):
+        depths = [len(messages) for messages in self._pending.values()]
+        return {
+            'queue_depth': sum(depths),
+            'max_recipient_queue_depth': max(depths, default=0),
+            'queue_capacity': self.queue_size * self.workers,
+            'recipients': len(depths),
+            'in_flight': self.in_flight,
+            'parked': self.parked,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+    async def _worker(self):
+        while True:
+            to_phone_id = await self._ready.get()
+            messages = self._pending[to_phone_id]
+            entry = messages[0]
+            self.in_flight += 1
+            try:
+                retry_delay = await self._deliver(to_phone_id, entry[0], entry[1])
+            except Exception as e:
+                logging.error(f"Error sending WhatsApp message to {to_phone_id}: {e}")
+                retry_delay = None
+                self.failed += 1
+            finally:
+                self.in_flight -= 1
+            if retry_delay is not None:
+                entry[1] += 1
+                self.retried += 1
+                self.parked += 1
+                self._loop.call_later(retry_delay, self._unpark, to_phone_id)
+                continue
+            messages.popleft()
+            self._capacity.release()
+            if messages:
+                self._ready.put_nowait(to_phone_id)
+            else:
+                del self._pending[to_phone_id]
+
+    def _unpark(self, to_phone_id):
+        self.parked -= 1
+        self._ready.put_nowait(to_phone_id)
+
+    async def _deliver(self, to_phone_id, message, attempt):
+        """Send one attempt; returns the delay before a retry, or None when done (sent or given up)."""
+        loop = asyncio.get_running_loop()
+        await self._rate_limiter.acquire()
+        retry_after = None
+        try:
+            response = await loop.run_in_executor(self._executor, self._post, to_phone_id, message)
+            if response.status_code < 400:
+                self.sent += 1
+                return None
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                self.failed += 1
+                logging.error(f"WhatsApp API rejected message to {to_phone_id}: {response.status_code} {response.text}")
+                return None
+            retry_after = response.headers.get('Retry-After')
+            logging.warning(f"WhatsApp API returned {response.status_code} for {to_phone_id}")
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Error sending WhatsApp message to {to_phone_id}: {e}")
+        if attempt >= self.max_retries:
+            self.failed += 1
+            logging.error(f"Giving up on WhatsApp message to {to_phone_id} after {self.max_retries} retries")
+            return None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(30, self.retry_base_delay * 2 ** attempt))
+
+    def _post(self, to_phone_id, message):
+        return self.session.post(
+            self.url,
+            headers={
+                "Authorization": f"Bearer {self.access_token}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "messaging_product": "whatsapp",
+                "recipient_type": "individual",
+                "to": to_phone_id,
+                "type": "text",
+                "text": {"body": message}
+            },
+            timeout=self.timeout
+        )
+
+_whatsapp_sender = None
+_whatsapp_sender_lock = threading.Lock()
+
+def get_whatsapp_sender():
+    global _whatsapp_sender
+    if _whatsapp_sender is None:
+        with _whatsapp_sender_lock:
+            if _whatsapp_sender is None:
+                _whatsapp_sender = WhatsAppSender(
+                    phone_number_id=SPOUT_PHONE_NUMBER_ID,
+                    access_token=WA_ACCESS_TOKEN,
+                    base_url=settings.WA_GRAPH_API_URL,
+                    workers=settings.WHATSAPP_SENDER_WORKERS,
+                    queue_size=settings.WHATSAPP_SENDER_QUEUE_SIZE,
+                    rate_per_second=settings.WHATSAPP_SEND_RATE,
+                    max_retries=settings.WHATSAPP_SEND_MAX_RETRIES,
+                )
+                register_metrics('whatsapp_sender', _whatsapp_sender.stats)
+    return _whatsapp_sender
@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from django.core.management.base import BaseCommand
+from app.management.commands.bench_channel_layer import percentile
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test an HTTP endpoint of a running server with many concurrent clients. '
+        'Run it once against a server started with ASYNC_API_VIEWS=False and once with '
+        'ASYNC_API_VIEWS=True to compare the sync and async views.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='e.g. http://localhost:8000/conversations/by-vendor?vendor_id=your_vendor_id')
+        parser.add_argument('--method', default='GET')
+        parser.add_argument('--body-file', help='JSON file sent as the request body, e.g. app/views/sample_received_text_whatsapp.json')
+        parser.add_argument('--requests', type=int, default=2000, help='Total number of requests')
+        parser.add_argument('--concurrency', type=int, default=200, help='Number of concurrent clients')
+        parser.add_argument('--timeout', type=float, default=30)
+
+    def handle(self, *args, **options):
+        body = None
+        if options['body_file']:
+            with open(options['body_file']) as f:
+                body = json.load(f)
+
+        local = threading.local()
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+
+        def call(_):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            started = time.perf_counter()
+            try:
+                response = session.request(options['method'], options['url'], json=body, timeout=options['timeout'])
+                outcome = response.status_code
+            except requests.exceptions.RequestException as e:
+                outcome = type(e).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+                statuses[outcome] = statuses.get(outcome, 0) + 1
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            list(executor.map(call, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{len(latencies)} requests, concurrency {options['concurrency']}: "
+            f"{len(latencies) / elapsed:.0f} req/s, latency p50={percentile(latencies, 50):.1f}ms "
+            f"p95={percentile(latencies, 95):.1f}ms p99={percentile(latencies, 99):.1f}ms"
+        )
+        self.stdout.write(f"responses: {', '.join(f'{key}={value}' for key, value in sorted(statuses.items(), key=str))}")
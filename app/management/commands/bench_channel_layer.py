@@ -0,0 +1,83 @@
+import asyncio
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from channels.layers import InMemoryChannelLayer
+from app.helpers.pg_channel_layer import PostgresChannelLayer
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Command(BaseCommand):
+    help = 'Measure group_send throughput and delivery latency of the in-memory and Postgres channel layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=['memory', 'postgres', 'both'], default='both')
+        parser.add_argument('--messages', type=int, default=1000, help='Number of group_send calls')
+        parser.add_argument('--channels', type=int, default=10, help='Number of channels in the group')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for delivery')
+
+    def handle(self, *args, **options):
+        backends = ['memory', 'postgres'] if options['backend'] == 'both' else [options['backend']]
+        for backend in backends:
+            result = asyncio.run(self.run_benchmark(backend, options['messages'], options['channels'], options['timeout']))
+            self.stdout.write(
+                f"{backend:>8}: {result['delivered']}/{result['expected']} delivered, "
+                f"{result['throughput']:.0f} msg/s, latency p50={result['p50']:.2f}ms "
+                f"p95={result['p95']:.2f}ms p99={result['p99']:.2f}ms"
+            )
+
+    async def run_benchmark(self, backend, message_count, channel_count, timeout):
+        capacity = message_count + 1
+        if backend == 'memory':
+            sender = receiver = InMemoryChannelLayer(capacity=capacity)
+        else:
+            # Two layer instances have different process ids, so every message
+            # takes the same NOTIFY round trip it would between two workers.
+            sender = PostgresChannelLayer(capacity=capacity)
+            receiver = PostgresChannelLayer(capacity=capacity)
+
+        group = f'bench_{uuid.uuid4().hex[:12]}'
+        channels = [await receiver.new_channel() for _ in range(channel_count)]
+        for channel in channels:
+            await sender.group_add(group, channel)
+
+        latencies = []
+
+        async def consume(channel):
+            for _ in range(message_count):
+                message = await receiver.receive(channel)
+                latencies.append((time.perf_counter() - message['sent_at']) * 1000)
+
+        consumers = [asyncio.ensure_future(consume(channel)) for channel in channels]
+        await asyncio.sleep(0.1)  # Let the receivers start listening
+
+        started = time.perf_counter()
+        for index in range(message_count):
+            await sender.group_send(group, {'type': 'bench.message', 'index': index, 'sent_at': time.perf_counter()})
+        try:
+            await asyncio.wait_for(asyncio.gather(*consumers), timeout)
+        except asyncio.TimeoutError:
+            for task in consumers:
+                task.cancel()
+        elapsed = time.perf_counter() - started
+
+        for channel in channels:
+            await sender.group_discard(group, channel)
+        await sender.close()
+        if receiver is not sender:
+            await receiver.close()
+
+        return {
+            'expected': message_count * channel_count,
+            'delivered': len(latencies),
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
@@ -0,0 +1,79 @@
+import os
+import threading
+from django.core.management.base import BaseCommand, CommandError
+from app.helpers.backfill import TRANSFORMS, Backfill
+
+
+class Command(BaseCommand):
+    help = (
+        'Scan a DynamoDB table with parallel segments, transform each item and write the '
+        'result with BatchWriteItem (in-place transforms update only the migrated attribute). Progress is checkpointed; re-running with the same '
+        'checkpoint file resumes an interrupted run. Point DYNAMODB_ENDPOINT_URL at DynamoDB '
+        'Local to try it out.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('transform', choices=sorted(TRANSFORMS))
+        parser.add_argument('--segments', type=int, default=8, help='Parallel Scan segments (one thread each)')
+        parser.add_argument('--page-size', type=int, default=500, help='Items read per Scan call')
+        parser.add_argument('--checkpoint', help='Checkpoint file (default: .backfill-<transform>.json)')
+        parser.add_argument('--reset', action='store_true', help='Ignore an existing checkpoint and start over')
+        parser.add_argument('--max-read-units', type=float, help='Read capacity units per second to stay under')
+        parser.add_argument('--max-write-units', type=float, help='Write capacity units per second to stay under')
+        parser.add_argument('--dry-run', action='store_true', help='Scan and transform without writing')
+        parser.add_argument('--progress-interval', type=float, default=10, help='Seconds between progress lines')
+
+    def handle(self, *args, **options):
+        definition = TRANSFORMS[options['transform']]
+        checkpoint = options['checkpoint'] or f".backfill-{options['transform']}.json"
+        if options['dry_run'] and not options['checkpoint']:
+            checkpoint = None
+        if options['reset'] and checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        try:
+            backfill = Backfill(
+                definition['source'],
+                definition['target'],
+                definition.get('transform'),
+                update=definition.get('update'),
+                before_write=definition.get('before_write'),
+                segments=options['segments'],
+                page_size=options['page_size'],
+                checkpoint_path=checkpoint,
+                max_read_units=options['max_read_units'],
+                max_write_units=options['max_write_units'],
+                dry_run=options['dry_run'],
+            )
+        except ValueError as e:
+            raise CommandError(f"{e}; use --reset or the original --segments")
+
+        self.stdout.write(f"Backfilling {definition['source']} -> {definition['target']} with {options['segments']} segments")
+        errors = []
+
+        def run():
+            try:
+                backfill.run()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            while thread.is_alive():
+                thread.join(options['progress_interval'])
+                self.stdout.write(self.format_progress(backfill.progress()))
+        except KeyboardInterrupt:
+            backfill.stop()
+            thread.join()
+            self.stdout.write(self.style.WARNING(f"Stopped; run the command again to resume from {checkpoint}"))
+            return
+        if errors:
+            raise CommandError(f"Backfill failed: {errors[0]}; run the command again to resume from {checkpoint}")
+        self.stdout.write(self.style.SUCCESS(f"Done: {self.format_progress(backfill.progress())}"))
+
+    def format_progress(self, progress):
+        return (
+            f"scanned={progress['scanned']} written={progress['written']} skipped={progress['skipped']} "
+            f"segments={progress['segments_done']}/{progress['segments']} "
+            f"{progress['items_per_second']} items/s rcu={progress['read_units']} wcu={progress['write_units']}"
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from app.helpers.dynamodb_helpers import ensure_tables
+
+
+class Command(BaseCommand):
+    help = 'Check that every DynamoDB table used by the app exists, creating missing ones'
+
+    def handle(self, *args, **options):
+        tables = ensure_tables(force=True)
+        for name in tables:
+            self.stdout.write(self.style.SUCCESS(f"Table '{name}' is ready"))
@@ -0,0 +1,78 @@
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+
+
+def build_fake_graph_server(host='127.0.0.1', port=8089, latency=0.05, error_rate=0.0,
+                            failing_recipients=(), log=None):
+    """HTTP server answering like the Graph API messages endpoint.
+
+    Requests are answered with 429 at `error_rate` and with 503 for every
+    recipient in `failing_recipients`. Each request body received is appended
+    to server.received. Pass port=0 to pick a free port (server.server_port).
+    """
+    failing_recipients = set(failing_recipients)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, like the real API
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self.server.received.append(body)
+            time.sleep(latency)
+            if body.get('to') in failing_recipients:
+                self._reply(503, {'error': {'message': 'Service temporarily unavailable', 'code': 2}})
+                return
+            if random.random() < error_rate:
+                self._reply(429, {'error': {'message': 'Rate limit hit', 'code': 130429}})
+                return
+            self._reply(200, {
+                'messaging_product': 'whatsapp',
+                'contacts': [{'input': body.get('to'), 'wa_id': body.get('to')}],
+                'messages': [{'id': f'wamid.{uuid.uuid4().hex}'}],
+            })
+
+        def _reply(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            if log:
+                log(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.received = []
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Serve a local stand-in for the WhatsApp Graph API messages endpoint (set WA_GRAPH_API_URL to it)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds to wait before answering')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 429')
+        parser.add_argument('--fail-recipient', action='append', default=[],
+                            help='Recipient whose messages are always answered with 503 (repeatable)')
+
+    def handle(self, *args, **options):
+        server = build_fake_graph_server(
+            port=options['port'],
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            failing_recipients=options['fail_recipient'],
+            log=self.stdout.write,
+        )
+        self.stdout.write(f"Fake Graph API listening on http://127.0.0.1:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from app.helpers.backfill import TRANSFORMS, Backfill
+
+
+class Command(BaseCommand):
+    help = (
+        'Copy the Messages table into MessagesByMonth (customer_id#YYYYMM partition keys). '
+        'Safe to re-run: items are overwritten with the same key. Run it once before setting '
+        'MESSAGE_KEY_SCHEME=monthly and once more after, to pick up messages written in between. '
+        'Same as `dynamodb_backfill message-buckets` without a checkpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--segments', type=int, default=8, help='Parallel Scan segments')
+        parser.add_argument('--page-size', type=int, default=500, help='Items read per Scan call')
+
+    def handle(self, *args, **options):
+        definition = TRANSFORMS['message-buckets']
+        backfill = Backfill(
+            definition['source'],
+            definition['target'],
+            definition['transform'],
+            before_write=definition['before_write'],
+            segments=options['segments'],
+            page_size=options['page_size'],
+        )
+        progress = backfill.run()
+        self.stdout.write(self.style.SUCCESS(f"Copied {progress['written']} messages to {definition['target']}"))
@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from app.helpers.webhook_pipeline import get_webhook_worker_pool
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of workers that process queued WhatsApp webhook events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+
+    def handle(self, *args, **options):
+        pool = get_webhook_worker_pool(workers=options['workers'])
+        pool.start()
+        self.stdout.write(self.style.SUCCESS(f"Processing webhook events with {options['workers']} workers"))
+        try:
+            while True:
+                time.sleep(60)
+                self.stdout.write(str(pool.stats()))
+        except KeyboardInterrupt:
+            pool.stop()
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.1 on 2026-10-17 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0019_booking_vendor_alter_booking_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelLayerMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField()),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'db_table': 'ChannelLayerMessage',
+            },
+        ),
+        migrations.CreateModel(
+            name='ChannelLayerGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group_name', models.CharField(max_length=100)),
+                ('channel_name', models.CharField(max_length=100)),
+                ('expires_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'ChannelLayerGroup',
+                'indexes': [models.Index(fields=['group_name', 'expires_at'], name='ChannelLaye_group_n_e96c18_idx')],
+                'unique_together': {('group_name', 'channel_name')},
+            },
+        ),
+    ]
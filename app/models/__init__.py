@@ -1,4 +1,6 @@
 from .user import User
 from .role import Role
 from .team import Team
-from .vendor import Vendor
\ No newline at end of file
+from .vendor import Vendor
+from .channel_layer import ChannelLayerGroup, ChannelLayerMessage
+from .webhook_event import WebhookEvent
\ No newline at end of file
@@ -0,0 +1,22 @@
+from django.db import models
+
+class ChannelLayerGroup(models.Model):
+    """Group membership for the Postgres channel layer (app.helpers.pg_channel_layer)."""
+    group_name = models.CharField(max_length=100)
+    channel_name = models.CharField(max_length=100)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'ChannelLayerGroup'
+        unique_together = ('group_name', 'channel_name')
+        indexes = [
+            models.Index(fields=['group_name', 'expires_at']),
+        ]
+
+class ChannelLayerMessage(models.Model):
+    """Payloads too large for a NOTIFY, picked up by the receiving process."""
+    payload = models.TextField()
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'ChannelLayerMessage'
@@ -1,3 +1,1073 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Future
+from decimal import Decimal
+from unittest import mock
+import psycopg2
+from botocore.exceptions import ClientError
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import AsyncRequestFactory, SimpleTestCase, override_settings
+from django.urls import re_path
+from django.utils import timezone
+from app.consumers import ChatConsumer, InboxConsumer
+from app.helpers.backfill import Backfill, colab_users_set
+from app.helpers.bulk_updates import BulkJobs, apply_collaborator_changes
+from app.helpers.conversation import ROUTE_MAX_RETRIES, create_conversation, get_conversation_routes, list_conversations_by_vendor, update_collaborators, update_conversation_summaries
+from app.helpers.dynamodb_helpers import TABLE_DEFINITIONS, _ensure_table, decode_cursor, encode_cursor, ensure_tables, get_table, projection_kwargs
+from app.helpers.frame_codec import FrameProtocolMixin, decode_frame, encode_frame, packb
+from app.helpers.inbox import routed_events
+from app.helpers.io_executor import IOExecutor, run_io
+from app.helpers.message_writer import MessageWriter
+from app.helpers.messages import add_message_key, clamp_history_limit, fetch_message_history, fetch_messages_since, fetch_recent_since, list_conversation_messages, record_message_buckets
+from app.helpers.pg_channel_layer import PostgresChannelLayer
+from app.helpers.presence import EventThrottle, PresenceRegistry
+from app.helpers.read_receipts import ReadMarkWriter, add_user_unread_counts, check_read_timestamp, parse_read_timestamp
+from app.helpers.recent_messages import RecentMessageCache
+from app.helpers.send_buffer import BufferedSendMixin
+from app.helpers.webhook_pipeline import WebhookWorkerPool, claim_new_messages, extract_changes, ingest_payload
+from app.helpers.whatsapp_sender import WhatsAppSender
+from app.management.commands.fake_graph_api import build_fake_graph_server
+from app.models.webhook_event import WebhookEvent
+from app.views import async_api
+from app.views.conversation import parse_flag, parse_page_size
 
-# Create your tests here.
+MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class TableRegistryTests(SimpleTestCase):
+    def test_tables_are_checked_once_per_process(self):
+        with mock.patch.dict('app.helpers.dynamodb_helpers._tables', clear=True), \
+                mock.patch('app.helpers.dynamodb_helpers._ensure_table', side_effect=lambda name, _: name) as ensure:
+            self.assertEqual(get_table('Conversations'), 'Conversations')
+            get_table('Messages')
+            self.assertEqual(ensure.call_count, len(TABLE_DEFINITIONS))
+            ensure_tables(force=True)
+            self.assertEqual(ensure.call_count, 2 * len(TABLE_DEFINITIONS))
+
+    def test_missing_table_is_created_with_its_time_to_live(self):
+        resource = mock.Mock()
+        resource.Table.return_value.load.side_effect = ClientError({'Error': {'Code': 'ResourceNotFoundException'}}, 'DescribeTable')
+        with mock.patch('app.helpers.dynamodb_helpers.dynamodb', resource):
+            table = _ensure_table('BulkJobs', TABLE_DEFINITIONS['BulkJobs'])
+        resource.create_table.assert_called_once_with(TableName='BulkJobs', **TABLE_DEFINITIONS['BulkJobs'])
+        table.meta.client.update_time_to_live.assert_called_once_with(
+            TableName='BulkJobs', TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires_at'}
+        )
+
+
+class PostgresChannelLayerTests(SimpleTestCase):
+    def test_receive_after_expired_message(self):
+        async def scenario():
+            layer = PostgresChannelLayer()
+            with mock.patch.object(layer, '_ensure_listener'):
+                layer._put('test.channel', {'type': 'stale'}, time.time() - 1)
+                receive = asyncio.ensure_future(layer.receive('test.channel'))
+                await asyncio.sleep(0.05)
+                await layer.send('test.channel', {'type': 'live'})
+                return await asyncio.wait_for(receive, timeout=1)
+
+        self.assertEqual(asyncio.run(scenario()), {'type': 'live'})
+
+    def test_statements_run_on_pooled_connections(self):
+        layer = PostgresChannelLayer(pool_size=2)
+        in_use = []
+        peak = []
+
+        def execute(sql, params):
+            in_use.append(sql)
+            peak.append(len(in_use))
+            time.sleep(0.05)
+            in_use.remove(sql)
+
+        def connect():
+            connection = mock.MagicMock(closed=False)
+            connection.cursor.return_value.__enter__.return_value.execute.side_effect = execute
+            return connection
+
+        with mock.patch.object(layer, '_connect', side_effect=connect) as connect_mock:
+            threads = [threading.Thread(target=layer._execute, args=('SELECT 1',)) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(connect_mock.call_count, 2)
+
+    def test_broken_connection_is_replaced(self):
+        layer = PostgresChannelLayer(pool_size=1)
+        broken = mock.MagicMock(closed=False)
+        broken.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError('gone')
+        broken.close.side_effect = lambda: setattr(broken, 'closed', True)
+        healthy = mock.MagicMock(closed=False)
+        with mock.patch.object(layer, '_connect', side_effect=[broken, healthy]):
+            with self.assertRaises(psycopg2.OperationalError):
+                layer._execute('SELECT 1')
+            layer._execute('SELECT 1')
+        healthy.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('SELECT 1', None)
+
+    def test_refresh_covers_memberships_not_discarded(self):
+        async def scenario():
+            layer = PostgresChannelLayer(group_expiry=90)
+            with mock.patch.object(layer, '_run', new=mock.AsyncMock()) as run:
+                await layer.group_add('inbox_v1', 'specific.a!x')
+                await layer.group_add('inbox_v1', 'specific.a!y')
+                await layer.group_add('chat_c1', 'specific.a!x')
+                await layer.group_discard('inbox_v1', 'specific.a!y')
+                run.reset_mock()
+                await layer.refresh_memberships()
+                return layer.group_refresh, run.call_args.args[1]
+
+        group_refresh, params = asyncio.run(scenario())
+        self.assertEqual(group_refresh, 30)
+        self.assertEqual(params[0], 90)
+        self.assertEqual(sorted(zip(params[1], params[2])), [('chat_c1', 'specific.a!x'), ('inbox_v1', 'specific.a!x')])
+
+
+class WhatsAppSenderTests(SimpleTestCase):
+    def setUp(self):
+        self.server = build_fake_graph_server(port=0, latency=0.01, failing_recipients={'failing'})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_failing_recipient_does_not_block_others(self):
+        sender = WhatsAppSender(
+            phone_number_id='1', access_token='token', base_url=f'http://127.0.0.1:{self.server.server_port}',
+            workers=1, rate_per_second=1000, max_retries=2, retry_base_delay=0.5
+        )
+
+        async def scenario():
+            await sender.send('failing', 'first')
+            for index in range(5):
+                await sender.send('ok', f'message {index}')
+            # Delivered while the failing recipient waits for its retries
+            while sender.sent < 5:
+                await asyncio.sleep(0.01)
+            self.assertEqual(sender.failed, 0)
+            while sender.failed < 1:
+                await asyncio.sleep(0.05)
+
+        # Full backoff (no jitter): retries after 0.5s and 1s
+        with mock.patch('app.helpers.whatsapp_sender.random.uniform', side_effect=lambda low, high: high):
+            asyncio.run(asyncio.wait_for(scenario(), timeout=10))
+        self.assertEqual(
+            [body['text']['body'] for body in self.server.received if body['to'] == 'ok'],
+            [f'message {index}' for index in range(5)]
+        )
+        self.assertEqual(sum(1 for body in self.server.received if body['to'] == 'failing'), 3)
+        self.assertEqual(sender.stats()['queue_depth'], 0)
+
+
+class ParseFlagTests(SimpleTestCase):
+    def test_accepted_values(self):
+        for value in (True, 'true', '1'):
+            self.assertIs(parse_flag(value, 'atomic'), True)
+        for value in (None, False, 'false', '0'):
+            self.assertIs(parse_flag(value, 'atomic'), False)
+
+    def test_rejects_other_values(self):
+        for value in ('False', 'yes', 2, [], {}):
+            with self.assertRaises(ValueError):
+                parse_flag(value, 'atomic')
+
+
+class ClaimNewMessagesTests(SimpleTestCase):
+    def test_releases_successful_claims_when_one_fails(self):
+        def claim(message_id):
+            if message_id == 'wamid.2':
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutItem')
+            return message_id != 'wamid.3'
+
+        messages = [('123', {'id': f'wamid.{index}'}) for index in range(4)]
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', side_effect=claim), \
+                mock.patch('app.helpers.webhook_pipeline.release_message') as release:
+            with self.assertRaises(ClientError):
+                claim_new_messages(messages)
+        self.assertEqual(sorted(call.args[0] for call in release.call_args_list), ['wamid.0', 'wamid.1'])
+
+
+class ExtractChangesTests(SimpleTestCase):
+    payload = {'entry': [
+        {'changes': [
+            {'value': {'messages': [
+                {'id': 'wamid.1', 'from': '111', 'type': 'text', 'text': {'body': 'one'}},
+                {'id': 'wamid.2', 'from': '222', 'type': 'text', 'text': {'body': 'two'}},
+            ]}},
+            {'value': {'statuses': [{'id': 'wamid.out', 'status': 'read', 'recipient_id': '111'}, {'id': 'wamid.bad'}]}},
+        ]},
+        {'changes': [
+            {'value': {
+                'contacts': [{'wa_id': '333'}],
+                'messages': [{'id': 'wamid.3', 'type': 'text', 'text': {'body': 'three'}}],
+            }},
+        ]},
+    ]}
+
+    def test_every_entry_and_change_is_collected(self):
+        messages, statuses = extract_changes(self.payload)
+        self.assertEqual([(customer_id, message['id']) for customer_id, message in messages],
+                         [('111', 'wamid.1'), ('222', 'wamid.2'), ('333', 'wamid.3')])
+        self.assertEqual([status['id'] for status in statuses], ['wamid.out'])
+
+    def test_payload_is_ingested_in_one_batch(self):
+        stored = Future()
+        stored.set_result(True)
+        writer = mock.Mock()
+        writer.submit.return_value = stored
+        conversations = {'111': 'conv-1', '222': 'conv-2', '333': 'conv-3'}
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', return_value=True), \
+                mock.patch('app.helpers.webhook_pipeline.is_known_duplicate', return_value=False), \
+                mock.patch('app.helpers.webhook_pipeline.resolve_conversations', return_value=conversations) as resolve, \
+                mock.patch('app.helpers.webhook_pipeline.get_conversation_routes', return_value={}) as routes, \
+                mock.patch('app.helpers.webhook_pipeline.get_message_writer', return_value=writer), \
+                mock.patch('app.helpers.webhook_pipeline.confirm_message'), \
+                mock.patch('app.helpers.webhook_pipeline.recent_messages'):
+            events = ingest_payload(self.payload)
+        resolve.assert_called_once()
+        self.assertEqual(resolve.call_args.args[0], ['111', '222', '333'])
+        routes.assert_called_once_with(['conv-1', 'conv-2', 'conv-3'])
+        self.assertEqual(writer.submit.call_count, 3)
+        types = [event['type'] for _, event in events]
+        self.assertEqual(types.count('chat_message_batch'), 3)
+        self.assertEqual(types.count('message_status'), 1)
+
+
+class IngestPayloadTests(SimpleTestCase):
+    payload = {'entry': [{'changes': [{'value': {'messages': [
+        {'id': 'wamid.redelivered', 'from': '123', 'type': 'text', 'text': {'body': 'Hello'}}
+    ]}}]}]}
+
+    def test_redelivery_skips_conversation_lookups(self):
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', return_value=False), \
+                mock.patch('app.helpers.webhook_pipeline.is_known_duplicate', return_value=False), \
+                mock.patch('app.helpers.conversation.create_conversation') as create, \
+                mock.patch('app.helpers.conversation.get_dynamodb_resource') as dynamodb:
+            self.assertEqual(ingest_payload(self.payload), [])
+        create.assert_not_called()
+        dynamodb.assert_not_called()
+
+    def test_claims_are_released_when_lookup_fails(self):
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', return_value=True), \
+                mock.patch('app.helpers.webhook_pipeline.is_known_duplicate', return_value=False), \
+                mock.patch('app.helpers.webhook_pipeline.resolve_conversations', return_value={'123': None}), \
+                mock.patch('app.helpers.webhook_pipeline.release_message') as release:
+            with self.assertRaises(RuntimeError):
+                ingest_payload(self.payload)
+        release.assert_called_once_with('wamid.redelivered')
+
+    def test_claims_of_dropped_messages_are_released(self):
+        payload = {'entry': [{'changes': [{'value': {'messages': [
+            {'id': 'wamid.stored', 'from': '123', 'type': 'text', 'text': {'body': 'Hello'}},
+            {'id': 'wamid.dropped', 'from': '123', 'type': 'text', 'text': {'body': 'Again'}},
+        ]}}]}]}
+        stored, dropped = Future(), Future()
+        stored.set_result(True)
+        dropped.set_exception(RuntimeError('Item for Messages dropped after 5 retries'))
+        writer = mock.Mock()
+        writer.submit.side_effect = [stored, dropped]
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', return_value=True), \
+                mock.patch('app.helpers.webhook_pipeline.is_known_duplicate', return_value=False), \
+                mock.patch('app.helpers.webhook_pipeline.resolve_conversations', return_value={'123': 'conv'}), \
+                mock.patch('app.helpers.webhook_pipeline.get_conversation_routes', return_value={}), \
+                mock.patch('app.helpers.webhook_pipeline.get_message_writer', return_value=writer), \
+                mock.patch('app.helpers.webhook_pipeline.confirm_message') as confirm, \
+                mock.patch('app.helpers.webhook_pipeline.release_message') as release:
+            with self.assertRaises(RuntimeError):
+                ingest_payload(payload)
+        confirm.assert_called_once_with('wamid.stored')
+        release.assert_called_once_with('wamid.dropped')
+
+
+class MessageWriterTests(SimpleTestCase):
+    def test_submit_fails_for_dropped_items(self):
+        writer = MessageWriter(table_name='Messages', flush_interval=0, max_retries=0)
+        dynamodb = mock.Mock()
+        dynamodb.batch_write_item.side_effect = lambda RequestItems: {'UnprocessedItems': RequestItems}
+        with mock.patch('app.helpers.message_writer.get_dynamodb_resource', return_value=dynamodb), \
+                self.assertLogs(level='ERROR'):
+            future = writer.submit({'customer_id': '123', 'timestamp': '2024-01-01T00:00:00'})
+            with self.assertRaises(RuntimeError):
+                future.result(timeout=5)
+
+    def test_submit_resolves_once_stored(self):
+        stored = []
+        writer = MessageWriter(table_name='Messages', flush_interval=0, after_write=stored.extend)
+        dynamodb = mock.Mock()
+        dynamodb.batch_write_item.return_value = {}
+        item = {'customer_id': '123', 'timestamp': '2024-01-01T00:00:00'}
+        with mock.patch('app.helpers.message_writer.get_dynamodb_resource', return_value=dynamodb):
+            self.assertTrue(writer.submit(item).result(timeout=5))
+            writer.flush()
+        self.assertEqual(stored, [item])
+
+
+class WebhookWorkerTests(SimpleTestCase):
+    def process(self, error=None):
+        event = mock.Mock(id=1, attempts=0, payload={}, received_at=timezone.now())
+        with mock.patch.object(WebhookEvent, 'objects') as objects, \
+                mock.patch('app.helpers.webhook_pipeline.process_payload', side_effect=error):
+            WebhookWorkerPool(workers=0)._process(event)
+        return objects.filter.return_value.update.call_args.kwargs['status']
+
+    def test_event_is_done_after_its_messages_are_stored(self):
+        self.assertEqual(self.process(), WebhookEvent.DONE)
+
+    def test_event_stays_pending_when_the_write_fails(self):
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(self.process(RuntimeError('Item for Messages dropped after 5 retries')), WebhookEvent.PENDING)
+
+    def test_ingest_raises_when_a_message_is_not_stored(self):
+        failed = Future()
+        failed.set_exception(RuntimeError('dropped'))
+        writer = mock.Mock()
+        writer.submit.return_value = failed
+        with mock.patch('app.helpers.webhook_pipeline.claim_message', return_value=True), \
+                mock.patch('app.helpers.webhook_pipeline.is_known_duplicate', return_value=False), \
+                mock.patch('app.helpers.webhook_pipeline.resolve_conversations', return_value={'123': 'conv'}), \
+                mock.patch('app.helpers.webhook_pipeline.get_conversation_routes', return_value={}), \
+                mock.patch('app.helpers.webhook_pipeline.get_message_writer', return_value=writer), \
+                mock.patch('app.helpers.webhook_pipeline.release_message'):
+            with self.assertRaises(RuntimeError):
+                ingest_payload(IngestPayloadTests.payload)
+
+
+class InPlaceBackfillTests(SimpleTestCase):
+    def test_updates_only_the_migrated_attribute(self):
+        update = colab_users_set({'conversation_id': 'c1', 'status': 'open', 'colab_users': ['a']})
+        self.assertEqual(update['UpdateExpression'], 'SET colab_users = :colab_users')
+        self.assertEqual(update['ExpressionAttributeValues'], {':colab_users': {'a'}, ':previous': ['a']})
+        self.assertIsNone(colab_users_set({'conversation_id': 'c1', 'colab_users': {'a'}}))
+
+    def test_items_changed_since_the_scan_are_skipped(self):
+        table = mock.Mock()
+        table.update_item.side_effect = [
+            ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem'),
+            {},
+        ]
+        backfill = Backfill('Conversations', 'Conversations', update=colab_users_set)
+        items = [{'conversation_id': 'c1', 'colab_users': ['a']}, {'conversation_id': 'c2', 'colab_users': ['b']}]
+
+        self.assertEqual(backfill._update_items(table, items), 1)
+        table.put_item.assert_not_called()
+        self.assertEqual(table.update_item.call_args.kwargs['Key'], {'conversation_id': 'c2'})
+
+
+class ConversationSummaryTests(SimpleTestCase):
+    def message(self, conversation_id, timestamp):
+        return {'conversation_id': conversation_id, 'customer_id': 'c', 'sender_id': 'c', 'timestamp': timestamp}
+
+    def test_throttled_update_is_retried(self):
+        table = mock.Mock()
+        table.update_item.side_effect = [ClientError({'Error': {'Code': 'ThrottlingException'}}, 'UpdateItem'), {}]
+        with mock.patch('app.helpers.conversation.get_conversations_table', return_value=table), \
+                mock.patch('app.helpers.conversation.time.sleep'):
+            update_conversation_summaries([self.message('a', '2024-01-01T00:00:00')])
+        self.assertEqual(table.update_item.call_count, 2)
+
+    def test_failed_conversation_is_logged_and_others_updated(self):
+        table = mock.Mock()
+        table.update_item.side_effect = [ClientError({'Error': {'Code': 'ValidationException'}}, 'UpdateItem'), {}]
+        with mock.patch('app.helpers.conversation.get_conversations_table', return_value=table), \
+                self.assertLogs(level='ERROR') as logs:
+            update_conversation_summaries([
+                self.message('a', '2024-01-01T00:00:00'),
+                self.message('b', '2024-01-01T00:00:01'),
+            ])
+        self.assertEqual(table.update_item.call_count, 2)
+        self.assertIn('conversation a', logs.output[0])
+
+
+class VendorConversationPageTests(SimpleTestCase):
+    def test_cursor_round_trips_and_rejects_garbage(self):
+        key = {'conversation_id': 'c1', 'vendor_id': 'v1', 'updated_at': '2024-01-01T10:00:00'}
+        self.assertEqual(decode_cursor(encode_cursor(key)), key)
+        self.assertIsNone(encode_cursor(None))
+        for cursor in ['not base64!', encode_cursor(['a'])]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+    def test_projection_names_every_field(self):
+        self.assertEqual(projection_kwargs(['conversation_id', 'status']), {
+            'ProjectionExpression': '#f0, #f1',
+            'ExpressionAttributeNames': {'#f0': 'conversation_id', '#f1': 'status'},
+        })
+        self.assertEqual(projection_kwargs([]), {})
+
+    @override_settings(CONVERSATION_PAGE_SIZE=20, CONVERSATION_MAX_PAGE_SIZE=100)
+    def test_page_size(self):
+        self.assertEqual([parse_page_size(limit) for limit in [None, '5', '500']], [20, 5, 100])
+        for limit in ['0', 'ten']:
+            with self.assertRaises(ValueError):
+                parse_page_size(limit)
+
+    def test_pages_are_read_from_the_vendor_index(self):
+        table = mock.Mock()
+        next_key = {'conversation_id': 'c2', 'vendor_id': 'v1', 'updated_at': '2024-01-01T09:00:00'}
+        table.query.return_value = {'Items': [{'conversation_id': 'c2', 'unread_count': Decimal(3)}], 'LastEvaluatedKey': next_key}
+        cursor = encode_cursor({'conversation_id': 'c1', 'vendor_id': 'v1', 'updated_at': '2024-01-01T10:00:00'})
+        with mock.patch('app.helpers.conversation.get_conversations_table', return_value=table):
+            conversations, next_cursor = list_conversations_by_vendor('v1', 1, cursor=cursor, fields=['conversation_id', 'unread_count'])
+        query = table.query.call_args.kwargs
+        self.assertEqual((query['IndexName'], query['Limit'], query['ScanIndexForward']), ('vendor_id-updated_at-index', 1, False))
+        self.assertEqual(query['ExclusiveStartKey'], decode_cursor(cursor))
+        self.assertEqual(conversations, [{'conversation_id': 'c2', 'unread_count': 3}])
+        self.assertEqual(decode_cursor(next_cursor), next_key)
+
+    def test_view_rejects_bad_paging_parameters(self):
+        for query in ['vendor_id=v1&limit=0', 'vendor_id=v1&cursor=garbage', 'limit=5']:
+            with mock.patch('app.helpers.conversation.get_conversations_table'):
+                response = self.client.get(f'/api/v1/conversations/by-vendor?{query}')
+            self.assertEqual(response.status_code, 400, query)
+
+
+class CollaboratorTests(SimpleTestCase):
+    def setUp(self):
+        self.table = mock.Mock()
+        patcher = mock.patch('app.helpers.conversation.get_conversations_table', return_value=self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_add_is_one_set_update(self):
+        update_collaborators('c1', ['u1', 'u2', 'u1'], 'add')
+        self.table.update_item.assert_called_once_with(
+            Key={'conversation_id': 'c1'},
+            UpdateExpression='ADD colab_users :users',
+            ConditionExpression='attribute_exists(conversation_id)',
+            ExpressionAttributeValues={':users': {'u1', 'u2'}}
+        )
+        self.table.get_item.assert_not_called()
+
+    def test_legacy_list_is_converted_then_updated(self):
+        self.table.update_item.side_effect = [ClientError({'Error': {'Code': 'ValidationException'}}, 'UpdateItem'), {}, {}]
+        self.table.get_item.return_value = {'Item': {'conversation_id': 'c1', 'colab_users': ['u1']}}
+        update_collaborators('c1', ['u1'], 'remove')
+        expressions = [call.kwargs['UpdateExpression'] for call in self.table.update_item.call_args_list]
+        self.assertEqual(expressions, ['DELETE colab_users :users', 'SET colab_users = :users', 'DELETE colab_users :users'])
+
+    def test_bulk_changes_report_missing_conversations(self):
+        def update_item(**kwargs):
+            if kwargs['Key']['conversation_id'] == 'gone':
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+        self.table.update_item.side_effect = update_item
+        result = apply_collaborator_changes([
+            {'conversation_id': 'c1', 'add': ['u2'], 'remove': ['u1']},
+            {'conversation_id': 'gone', 'add': ['u2']},
+        ])
+        self.assertEqual([item['status'] for item in result['results']], ['updated', 'not_found'])
+        self.assertEqual((result['updated'], result['failed']), (1, 1))
+
+
+class ConversationRouteTests(SimpleTestCase):
+    def setUp(self):
+        self.table = mock.Mock()
+        self.table.name = 'Conversations'
+        self.dynamodb = mock.Mock()
+        for target, value in [('get_conversations_table', self.table), ('get_dynamodb_resource', self.dynamodb)]:
+            patcher = mock.patch(f'app.helpers.conversation.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('app.helpers.conversation.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def unprocessed(self, *conversation_ids):
+        return {'Conversations': {'Keys': [{'conversation_id': conversation_id} for conversation_id in conversation_ids]}}
+
+    def test_unprocessed_keys_are_retried_with_backoff(self):
+        self.dynamodb.batch_get_item.side_effect = [
+            {'Responses': {'Conversations': [{'conversation_id': 'route-a', 'vendor_id': 'v'}]},
+             'UnprocessedKeys': self.unprocessed('route-b')},
+            {'Responses': {'Conversations': [{'conversation_id': 'route-b', 'vendor_id': 'v'}]}},
+        ]
+        routes = get_conversation_routes(['route-a', 'route-b'])
+        self.assertEqual(set(routes), {'route-a', 'route-b'})
+        self.assertEqual(self.sleep.call_count, 1)
+
+    def test_keys_left_unprocessed_raise(self):
+        self.dynamodb.batch_get_item.return_value = {'UnprocessedKeys': self.unprocessed('route-c')}
+        with self.assertLogs(level='ERROR') as logs, self.assertRaises(RuntimeError):
+            get_conversation_routes(['route-c'])
+        self.assertIn('route-c', logs.output[0])
+        self.assertEqual(self.dynamodb.batch_get_item.call_count, ROUTE_MAX_RETRIES + 1)
+
+
+class CreateConversationTests(SimpleTestCase):
+    def test_racing_creations_share_one_conversation(self):
+        table = mock.Mock()
+        table.put_item.side_effect = [{}, ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')]
+        with mock.patch('app.helpers.conversation.get_conversations_table', return_value=table), \
+                mock.patch('app.helpers.conversation.find_conversation_id', return_value=None), \
+                mock.patch('app.helpers.conversation._conversation_cache.get', return_value=None):
+            first = create_conversation('15550001111')
+            second = create_conversation('15550001111')
+        self.assertEqual(first, second)
+        for call in table.put_item.call_args_list:
+            self.assertEqual(call.kwargs['Item']['conversation_id'], first)
+            self.assertEqual(call.kwargs['ConditionExpression'], 'attribute_not_exists(conversation_id)')
+
+
+class BulkJobsTests(SimpleTestCase):
+    def setUp(self):
+        self.table = mock.Mock()
+        patcher = mock.patch('app.helpers.bulk_updates.get_table', return_value=self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_running_job_sends_heartbeats_until_it_finishes(self):
+        jobs = BulkJobs(heartbeat=0.02)
+        release = threading.Event()
+        job_id = jobs.submit(lambda: release.wait(1) and {})
+        time.sleep(0.1)
+        release.set()
+        jobs._executor.shutdown(wait=True)
+        beats = [call for call in self.table.update_item.call_args_list if call.kwargs['Key'] == {'job_id': job_id}]
+        self.assertTrue(beats)
+        self.assertEqual(beats[0].kwargs['ExpressionAttributeValues'][':running'], 'running')
+        self.assertEqual(self.table.put_item.call_args.kwargs['Item']['status'], 'done')
+        self.assertNotIn(job_id, jobs._live_jobs)
+
+    def test_job_without_recent_heartbeat_is_reported_failed(self):
+        jobs = BulkJobs(heartbeat=30)
+        now = int(time.time())
+        self.table.get_item.side_effect = [
+            {'Item': {'job_id': 'a', 'status': 'running', 'heartbeat_at': now - 10, 'expires_at': now + 60}},
+            {'Item': {'job_id': 'b', 'status': 'running', 'heartbeat_at': now - 100, 'expires_at': now + 60}},
+        ]
+        self.assertEqual(jobs.get('a')['status'], 'running')
+        self.assertEqual(jobs.get('b')['status'], 'failed')
+
+
+class ReadMarkWriterTests(SimpleTestCase):
+    def test_failed_mark_is_requeued_behind_newer_one(self):
+        writer = ReadMarkWriter()
+        writer._pending[('conv', 'u1')] = '2024-01-01T00:00:01'
+        table = mock.Mock()
+
+        def update_item(**kwargs):
+            # A newer mark arrives while the flush is writing
+            writer._pending[('conv', 'u1')] = '2024-01-01T00:00:02'
+            raise ClientError({'Error': {'Code': 'ThrottlingException'}}, 'UpdateItem')
+
+        table.update_item.side_effect = update_item
+        with mock.patch('app.helpers.read_receipts.get_table', return_value=table), self.assertLogs(level='ERROR'):
+            writer.flush()
+        self.assertEqual(writer._pending, {('conv', 'u1'): '2024-01-01T00:00:02'})
+
+        table.update_item.side_effect = None
+        with mock.patch('app.helpers.read_receipts.get_table', return_value=table):
+            writer.flush()
+        self.assertEqual(writer._pending, {})
+        self.assertEqual(table.update_item.call_args.kwargs['ExpressionAttributeValues'], {':timestamp': '2024-01-01T00:00:02'})
+
+    def test_unexpected_error_does_not_lose_marks(self):
+        writer = ReadMarkWriter()
+        writer._pending[('conv', 'u1')] = '2024-01-01T00:00:01'
+        with mock.patch('app.helpers.read_receipts.get_table', side_effect=RuntimeError('no connection')), \
+                self.assertLogs(level='ERROR'):
+            writer.flush()
+        self.assertEqual(writer._pending, {('conv', 'u1'): '2024-01-01T00:00:01'})
+
+
+class ReadTimestampTests(SimpleTestCase):
+    def test_parse_normalises_and_rejects_garbage(self):
+        self.assertEqual(parse_read_timestamp('2024-01-01T10:00:00.500'), '2024-01-01T10:00:00.500000')
+        for value in ('zzzz', '2024-01-01T10:00:00+02:00', 5):
+            with self.assertRaises(ValueError):
+                parse_read_timestamp(value)
+
+    def test_read_past_last_message_is_rejected(self):
+        latest = {'message': 'hi', 'timestamp': '2024-01-01T10:00:00.000001'}
+        with mock.patch('app.helpers.read_receipts.recent_messages.peek_latest', return_value=latest):
+            check_read_timestamp('c', 'conv', '2024-01-01T10:00:00.000001')
+            with self.assertRaises(ValueError):
+                check_read_timestamp('c', 'conv', '2024-01-01T10:00:00.000002')
+
+
+class UserUnreadCountTests(SimpleTestCase):
+    def test_counts_come_from_the_users_own_marks(self):
+        marks = {('read', 'u1'): '2024-01-01T00:00:05', ('partly', 'u1'): '2024-01-01T00:00:01'}
+        conversations = [
+            {'conversation_id': conversation_id, 'updated_at': '2024-01-01T00:00:05', 'unread_count': 3}
+            for conversation_id in ('read', 'partly', 'never')
+        ]
+        with mock.patch('app.helpers.read_receipts.get_read_mark', side_effect=lambda *key: marks.get(key)), \
+                mock.patch('app.helpers.read_receipts.count_unread', side_effect=lambda conversation_id, mark: 2 if mark else 4) as count:
+            add_user_unread_counts(conversations, 'u1')
+        self.assertEqual([conversation['unread_count'] for conversation in conversations], [0, 2, 4])
+        self.assertEqual(count.call_count, 2)
+
+
+class FrameCodecTests(SimpleTestCase):
+    def test_round_trip(self):
+        frame = {'type': 'history', 'messages': [{'message': 'hi', 'timestamp': '2024-01-01T10:00:00.000001'}]}
+        self.assertEqual(decode_frame(encode_frame(frame)), frame)
+
+    def test_hostile_frames_raise_value_error(self):
+        frames = [
+            packb({3: 2 ** 63 - 1}),  # timestamp out of datetime's range
+            b'\x91' * 100000,  # nested arrays
+            bytes([0x81, 0x90, 0x01]),  # array as a map key
+            bytes([0x81, 0x01, 0xd4, 0x05, 0x00]),  # extension type
+        ]
+        for data in frames:
+            with self.assertRaises(ValueError):
+                decode_frame(data)
+        with self.assertRaises(ValueError):
+            FrameProtocolMixin().parse_frame(text_data='[' * 100000)
+
+
+class RecentMessageCacheTests(SimpleTestCase):
+    def message(self, second):
+        return {'message': f'm{second}', 'timestamp': f'2024-01-01T10:00:{second:02}'}
+
+    def test_entry_expires_ttl_after_the_last_subscriber_leaves(self):
+        cache = RecentMessageCache(ttl=30)
+        with mock.patch('app.helpers.recent_messages.time.monotonic', return_value=100):
+            cache.subscribe('c')
+            cache.finish_load('c', [self.message(1)], has_older=False)
+            cache.unsubscribe('c')
+        with mock.patch('app.helpers.recent_messages.time.monotonic', return_value=129):
+            self.assertIsNotNone(cache.history('c', 10))
+        with mock.patch('app.helpers.recent_messages.time.monotonic', return_value=131):
+            self.assertIsNone(cache.history('c', 10))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+    def test_least_recently_used_conversation_is_evicted(self):
+        cache = RecentMessageCache(maxsize=2)
+        for customer_id in ['a', 'b']:
+            cache.subscribe(customer_id)
+            cache.finish_load(customer_id, [self.message(1)], has_older=False)
+        cache.history('a', 10)
+        cache.subscribe('c')
+        cache.finish_load('c', [self.message(1)], has_older=False)
+        self.assertIsNone(cache.history('b', 10))
+        self.assertIsNotNone(cache.history('a', 10))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_buffer_keeps_the_newest_messages(self):
+        cache = RecentMessageCache(size=3)
+        cache.subscribe('c')
+        cache.finish_load('c', [self.message(1), self.message(2)], has_older=False)
+        cache.add('c', [self.message(4), self.message(3), self.message(5)])
+        messages, next_before = cache.history('c', 3)
+        self.assertEqual([message['message'] for message in messages], ['m3', 'm4', 'm5'])
+        self.assertEqual(next_before, '2024-01-01T10:00:03')
+        # Older messages were dropped from the buffer, so a longer page is a miss
+        self.assertIsNone(cache.history('c', 4))
+        self.assertEqual(cache.since('c', '2024-01-01T10:00:03', 10), ([self.message(4), self.message(5)], None))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (2, 1))
+
+
+class PresenceTests(SimpleTestCase):
+    def test_repeated_state_is_coalesced_until_the_interval_passes(self):
+        throttle = EventThrottle(interval=1.0)
+        with mock.patch('app.helpers.mem_cache.time.monotonic', return_value=100):
+            self.assertTrue(throttle.allow(('c', 'u1'), 'typing'))
+            self.assertFalse(throttle.allow(('c', 'u1'), 'typing'))
+            self.assertTrue(throttle.allow(('c', 'u2'), 'typing'))
+            self.assertTrue(throttle.allow(('c', 'u1'), 'stopped'))
+        with mock.patch('app.helpers.mem_cache.time.monotonic', return_value=101.5):
+            self.assertTrue(throttle.allow(('c', 'u1'), 'stopped'))
+        self.assertEqual(throttle.stats(), {'allowed': 4, 'dropped': 1})
+
+    def test_users_expire_unless_refreshed(self):
+        registry = PresenceRegistry(ttl=30)
+        with mock.patch('app.helpers.presence.time.monotonic', return_value=100):
+            self.assertIsNone(registry.update('c', 'u1', 'online'))
+            registry.update('c', 'u2', 'away')
+        with mock.patch('app.helpers.presence.time.monotonic', return_value=120):
+            self.assertEqual(registry.update('c', 'u1', 'online'), 'online')
+        with mock.patch('app.helpers.presence.time.monotonic', return_value=140):
+            self.assertEqual(registry.present('c'), {'u1': 'online'})
+            self.assertEqual(registry.update('c', 'u1', 'offline'), 'online')
+            self.assertEqual(registry.present('c'), {})
+        self.assertEqual(registry.stats(), {'rooms': 0, 'users': 0})
+
+
+class ConversationTranscriptTests(SimpleTestCase):
+    def test_page_is_read_from_the_conversation_index(self):
+        table = mock.Mock()
+        next_key = {'customer_id': '123', 'timestamp': '2024-01-01T09:00:00', 'conversation_id': 'c1'}
+        table.query.return_value = {'Items': [{'message': 'hi'}], 'LastEvaluatedKey': next_key}
+        with mock.patch('app.helpers.messages.get_table', return_value=table) as get_table, \
+                override_settings(MESSAGE_KEY_SCHEME='customer'):
+            messages, cursor = list_conversation_messages('c1', '10', direction='desc', fields=['message'])
+        get_table.assert_called_once_with('Messages')
+        query = table.query.call_args.kwargs
+        self.assertEqual((query['IndexName'], query['ScanIndexForward'], query['Limit']), ('conversation_id-timestamp-index', False, 10))
+        self.assertEqual(query['ExpressionAttributeNames'], {'#f0': 'message'})
+        self.assertEqual((messages, decode_cursor(cursor)), ([{'message': 'hi'}], next_key))
+
+    def test_view_rejects_bad_direction_and_cursor(self):
+        for query in ['direction=sideways', 'cursor=garbage']:
+            with mock.patch('app.helpers.messages.get_table'):
+                response = self.client.get(f'/api/v1/conversations/c1/messages?{query}')
+            self.assertEqual(response.status_code, 400, query)
+
+
+class FakeBucketTable:
+    """MessagesByMonth stand-in answering bucket/timestamp key conditions like Query does."""
+
+    operators = {'=': lambda a, b: a == b, '<': lambda a, b: a < b, '>': lambda a, b: a > b}
+
+    def __init__(self, items):
+        self.items = items
+        self.queried = []
+
+    def conditions(self, condition):
+        expression = condition.get_expression()
+        if expression['operator'] == 'AND':
+            return [part for value in expression['values'] for part in self.conditions(value)]
+        key, value = expression['values']
+        return [(key.name, self.operators[expression['operator']], value)]
+
+    def query(self, KeyConditionExpression, ScanIndexForward, Limit, ExclusiveStartKey=None):
+        conditions = self.conditions(KeyConditionExpression)
+        self.queried.append(next(value for name, _, value in conditions if name == 'bucket'))
+        matches = sorted(
+            (item for item in self.items if all(test(item[name], value) for name, test, value in conditions)),
+            key=lambda item: item['timestamp'], reverse=not ScanIndexForward
+        )
+        if ExclusiveStartKey:
+            matches = matches[[item['timestamp'] for item in matches].index(ExclusiveStartKey['timestamp']) + 1:]
+        response = {'Items': matches[:Limit]}
+        if len(matches) >= Limit:
+            response['LastEvaluatedKey'] = {'bucket': matches[Limit - 1]['bucket'], 'timestamp': matches[Limit - 1]['timestamp']}
+        return response
+
+
+@override_settings(MESSAGE_KEY_SCHEME='monthly')
+class BucketedMessageTests(SimpleTestCase):
+    def setUp(self):
+        timestamps = ['2024-01-10T00:00:00', '2024-01-20T00:00:00', '2024-01-30T00:00:00',
+                      '2024-03-05T00:00:00', '2024-03-06T00:00:00']
+        self.messages = FakeBucketTable([add_message_key({'customer_id': 'c', 'timestamp': timestamp}) for timestamp in timestamps])
+        index = mock.Mock()
+        index.get_item.return_value = {'Item': {'customer_id': 'c', 'months': {'202401', '202403'}}}
+        tables = {'MessagesByMonth': self.messages, 'MessageBucketIndex': index}
+        patcher = mock.patch('app.helpers.messages.get_table', side_effect=tables.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def timestamps(self, items):
+        return [item['timestamp'][:10] for item in items]
+
+    def test_history_pages_through_month_buckets_newest_first(self):
+        items, before = fetch_message_history('c', limit=4)
+        self.assertEqual(self.timestamps(items), ['2024-01-20', '2024-01-30', '2024-03-05', '2024-03-06'])
+        self.assertEqual(before, '2024-01-20T00:00:00')
+        # Only months recorded in MessageBucketIndex are read
+        self.assertEqual(self.messages.queried, ['c#202403', 'c#202401'])
+
+        items, before = fetch_message_history('c', limit=4, before=before)
+        self.assertEqual(self.timestamps(items), ['2024-01-10'])
+        self.assertIsNone(before)
+
+    def test_since_reads_later_buckets_oldest_first(self):
+        items, since = fetch_messages_since('c', '2024-01-15T00:00:00', limit=2)
+        self.assertEqual(self.timestamps(items), ['2024-01-20', '2024-01-30'])
+        items, since = fetch_messages_since('c', since, limit=2)
+        self.assertEqual(self.timestamps(items), ['2024-03-05', '2024-03-06'])
+        self.assertIsNone(fetch_messages_since('c', '2024-03-06T00:00:00', limit=2)[1])
+
+    def test_writes_record_each_month_once(self):
+        index = mock.Mock()
+        with mock.patch('app.helpers.messages.get_table', return_value=index):
+            record_message_buckets([
+                {'customer_id': 'bucket-writer', 'timestamp': '2024-05-01T00:00:00'},
+                {'customer_id': 'bucket-writer', 'timestamp': '2024-05-02T00:00:00'},
+            ])
+            record_message_buckets([{'customer_id': 'bucket-writer', 'timestamp': '2024-05-03T00:00:00'}])
+        index.update_item.assert_called_once()
+        self.assertEqual(index.update_item.call_args.kwargs['ExpressionAttributeValues'], {':months': {'202405'}})
+
+
+class RecentMessagePeekTests(SimpleTestCase):
+    def test_peek_does_not_count_as_a_lookup(self):
+        cache = RecentMessageCache()
+        cache.subscribe('c')
+        cache.finish_load('c', [{'message': 'hi', 'timestamp': '2024-01-01T10:00:00'}], has_older=False)
+        self.assertEqual(cache.peek_latest('c')['timestamp'], '2024-01-01T10:00:00')
+        self.assertIsNone(cache.peek_latest('other'))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (0, 0))
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS)
+class ChatHistoryTests(SimpleTestCase):
+    application = URLRouter([re_path(r'^ws/chat/(?P<room_name>\w+)/?$', ChatConsumer.as_asgi())])
+    page = [{'message': 'hi', 'timestamp': '2024-01-01T10:00:00', 'sender_id': '123'}]
+
+    def chat(self, path, *frames):
+        """Connect, send `frames` and return every frame received."""
+        async def scenario():
+            communicator = WebsocketCommunicator(self.application, path)
+            await communicator.connect()
+            received = [await communicator.receive_json_from(timeout=5)]
+            for frame in frames:
+                await communicator.send_json_to(frame)
+                received.append(await communicator.receive_json_from(timeout=5))
+            await communicator.disconnect()
+            return received
+
+        with mock.patch('app.consumers.create_conversation', return_value='conv-123'):
+            return asyncio.run(scenario())
+
+    def test_connect_sends_one_history_page_and_pages_back(self):
+        with mock.patch('app.consumers.fetch_recent_history', return_value=(self.page, '2024-01-01T10:00:00')) as recent, \
+                mock.patch('app.consumers.fetch_message_history', return_value=([], None)) as older:
+            first, second = self.chat('/ws/chat/123/?history_limit=20',
+                                      {'type': 'history', 'before': '2024-01-01T10:00:00', 'limit': 20})
+        recent.assert_called_once_with('123', limit='20')
+        self.assertEqual(first, {'type': 'history', 'messages': self.page, 'before': '2024-01-01T10:00:00'})
+        older.assert_called_once_with('123', limit=20, before='2024-01-01T10:00:00')
+        self.assertEqual(second, {'type': 'history', 'messages': [], 'before': None})
+
+    def test_reconnect_with_since_gets_only_missed_messages(self):
+        with mock.patch('app.consumers.fetch_recent_since', side_effect=[(self.page, '2024-01-01T10:00:00'), ([], None)]) as since, \
+                mock.patch('app.consumers.fetch_recent_history') as recent:
+            first, second = self.chat('/ws/chat/123/?since=2024-01-01T09:00:00',
+                                      {'type': 'resume', 'since': '2024-01-01T10:00:00'})
+        recent.assert_not_called()
+        self.assertEqual(since.call_args_list, [
+            mock.call('123', '2024-01-01T09:00:00', limit=None),
+            mock.call('123', '2024-01-01T10:00:00', limit=None),
+        ])
+        self.assertEqual(first, {'type': 'history', 'mode': 'resume', 'messages': self.page, 'since': '2024-01-01T10:00:00'})
+        self.assertEqual(second['since'], None)
+
+    def test_resume_reads_dynamodb_when_the_cache_does_not_cover_since(self):
+        cache = RecentMessageCache(size=1)
+        cache.subscribe('123')
+        cache.finish_load('123', self.page, has_older=True)
+        stored = {'message': 'missed', 'timestamp': '2024-01-01T09:30:00', 'sender_id': '123'}
+        with mock.patch('app.helpers.messages.recent_messages', cache), \
+                mock.patch('app.helpers.messages.fetch_messages_since', return_value=([stored], None)) as fetch:
+            self.assertEqual(fetch_recent_since('123', '2024-01-01T10:00:00'), ([], None))
+            fetch.assert_not_called()
+            messages, _ = fetch_recent_since('123', '2024-01-01T09:00:00')
+        self.assertEqual(messages, [stored])
+
+    def test_page_size_is_clamped(self):
+        with override_settings(MESSAGE_HISTORY_PAGE_SIZE=50, MESSAGE_HISTORY_MAX_PAGE_SIZE=200):
+            self.assertEqual([clamp_history_limit(limit) for limit in [None, 'x', '0', '20', 1000]], [50, 50, 1, 20, 200])
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS)
+class InboxRoutingTests(SimpleTestCase):
+    route = {'vendor_id': 'v1', 'assigned_team_id': 't1', 'assigned_user_id': 'u1', 'colab_users': ['u2', 'u1']}
+
+    def test_event_is_routed_to_every_watching_group_with_one_id(self):
+        events = routed_events({'type': 'chat_message', 'message': 'hi'}, '123', 'conv-123', self.route)
+        self.assertEqual([group for group, _ in events],
+                         ['chat_123', 'inbox_vendor_v1', 'inbox_team_t1', 'inbox_user_u1', 'inbox_user_u2'])
+        self.assertEqual(len({event['event_id'] for _, event in events}), 1)
+        self.assertEqual(events[0][1]['conversation_id'], 'conv-123')
+
+    def test_socket_in_several_groups_gets_an_event_once(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(InboxConsumer.as_asgi(), '/ws/inbox/?vendor_id=v1&user_id=u1,u2')
+            await communicator.connect()
+            await communicator.send_json_to({'type': 'subscribe', 'customer_ids': ['123']})
+            subscriptions = await communicator.receive_json_from(timeout=5)
+            event = {'type': 'chat_message', 'message': 'hi', 'sender_id': '123', 'timestamp': '2024-01-01T10:00:00'}
+            channel_layer = get_channel_layer()
+            for group, routed in routed_events(event, '123', 'conv-123', self.route):
+                await channel_layer.group_send(group, routed)
+            message = await communicator.receive_json_from(timeout=5)
+            duplicate = not await communicator.receive_nothing(timeout=0.2)
+            await communicator.disconnect()
+            return subscriptions, message, duplicate
+
+        subscriptions, message, duplicate = asyncio.run(scenario())
+        self.assertEqual(subscriptions, {'type': 'subscriptions', 'customer_ids': ['123']})
+        self.assertEqual((message['type'], message['conversation_id'], message['message']), ('message', 'conv-123', 'hi'))
+        self.assertFalse(duplicate)
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_CHANNEL_LAYERS)
+class InboxReadTests(SimpleTestCase):
+    def test_read_for_another_customers_conversation_is_rejected(self):
+        async def scenario():
+            communicator = WebsocketCommunicator(InboxConsumer.as_asgi(), '/ws/inbox/?vendor_id=v1')
+            await communicator.connect()
+            await communicator.send_json_to({
+                'type': 'read', 'customer_id': '123', 'conversation_id': 'someone-elses',
+                'user_id': 'u1', 'timestamp': '2024-01-01T10:00:00',
+            })
+            response = await communicator.receive_json_from(timeout=5)
+            await communicator.disconnect()
+            return response
+
+        with mock.patch('app.consumers.lookup_conversation', return_value='conv-123'), \
+                mock.patch('app.consumers.record_read') as record_read:
+            response = asyncio.run(scenario())
+        self.assertIn('error', response)
+        record_read.assert_not_called()
+
+
+class RecordingSocket:
+    """Stands in for AsyncWebsocketConsumer under BufferedSendMixin; writes wait for `writable`."""
+
+    def __init__(self):
+        self.scope = {'type': 'websocket', 'path': '/ws/test/'}
+        self.sent = []
+        self.closed_with = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    async def websocket_connect(self, message):
+        pass
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.writable.wait()
+        self.sent.append(text_data)
+
+    async def close(self, code=None, reason=None):
+        self.closed_with = code
+
+
+class BufferedSocket(BufferedSendMixin, RecordingSocket):
+    pass
+
+
+class SendBufferTests(SimpleTestCase):
+    def run_socket(self, frames, settle=0.05):
+        async def scenario():
+            socket = BufferedSocket()
+            for frame, key in frames:
+                await socket.send(text_data=frame, coalesce_key=key)
+            await asyncio.sleep(settle)
+            socket._stop_sending()
+            return socket
+
+        return asyncio.run(scenario())
+
+    @override_settings(WS_SEND_BUFFER_SIZE=2, WS_SEND_BUFFER_POLICY='drop_oldest')
+    def test_drop_oldest_keeps_the_newest_frames(self):
+        socket = self.run_socket([('a', None), ('b', None), ('c', None), ('d', None)])
+        self.assertEqual(socket.sent, ['c', 'd'])
+        self.assertEqual(socket.frames_dropped, 2)
+        self.assertIsNone(socket.closed_with)
+
+    @override_settings(WS_SEND_BUFFER_SIZE=2, WS_SEND_BUFFER_POLICY='coalesce', WS_SEND_BUFFER_CLOSE_CODE=4008)
+    def test_coalesce_replaces_keyed_frames_and_closes_without_one(self):
+        socket = self.run_socket([('typing', 'u1'), ('m1', None), ('stopped', 'u1'), ('m2', None), ('m3', None)])
+        self.assertEqual(socket.frames_coalesced, 1)
+        self.assertEqual(socket.frames_dropped, 1)
+        self.assertEqual(socket.closed_with, 4008)
+        self.assertEqual(socket.sent, [])
+
+    @override_settings(WS_SEND_BUFFER_SIZE=2, WS_SEND_BUFFER_POLICY='close', WS_SEND_BUFFER_CLOSE_CODE=4008)
+    def test_close_policy_closes_on_overflow(self):
+        socket = self.run_socket([('a', None), ('b', None), ('c', None), ('d', None)])
+        self.assertEqual(socket.closed_with, 4008)
+        self.assertEqual(socket.sent, [])
+
+    @override_settings(WS_REAPER_INTERVAL=0.01, WS_STALL_TIMEOUT=0.05, WS_IDLE_TIMEOUT=0.05,
+                       WS_SEND_BUFFER_CLOSE_CODE=4008, WS_IDLE_CLOSE_CODE=4000)
+    def test_reaper_closes_stalled_and_idle_sockets(self):
+        async def scenario():
+            stalled, idle = BufferedSocket(), BufferedSocket()
+            await stalled.websocket_connect({'type': 'websocket.connect'})
+            await idle.websocket_connect({'type': 'websocket.connect'})
+            stalled.writable.clear()
+            for frame in ['a', 'b']:
+                await stalled.send(text_data=frame)
+            await asyncio.sleep(0.03)
+            # Closed neither yet: the stall clock started with the first queued frame
+            early = (stalled.closed_with, idle.closed_with)
+            await asyncio.sleep(0.1)
+            return early, stalled.closed_with, idle.closed_with
+
+        early, stalled, idle = asyncio.run(scenario())
+        self.assertEqual(early, (None, None))
+        self.assertEqual((stalled, idle), (4008, 4000))
+
+
+class SendBufferStatsTests(SimpleTestCase):
+    def test_stats_do_not_expose_the_customer_path(self):
+        consumer = ChatConsumer()
+        consumer.scope = {'type': 'websocket', 'path': '/ws/chat/15551234567'}
+        stats = consumer.send_buffer_stats()
+        self.assertNotIn('15551234567', str(stats))
+        self.assertEqual(stats['consumer'], 'ChatConsumer')
+
+
+class IOExecutorTests(SimpleTestCase):
+    def test_calls_run_in_parallel_and_are_counted(self):
+        executor = IOExecutor(workers=4)
+
+        async def scenario():
+            started = time.monotonic()
+            await asyncio.gather(*[executor.run(time.sleep, 0.1) for _ in range(4)])
+            elapsed = time.monotonic() - started
+            with self.assertRaises(ZeroDivisionError):
+                await executor.run(lambda: 1 / 0)
+            return elapsed
+
+        elapsed = asyncio.run(scenario())
+        self.assertLess(elapsed, 0.3)
+        stats = executor.stats()
+        self.assertEqual((stats['completed'], stats['failed'], stats['active'], stats['queued']), (5, 1, 0, 0))
+        self.assertIsNotNone(stats['queue_wait_ms_p99'])
+
+    def test_waiting_calls_are_counted_as_queued(self):
+        executor = IOExecutor(workers=1)
+        release = threading.Event()
+        first = executor.submit(release.wait, 5)
+        second = executor.submit(lambda: 'done')
+        time.sleep(0.05)
+        self.assertEqual((executor.stats()['active'], executor.stats()['queued']), (1, 1))
+        release.set()
+        self.assertEqual(second.result(timeout=5), 'done')
+        first.result(timeout=5)
+
+
+class AsyncViewTests(SimpleTestCase):
+    factory = AsyncRequestFactory()
+
+    def test_vendor_page_runs_the_query_on_the_io_executor(self):
+        request = self.factory.get('/api/v1/conversations/by-vendor', {'vendor_id': 'v1', 'limit': '5'})
+        with mock.patch('app.views.async_api.list_conversations_by_vendor', return_value=([{'conversation_id': 'c1'}], None)) as page, \
+                mock.patch('app.views.async_api.run_io', wraps=run_io) as offload:
+            response = asyncio.run(async_api.get_conversations_by_vendor(request))
+        self.assertEqual(json.loads(response.content), {'conversations': [{'conversation_id': 'c1'}], 'next_cursor': None})
+        self.assertIs(offload.call_args.args[0], page)
+        self.assertEqual(page.call_args.args, ('v1', 5))
+
+    def test_vendor_page_validates_like_the_drf_view(self):
+        for params in [{'limit': '5'}, {'vendor_id': 'v1', 'limit': '0'}]:
+            response = asyncio.run(async_api.get_conversations_by_vendor(self.factory.get('/', params)))
+            self.assertEqual(response.status_code, 400, params)
+
+    @override_settings(WEBHOOK_INGEST_MODE='queued')
+    def test_webhook_queues_the_payload(self):
+        request = self.factory.post('/api/v1/webhook', data=IngestPayloadTests.payload, content_type='application/json')
+        with mock.patch('app.views.async_api.aenqueue_webhook') as enqueue:
+            response = asyncio.run(async_api.webhook(request))
+        self.assertEqual(response.status_code, 200)
+        enqueue.assert_awaited_once_with(IngestPayloadTests.payload)
+        invalid = self.factory.post('/api/v1/webhook', data='not json', content_type='application/json')
+        self.assertEqual(asyncio.run(async_api.webhook(invalid)).status_code, 400)
+
+
+class MetricsViewTests(SimpleTestCase):
+    def get(self, **headers):
+        return self.client.get('/api/v1/metrics', headers=headers)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_disabled_without_a_token(self):
+        self.assertEqual(self.get(Authorization='Bearer ').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_requires_the_token(self):
+        self.assertEqual(self.get().status_code, 401)
+        self.assertEqual(self.get(Authorization='Bearer wrong').status_code, 401)
+        with mock.patch('app.views.metrics.collect_metrics', return_value={'io_executor': {}}):
+            response = self.get(Authorization='Bearer secret')
+        self.assertEqual(response.json(), {'io_executor': {}})
@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.urls import path
 
 from app.views.health import health_check
+from app.views.metrics import metrics
 from app.views.role import role_detail, role_list
 from app.views.team import add_users_to_teams, team_details, list_teams, remove_users_from_teams, delete_teams
 from app.views.user import create_user, delete_users, invite_users, my_profile, update_users, generate_presigned_url, user_detail, user_list
@@ -12,11 +14,16 @@ from .views.auth import change_password, forgot_password, login, logout, registe
 from rest_framework_simplejwt.views import (TokenRefreshView)
 from app.views.contact import list_contacts, contact_details
 from app.views.room import room
-from app.views.conversation import get_conversations_by_vendor, assign_user_and_team_to_conversation, change_assignment, add_users_to_conversation, remove_users_from_conversation, set_multiple_conversation_statuses
+from app.views.conversation import get_conversations_by_vendor, assign_user_and_team_to_conversation, change_assignment, add_users_to_conversation, remove_users_from_conversation, set_multiple_conversation_statuses, conversation_status_job, bulk_update_collaborators, get_conversation_messages, get_conversation_reads, get_inbox
+
+if settings.ASYNC_API_VIEWS:
+    # Async-native webhook and conversation views for ASGI deployments
+    from app.views.async_api import webhook, get_conversations_by_vendor, assign_user_and_team_to_conversation, change_assignment, add_users_to_conversation, remove_users_from_conversation, set_multiple_conversation_statuses, bulk_update_collaborators, get_conversation_messages, get_conversation_reads, get_inbox
 
 urlpatterns = [
     # Health Check
     path('health', health_check, name='health_check'),
+    path('metrics', metrics, name='metrics'),
 
     # Auth
     path('login', login, name='login'),
@@ -78,11 +85,16 @@ urlpatterns = [
     
     # Conversation
     path('conversations/by-vendor', get_conversations_by_vendor, name='conversations_by_vendor'),
+    path('conversations/inbox', get_inbox, name='conversation_inbox'),
     path('conversations/assign', assign_user_and_team_to_conversation, name='assign_user_and_team_to_conversation'),
     path('conversations/change-assignment', change_assignment, name='change_assignment'),
     path('conversations/add-users', add_users_to_conversation, name='add_users_to_conversation'),
     path('conversations/remove-users', remove_users_from_conversation, name='remove_users_from_conversation'),
+    path('conversations/colab-users/bulk', bulk_update_collaborators, name='bulk_update_collaborators'),
     path('conversations/set-status', set_multiple_conversation_statuses, name='set_multiple_conversation_statuses'),
+    path('conversations/set-status/jobs/<uuid:job_id>', conversation_status_job, name='conversation_status_job'),
+    path('conversations/<str:conversation_id>/messages', get_conversation_messages, name='conversation_messages'),
+    path('conversations/<str:conversation_id>/reads', get_conversation_reads, name='conversation_reads'),
     
     # Webhook Whatsapp
     path("webhook", webhook, name="webhook"),
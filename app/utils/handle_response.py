@@ -1,4 +1,4 @@
-
+from django.http import JsonResponse
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -9,3 +9,12 @@ def handle_response(data=None, message=None, status_code=status.HTTP_200_OK):
         "code": status_code
     }
     return Response(response_data, status=status_code)
+
+def handle_json_response(data=None, message=None, status_code=status.HTTP_200_OK):
+    """handle_response for plain (async) Django views, which do not render DRF Responses."""
+    response_data = {
+        "message": message,
+        "data": data,
+        "code": status_code
+    }
+    return JsonResponse(response_data, status=status_code)
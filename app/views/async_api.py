@@ -0,0 +1,244 @@
+"""Async-native versions of the webhook and conversation endpoints.
+
+Used instead of the DRF views in app/views/webhook.py and
+app/views/conversation.py when ASYNC_API_VIEWS is enabled (see app/urls.py).
+Under ASGI they hold no worker thread while waiting: the blocking boto3 calls
+run on the I/O executor and channel layer sends are awaited directly. Request
+and response bodies are the same as the DRF views'.
+"""
+import json
+import logging
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.db import DatabaseError
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework import status
+from app.helpers.bulk_updates import apply_collaborator_changes, bulk_jobs, set_conversation_statuses
+from app.helpers.conversation import INBOX_FIELDS, WA_CONFIG_TOKEN, assign_conversation, list_conversations_by_vendor, update_collaborators
+from app.helpers.io_executor import run_io
+from app.helpers.messages import list_conversation_messages
+from app.helpers.read_receipts import add_user_unread_counts, get_read_state
+from app.helpers.webhook_pipeline import aenqueue_webhook, fan_out, ingest_payload, validate_payload
+from app.utils.handle_response import handle_json_response
+from app.views.conversation import parse_flag, parse_page_size
+
+def parse_json_body(request):
+    """Decode a JSON object request body; raises ValueError otherwise."""
+    data = json.loads(request.body.decode('utf-8') or '{}')
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a JSON object')
+    return data
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+async def webhook(request):
+    if request.method == "GET":
+        mode = request.GET.get("hub.mode")
+        challenge = request.GET.get("hub.challenge")
+        token = request.GET.get("hub.verify_token")
+        if mode == "subscribe" and token == WA_CONFIG_TOKEN:
+            return HttpResponse(challenge, status=200)
+        return HttpResponse(status=403)
+
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+        validate_payload(data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    logging.debug(f"Received webhook: {data}")
+
+    if settings.WEBHOOK_INGEST_MODE == 'queued':
+        try:
+            await aenqueue_webhook(data)
+        except DatabaseError as e:
+            logging.error(f"Error queueing webhook: {e}")
+            return JsonResponse({'error': 'Internal server error'}, status=500)
+        return JsonResponse({'status': 'received'}, status=200)
+
+    try:
+        events = await run_io(ingest_payload, data)
+        await fan_out(events)
+    except Exception as e:
+        logging.error(f"Error processing webhook: {str(e)}")
+        return JsonResponse({'error': 'Internal server error'}, status=500)
+    return JsonResponse({'status': 'received'}, status=200)
+
+@require_http_methods(["GET"])
+async def get_conversations_by_vendor(request):
+    vendor_id = request.GET.get('vendor_id')
+    if not vendor_id:
+        return handle_json_response(message='vendor_id is required', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = parse_page_size(request.GET.get('limit'))
+    except ValueError:
+        return handle_json_response(message='limit must be a positive integer', status_code=status.HTTP_400_BAD_REQUEST)
+    fields = [field for field in request.GET.get('fields', '').split(',') if field]
+
+    try:
+        conversations, next_cursor = await run_io(
+            list_conversations_by_vendor, vendor_id, limit, cursor=request.GET.get('cursor'), fields=fields
+        )
+        return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@require_http_methods(["GET"])
+async def get_inbox(request):
+    vendor_id = request.GET.get('vendor_id')
+    if not vendor_id:
+        return handle_json_response(message='vendor_id is required', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = parse_page_size(request.GET.get('limit'))
+    except ValueError:
+        return handle_json_response(message='limit must be a positive integer', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        conversations, next_cursor = await run_io(
+            list_conversations_by_vendor, vendor_id, limit, cursor=request.GET.get('cursor'), fields=INBOX_FIELDS
+        )
+        if request.GET.get('user_id'):
+            await run_io(add_user_unread_counts, conversations, request.GET['user_id'])
+        return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@require_http_methods(["GET"])
+async def get_conversation_messages(request, conversation_id):
+    direction = request.GET.get('direction', 'asc')
+    if direction not in ('asc', 'desc'):
+        return handle_json_response(message='direction must be asc or desc', status_code=status.HTTP_400_BAD_REQUEST)
+    fields = [field for field in request.GET.get('fields', '').split(',') if field]
+
+    try:
+        messages, next_cursor = await run_io(
+            list_conversation_messages, conversation_id, request.GET.get('limit'),
+            cursor=request.GET.get('cursor'), direction=direction, fields=fields
+        )
+        return JsonResponse({'messages': messages, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@require_http_methods(["GET"])
+async def get_conversation_reads(request, conversation_id):
+    try:
+        state = await run_io(get_read_state, conversation_id, request.GET.get('user_id'))
+        return handle_json_response(data=state, message='Read state retrieved successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+async def _assign(request, user_field, team_field):
+    try:
+        data = parse_json_body(request)
+    except ValueError:
+        return handle_json_response(message='Invalid JSON body', status_code=status.HTTP_400_BAD_REQUEST)
+    conversation_id = data.get('conversation_id')
+    user_id = data.get(user_field)
+    team_id = data.get(team_field)
+
+    if not conversation_id or (not user_id and not team_id):
+        return handle_json_response(message=f'conversation_id is required and at least one of {user_field} or {team_field} must be provided', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        await run_io(assign_conversation, conversation_id, user_id=user_id, team_id=team_id)
+        return handle_json_response(message='User and/or team assigned successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def assign_user_and_team_to_conversation(request):
+    return await _assign(request, 'assigned_user_id', 'assigned_team_id')
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def change_assignment(request):
+    return await _assign(request, 'new_user_id', 'new_team_id')
+
+async def _update_collaborators(request, action):
+    try:
+        data = parse_json_body(request)
+    except ValueError:
+        return handle_json_response(message='Invalid JSON body', status_code=status.HTTP_400_BAD_REQUEST)
+    conversation_id = data.get('conversation_id')
+    user_ids = data.get('user_ids', [])
+
+    if not conversation_id or not user_ids:
+        return handle_json_response(message='conversation_id is required and user_ids must be provided', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        await run_io(update_collaborators, conversation_id, user_ids, action)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return handle_json_response(message='Conversation not found', status_code=status.HTTP_404_NOT_FOUND)
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if action == 'add':
+        return handle_json_response(message='Users added to colab_users successfully', status_code=status.HTTP_200_OK)
+    return handle_json_response(message='Users removed from colab_users successfully', status_code=status.HTTP_200_OK)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def add_users_to_conversation(request):
+    return await _update_collaborators(request, 'add')
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def remove_users_from_conversation(request):
+    return await _update_collaborators(request, 'remove')
+
+@csrf_exempt
+@require_http_methods(["POST"])
+async def bulk_update_collaborators(request):
+    try:
+        changes = parse_json_body(request).get('changes', [])
+    except ValueError:
+        return handle_json_response(message='Invalid JSON body', status_code=status.HTTP_400_BAD_REQUEST)
+
+    if not changes or not all(isinstance(change, dict) and change.get('conversation_id') and (change.get('add') or change.get('remove')) for change in changes):
+        return handle_json_response(message='changes must be a list of entries with a conversation_id and add or remove user_ids', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        result = await run_io(apply_collaborator_changes, changes)
+        return handle_json_response(data=result, message='Collaborators updated successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@csrf_exempt
+@require_http_methods(["PUT"])
+async def set_multiple_conversation_statuses(request):
+    try:
+        data = parse_json_body(request)
+    except ValueError:
+        return handle_json_response(message='Invalid JSON body', status_code=status.HTTP_400_BAD_REQUEST)
+    conversation_ids = data.get('conversation_ids', [])
+    is_open = data.get('is_open')
+    try:
+        atomic = parse_flag(data.get('atomic'), 'atomic')
+        run_async = parse_flag(data.get('async'), 'async')
+    except ValueError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+
+    if not conversation_ids or is_open is None:
+        return handle_json_response(message='conversation_ids and is_open must be provided', status_code=status.HTTP_400_BAD_REQUEST)
+
+    if run_async or len(conversation_ids) > settings.BULK_STATUS_ASYNC_THRESHOLD:
+        try:
+            job_id = await run_io(bulk_jobs.submit, set_conversation_statuses, conversation_ids, is_open, atomic=atomic)
+        except ClientError as e:
+            return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return handle_json_response(data={'job_id': job_id}, message='Conversation status update started', status_code=status.HTTP_202_ACCEPTED)
+
+    try:
+        result = await run_io(set_conversation_statuses, conversation_ids, is_open, atomic=atomic)
+        return handle_json_response(data=result, message='Conversation statuses updated successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        return handle_json_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
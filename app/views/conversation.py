@@ -4,13 +4,16 @@ from drf_yasg.utils import swagger_auto_schema
 from rest_framework.decorators import api_view
 from drf_yasg import openapi
 from app.utils.handle_response import handle_response
-from app.helpers.dynamodb_helpers import get_conversations_table
+from app.helpers.bulk_updates import apply_collaborator_changes, bulk_jobs, set_conversation_statuses
+from app.helpers.conversation import INBOX_FIELDS, assign_conversation, list_conversations_by_vendor, update_collaborators
+from app.helpers.messages import list_conversation_messages
+from app.helpers.read_receipts import add_user_unread_counts, get_read_state
 from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Attr
+from django.conf import settings
 
 @swagger_auto_schema(
     method='get',
-    operation_description="Retrieve all conversations for a specific vendor",
+    operation_description="Retrieve a page of conversations for a specific vendor, most recently updated first",
     manual_parameters=[
         openapi.Parameter(
             'vendor_id', 
@@ -18,6 +21,28 @@ from boto3.dynamodb.conditions import Attr
             type=openapi.TYPE_STRING,
             required=True, 
             description="Vendor ID to filter conversations"
+        ),
+        openapi.Parameter(
+            'limit',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_INTEGER,
+            required=False,
+            description="Number of conversations per page",
+            default=20
+        ),
+        openapi.Parameter(
+            'cursor',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="next_cursor returned by the previous page"
+        ),
+        openapi.Parameter(
+            'fields',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="Comma-separated attributes to return, e.g. conversation_id,customer_id,updated_at"
         )
     ],
     responses={
@@ -32,7 +57,8 @@ from boto3.dynamodb.conditions import Attr
                             "customerId": "customer123",
                             "startedAt": "2023-10-01T12:00:00"
                         }
-                    ]
+                    ],
+                    "next_cursor": "eyJjb252ZXJzYXRpb25faWQiOiAiMTIzNDUifQ=="
                 }
             }
         ),
@@ -46,18 +72,123 @@ def get_conversations_by_vendor(request):
     if not vendor_id:
         return handle_response(message='vendor_id is required', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
+    try:
+        limit = parse_page_size(request.GET.get('limit'))
+    except ValueError:
+        return handle_response(message='limit must be a positive integer', status_code=status.HTTP_400_BAD_REQUEST)
+    fields = [field for field in request.GET.get('fields', '').split(',') if field]
 
     try:
-        response = table.scan(
-            FilterExpression=Attr('vendor_id').eq(vendor_id)
+        conversations, next_cursor = list_conversations_by_vendor(
+            vendor_id, limit, cursor=request.GET.get('cursor'), fields=fields
+        )
+        return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    except ClientError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@swagger_auto_schema(
+    method='get',
+    operation_description="Retrieve a page of a vendor's inbox: conversations with their last message and unread count, most recently updated first",
+    manual_parameters=[
+        openapi.Parameter(
+            'vendor_id',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=True,
+            description="Vendor ID of the inbox"
+        ),
+        openapi.Parameter(
+            'limit',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_INTEGER,
+            required=False,
+            description="Number of conversations per page",
+            default=20
+        ),
+        openapi.Parameter(
+            'cursor',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="next_cursor returned by the previous page"
+        ),
+        openapi.Parameter(
+            'user_id',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="Count unread_count from this user's read marks instead of the shared count (customer messages since the last agent reply)"
         )
+    ],
+    responses={
+        200: openapi.Response(
+            description="Inbox retrieved successfully",
+            examples={
+                "application/json": {
+                    "conversations": [
+                        {
+                            "conversation_id": "12345",
+                            "customer_id": "customer123",
+                            "vendor_id": "vendor123",
+                            "is_open": True,
+                            "assigned_user_id": "user123",
+                            "assigned_team_id": None,
+                            "last_message": "Message content",
+                            "last_sender_id": "customer123",
+                            "updated_at": "2023-10-01T12:00:00",
+                            "unread_count": 2
+                        }
+                    ],
+                    "next_cursor": None
+                }
+            }
+        ),
+        400: "Bad Request",
+        500: "Internal Server Error"
+    }
+)
+@api_view(['GET'])
+def get_inbox(request):
+    vendor_id = request.GET.get('vendor_id')
+    if not vendor_id:
+        return handle_response(message='vendor_id is required', status_code=status.HTTP_400_BAD_REQUEST)
 
-        conversations = response.get('Items', [])
-        return JsonResponse({'conversations': conversations}, status=status.HTTP_200_OK)
+    try:
+        limit = parse_page_size(request.GET.get('limit'))
+    except ValueError:
+        return handle_response(message='limit must be a positive integer', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        conversations, next_cursor = list_conversations_by_vendor(
+            vendor_id, limit, cursor=request.GET.get('cursor'), fields=INBOX_FIELDS
+        )
+        if request.GET.get('user_id'):
+            add_user_unread_counts(conversations, request.GET['user_id'])
+        return JsonResponse({'conversations': conversations, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
     except ClientError as e:
         return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+def parse_page_size(limit):
+    """Validate the limit query parameter against the conversation page size settings."""
+    if limit is None:
+        return settings.CONVERSATION_PAGE_SIZE
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit must be a positive integer')
+    return min(limit, settings.CONVERSATION_MAX_PAGE_SIZE)
+
+def parse_flag(value, name):
+    """Parse a boolean body field; only true/false (JSON or string) and '1'/'0' are accepted."""
+    if value in (True, 'true', '1'):
+        return True
+    if value in (None, False, 'false', '0'):
+        return False
+    raise ValueError(f'{name} must be true or false')
+
 @swagger_auto_schema(
     method='post',
     operation_description="Assign a user and team to a specific conversation",
@@ -100,26 +231,8 @@ def assign_user_and_team_to_conversation(request):
     if not conversation_id or (not assigned_user_id and not assigned_team_id):
         return handle_response(message='conversation_id is required and at least one of assigned_user_id or assigned_team_id must be provided', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
-
     try:
-        update_expression = []
-        expression_attribute_values = {}
-        
-        if assigned_user_id:
-            update_expression.append("assigned_user_id = :u")
-            expression_attribute_values[':u'] = assigned_user_id
-        if assigned_team_id:
-            update_expression.append("assigned_team_id = :t")
-            expression_attribute_values[':t'] = assigned_team_id
-        
-        update_expression_str = "set " + ", ".join(update_expression)
-
-        table.update_item(
-            Key={'conversation_id': conversation_id},
-            UpdateExpression=update_expression_str,
-            ExpressionAttributeValues=expression_attribute_values
-        )
+        assign_conversation(conversation_id, user_id=assigned_user_id, team_id=assigned_team_id)
         return handle_response(message='User and/or team assigned successfully', status_code=status.HTTP_200_OK)
     except ClientError as e:
         return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -166,33 +279,15 @@ def change_assignment(request):
     if not conversation_id or (not new_user_id and not new_team_id):
         return handle_response(message='conversation_id is required and at least one of new_user_id or new_team_id must be provided', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
-
     try:
-        update_expression = []
-        expression_attribute_values = {}
-
-        if new_user_id:
-            update_expression.append("assigned_user_id = :u")
-            expression_attribute_values[':u'] = new_user_id
-        if new_team_id:
-            update_expression.append("assigned_team_id = :t")
-            expression_attribute_values[':t'] = new_team_id
-
-        update_expression_str = "set " + ", ".join(update_expression)
-
-        table.update_item(
-            Key={'conversation_id': conversation_id},
-            UpdateExpression=update_expression_str,
-            ExpressionAttributeValues=expression_attribute_values
-        )
+        assign_conversation(conversation_id, user_id=new_user_id, team_id=new_team_id)
         return handle_response(message='User and/or team assigned successfully', status_code=status.HTTP_200_OK)
     except ClientError as e:
         return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @swagger_auto_schema(
     method='post',
-    operation_description="Add users to the colab_users array for a specific conversation",
+    operation_description="Add users to the colab_users set for a specific conversation",
     request_body=openapi.Schema(
         type=openapi.TYPE_OBJECT,
         properties={
@@ -230,25 +325,18 @@ def add_users_to_conversation(request):
     if not conversation_id or not user_ids:
         return handle_response(message='conversation_id is required and user_ids must be provided', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
-
     try:
-        # Update the colab_users array
-        table.update_item(
-            Key={'conversation_id': conversation_id},
-            UpdateExpression="SET colab_users = list_append(if_not_exists(colab_users, :empty_list), :user_ids)",
-            ExpressionAttributeValues={
-                ':user_ids': user_ids,
-                ':empty_list': []
-            }
-        )
+        # Add to the colab_users set; users already collaborating are ignored
+        update_collaborators(conversation_id, user_ids, 'add')
         return handle_response(message='Users added to colab_users successfully', status_code=status.HTTP_200_OK)
     except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return handle_response(message='Conversation not found', status_code=status.HTTP_404_NOT_FOUND)
         return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
 @swagger_auto_schema(
     method='post',
-    operation_description="Remove users from the colab_users array for a specific conversation",
+    operation_description="Remove users from the colab_users set for a specific conversation",
     request_body=openapi.Schema(
         type=openapi.TYPE_OBJECT,
         properties={
@@ -286,31 +374,72 @@ def remove_users_from_conversation(request):
     if not conversation_id or not user_ids:
         return handle_response(message='conversation_id is required and user_ids must be provided', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
-
     try:
-        # Get the current colab_users
-        response = table.get_item(Key={'conversation_id': conversation_id})
-        colab_users = response.get('Item', {}).get('colab_users', [])
-
-        # Remove the specified user_ids
-        updated_colab_users = [user for user in colab_users if user not in user_ids]
+        # Delete from the colab_users set in place, no read needed
+        update_collaborators(conversation_id, user_ids, 'remove')
+        return handle_response(message='Users removed from colab_users successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return handle_response(message='Conversation not found', status_code=status.HTTP_404_NOT_FOUND)
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Update the colab_users array
-        table.update_item(
-            Key={'conversation_id': conversation_id},
-            UpdateExpression="SET colab_users = :updated_users",
-            ExpressionAttributeValues={
-                ':updated_users': updated_colab_users
+@swagger_auto_schema(
+    method='post',
+    operation_description="Add and/or remove collaborators on many conversations in one call",
+    request_body=openapi.Schema(
+        type=openapi.TYPE_OBJECT,
+        properties={
+            'changes': openapi.Schema(
+                type=openapi.TYPE_ARRAY,
+                items=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'conversation_id': openapi.Schema(type=openapi.TYPE_STRING, description="ID of the conversation"),
+                        'add': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_STRING), description="User IDs to add"),
+                        'remove': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_STRING), description="User IDs to remove"),
+                    },
+                    required=['conversation_id']
+                ),
+                description="One entry per conversation"
+            ),
+        },
+        required=['changes'],
+        description="changes is a list of collaborator changes, each with a conversation_id and add and/or remove lists"
+    ),
+    responses={
+        200: openapi.Response(
+            description="Changes applied, with a result per conversation",
+            examples={
+                "application/json": {
+                    "message": "Collaborators updated successfully",
+                    "data": {
+                        "results": [{"conversation_id": "12345", "status": "updated"}],
+                        "updated": 1,
+                        "failed": 0
+                    }
+                }
             }
-        )
-        return handle_response(message='Users removed from colab_users successfully', status_code=status.HTTP_200_OK)
+        ),
+        400: "Bad Request",
+        500: "Internal Server Error"
+    }
+)
+@api_view(['POST'])
+def bulk_update_collaborators(request):
+    changes = request.data.get('changes', [])
+
+    if not changes or not all(isinstance(change, dict) and change.get('conversation_id') and (change.get('add') or change.get('remove')) for change in changes):
+        return handle_response(message='changes must be a list of entries with a conversation_id and add or remove user_ids', status_code=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        result = apply_collaborator_changes(changes)
+        return handle_response(data=result, message='Collaborators updated successfully', status_code=status.HTTP_200_OK)
     except ClientError as e:
         return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @swagger_auto_schema(
     method='put',
-    operation_description="Set the is_open status for multiple conversations",
+    operation_description="Set the is_open status for multiple conversations. Large batches (or async=true) run in the background and return a job_id.",
     request_body=openapi.Schema(
         type=openapi.TYPE_OBJECT,
         properties={
@@ -320,16 +449,32 @@ def remove_users_from_conversation(request):
                 description="List of conversation IDs to update"
             ),
             'is_open': openapi.Schema(type=openapi.TYPE_BOOLEAN, description="New status to set for the conversations"),
+            'atomic': openapi.Schema(type=openapi.TYPE_BOOLEAN, description="Apply the updates in all-or-nothing transactions of up to 100 conversations"),
+            'async': openapi.Schema(type=openapi.TYPE_BOOLEAN, description="Run in the background and return a job_id"),
         },
         required=['conversation_ids', 'is_open'],
         description="conversation_ids is required and is_open is a boolean value"
     ),
     responses={
         200: openapi.Response(
-            description="Statuses updated successfully",
+            description="Statuses updated, with a result per conversation",
             examples={
                 "application/json": {
-                    "message": "Conversation statuses updated successfully"
+                    "message": "Conversation statuses updated successfully",
+                    "data": {
+                        "results": {"12345": {"status": "updated"}, "67890": {"status": "not_found"}},
+                        "updated": 1,
+                        "failed": 1
+                    }
+                }
+            }
+        ),
+        202: openapi.Response(
+            description="Update started in the background",
+            examples={
+                "application/json": {
+                    "message": "Conversation status update started",
+                    "data": {"job_id": "a1b2c3"}
                 }
             }
         ),
@@ -348,23 +493,156 @@ def remove_users_from_conversation(request):
 def set_multiple_conversation_statuses(request):
     conversation_ids = request.data.get('conversation_ids', [])
     is_open = request.data.get('is_open')
+    try:
+        atomic = parse_flag(request.data.get('atomic'), 'atomic')
+        run_async = parse_flag(request.data.get('async'), 'async')
+    except ValueError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
 
     if not conversation_ids or is_open is None:
         return handle_response(message='conversation_ids and is_open must be provided', status_code=status.HTTP_400_BAD_REQUEST)
 
-    table = get_conversations_table()
+    if run_async or len(conversation_ids) > settings.BULK_STATUS_ASYNC_THRESHOLD:
+        try:
+            job_id = bulk_jobs.submit(set_conversation_statuses, conversation_ids, is_open, atomic=atomic)
+        except ClientError as e:
+            return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return handle_response(data={'job_id': job_id}, message='Conversation status update started', status_code=status.HTTP_202_ACCEPTED)
 
     try:
-        for conversation_id in conversation_ids:
-            # Update the is_open field for each conversation
-            table.update_item(
-                Key={'conversation_id': conversation_id},
-                UpdateExpression="SET is_open = :is_open",
-                ExpressionAttributeValues={
-                    ':is_open': is_open
+        result = set_conversation_statuses(conversation_ids, is_open, atomic=atomic)
+        return handle_response(data=result, message='Conversation statuses updated successfully', status_code=status.HTTP_200_OK)
+    except ClientError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@swagger_auto_schema(
+    method='get',
+    operation_description="Get the progress and per-conversation results of a background status update",
+    responses={
+        200: "Job retrieved successfully",
+        404: "Job not found"
+    }
+)
+@api_view(['GET'])
+def conversation_status_job(request, job_id):
+    try:
+        job = bulk_jobs.get(str(job_id))
+    except ClientError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    if job is None:
+        return handle_response(message='Job not found', status_code=status.HTTP_404_NOT_FOUND)
+    return handle_response(data=job, message='Job retrieved successfully', status_code=status.HTTP_200_OK)
+
+@swagger_auto_schema(
+    method='get',
+    operation_description="Retrieve a page of one conversation's messages in time order",
+    manual_parameters=[
+        openapi.Parameter(
+            'limit',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_INTEGER,
+            required=False,
+            description="Number of messages per page",
+            default=50
+        ),
+        openapi.Parameter(
+            'cursor',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="next_cursor returned by the previous page"
+        ),
+        openapi.Parameter(
+            'direction',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            enum=['asc', 'desc'],
+            description="asc for oldest first (default), desc for newest first"
+        ),
+        openapi.Parameter(
+            'fields',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="Comma-separated attributes to return, e.g. message,timestamp,sender_id"
+        )
+    ],
+    responses={
+        200: openapi.Response(
+            description="Messages retrieved successfully",
+            examples={
+                "application/json": {
+                    "messages": [
+                        {
+                            "conversation_id": "12345",
+                            "customer_id": "customer123",
+                            "message": "Message content",
+                            "sender_id": "customer123",
+                            "timestamp": "2023-10-01T12:00:00"
+                        }
+                    ],
+                    "next_cursor": "eyJjb252ZXJzYXRpb25faWQiOiAiMTIzNDUifQ=="
                 }
-            )
+            }
+        ),
+        400: "Bad Request",
+        500: "Internal Server Error"
+    }
+)
+@api_view(['GET'])
+def get_conversation_messages(request, conversation_id):
+    direction = request.GET.get('direction', 'asc')
+    if direction not in ('asc', 'desc'):
+        return handle_response(message='direction must be asc or desc', status_code=status.HTTP_400_BAD_REQUEST)
+    fields = [field for field in request.GET.get('fields', '').split(',') if field]
+
+    try:
+        messages, next_cursor = list_conversation_messages(
+            conversation_id, request.GET.get('limit'), cursor=request.GET.get('cursor'),
+            direction=direction, fields=fields
+        )
+        return JsonResponse({'messages': messages, 'next_cursor': next_cursor}, status=status.HTTP_200_OK)
+    except ValueError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_400_BAD_REQUEST)
+    except ClientError as e:
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return handle_response(message='Conversation statuses updated successfully', status_code=status.HTTP_200_OK)
+@swagger_auto_schema(
+    method='get',
+    operation_description="Retrieve how far each user has read a conversation, and one user's unread count",
+    manual_parameters=[
+        openapi.Parameter(
+            'user_id',
+            openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="User to compute last_read_timestamp and unread_count for"
+        )
+    ],
+    responses={
+        200: openapi.Response(
+            description="Read state retrieved successfully",
+            examples={
+                "application/json": {
+                    "data": {
+                        "reads": [
+                            {"user_id": "1", "last_read_timestamp": "2023-10-01T12:00:00"}
+                        ],
+                        "last_read_timestamp": "2023-10-01T12:00:00",
+                        "unread_count": 3
+                    },
+                    "message": "Read state retrieved successfully"
+                }
+            }
+        ),
+        500: "Internal Server Error"
+    }
+)
+@api_view(['GET'])
+def get_conversation_reads(request, conversation_id):
+    try:
+        state = get_read_state(conversation_id, request.GET.get('user_id'))
+        return handle_response(data=state, message='Read state retrieved successfully', status_code=status.HTTP_200_OK)
     except ClientError as e:
-        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        return handle_response(message=str(e), status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -0,0 +1,13 @@
+import hmac
+from django.conf import settings
+from django.http import JsonResponse
+from app.helpers.metrics import collect_metrics
+
+def metrics(request):
+    """Internal counters, for scrapers sending "Authorization: Bearer <METRICS_TOKEN>"."""
+    if not settings.METRICS_TOKEN:
+        return JsonResponse({'message': 'Set METRICS_TOKEN to enable /metrics'}, status=403)
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        return JsonResponse({'message': 'Unauthorized'}, status=401)
+    return JsonResponse(collect_metrics(), status=200)
@@ -6,11 +6,9 @@ from django.views.decorators.csrf import csrf_exempt
 from decouple import config
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
-from app.helpers.conversation import create_conversation
-from app.helpers.dynamodb_helpers import get_dynamodb_resource  # Import the helper function
-from channels.layers import get_channel_layer 
-from asgiref.sync import async_to_sync
-from datetime import datetime
+from django.conf import settings
+from django.db import DatabaseError
+from app.helpers.webhook_pipeline import enqueue_webhook, process_payload, validate_payload
 
 WA_ACCESS_TOKEN = config("WA_ACCESS_TOKEN")
 WA_CONFIG_TOKEN = config("WA_CONFIG_TOKEN")
@@ -29,43 +27,28 @@ def webhook(request):
         return HttpResponse(status=403)
 
     elif request.method == "POST":
-        data = json.loads(request.body.decode("utf-8"))
-        print("Received data:", json.dumps(data, indent=2))
-        # Extract the wa_id, it'll be customer_id in conversation
-        customer_id = data.get('entry', [{}])[0].get('changes', [{}])[0].get('value', {}).get('contacts', [{}])[0].get('wa_id')
-        # Extract the message body
-        message_body = data.get('entry', [{}])[0].get('changes', [{}])[0].get('value', {}).get('messages', [{}])[0].get('text', {}).get('body')
+        try:
+            data = json.loads(request.body.decode("utf-8"))
+            validate_payload(data)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        logging.debug(f"Received webhook: {data}")
 
-        if customer_id:
+        if settings.WEBHOOK_INGEST_MODE == 'queued':
+            # Acknowledge right away; conversation resolution, persistence and
+            # fan-out happen on the webhook worker pool
             try:
-                conversation_id = create_conversation(customer_id)
-                if conversation_id is None:
-                    return JsonResponse({'error': 'Failed to access Conversations table'}, status=500)
-                # Send the message to the WebSocket
-                channel_layer = get_channel_layer()
-                async_to_sync(channel_layer.group_send)(  # Use async_to_sync to call group_send
-                    f'chat_{customer_id}',  # Group name based on customer_id
-                    {
-                        'type': 'chat_message',  # This should match the method in ChatConsumer
-                        'message': message_body,  # The message you want to send
-                        'sender_id': customer_id,
-                        'timestamp': datetime.now().isoformat(),
-                    }
-                )
-                # Save the message to the DynamoDB Messages table
-                dynamodb = get_dynamodb_resource()
-                dynamodb.Table('Messages').put_item(  # Ensure you have access to the table
-                    Item={
-                        'customer_id': customer_id,
-                        'conversation_id': conversation_id,  # Add conversation_id
-                        'message': message_body,
-                        'timestamp': datetime.now().isoformat(),
-                        'sender_id': customer_id
-                    }
-                ) 
-            except Exception as e:
-                logging.error(f"Error processing customer_id {customer_id}: {str(e)}")
+                enqueue_webhook(data)
+            except DatabaseError as e:
+                logging.error(f"Error queueing webhook: {e}")
                 return JsonResponse({'error': 'Internal server error'}, status=500)
+            return JsonResponse({'status': 'received'}, status=200)
+
+        try:
+            process_payload(data)
+        except Exception as e:
+            logging.error(f"Error processing webhook: {str(e)}")
+            return JsonResponse({'error': 'Internal server error'}, status=500)
         return JsonResponse({'status': 'received'}, status=200)
     return JsonResponse({'error': 'Invalid request method'}, status=405)
 
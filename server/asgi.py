@@ -9,20 +9,35 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
-from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+
+# Initialise Django before importing code that touches models or settings
+django_asgi_app = get_asgi_application()
+
+from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from django.conf import settings
 from django.urls import re_path
-from app.consumers import ChatConsumer
+from app.consumers import ChatConsumer, InboxConsumer
+from app.helpers.dynamodb_helpers import ensure_tables
+from app.helpers.webhook_pipeline import start_webhook_workers
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
+# Check/provision the DynamoDB schema once per process, before serving traffic
+if settings.DYNAMODB_ENSURE_TABLES_ON_STARTUP:
+    ensure_tables()
+
+# Drain webhook events queued before this process started
+start_webhook_workers()
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             [
                 re_path(r'^ws/chat/(?P<room_name>\w+)/?$', ChatConsumer.as_asgi()),
+                re_path(r'^ws/inbox/?$', InboxConsumer.as_asgi()),
             ]
         )
     ),
@@ -84,7 +84,7 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "app.middleware.AsyncWhiteNoiseMiddleware",
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
 ]
@@ -182,8 +182,139 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'app.User'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# "postgres" fans group messages out across processes and nodes with
+# LISTEN/NOTIFY on the main database; "memory" only reaches sockets served by
+# the same process and is meant for local development.
+CHANNEL_LAYER_BACKEND = config('CHANNEL_LAYER_BACKEND', default='postgres')
+
+if CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
     }
-}
\ No newline at end of file
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'app.helpers.pg_channel_layer.PostgresChannelLayer',
+            'CONFIG': {
+                'database': 'default',
+                'capacity': config('CHANNEL_LAYER_CAPACITY', default=100, cast=int),
+                'expiry': config('CHANNEL_LAYER_EXPIRY', default=60, cast=int),
+                'group_expiry': config('CHANNEL_LAYER_GROUP_EXPIRY', default=86400, cast=int),
+                'pool_size': config('CHANNEL_LAYER_POOL_SIZE', default=4, cast=int),
+            }
+        }
+    }
+
+# Check/create the DynamoDB tables when the ASGI application starts. Disable it
+# when the schema is provisioned separately (python manage.py ensure_dynamodb_tables).
+DYNAMODB_ENSURE_TABLES_ON_STARTUP = config('DYNAMODB_ENSURE_TABLES_ON_STARTUP', default=True, cast=bool)
+
+# Number of messages replayed on WebSocket connect / per history page request
+MESSAGE_HISTORY_PAGE_SIZE = config('MESSAGE_HISTORY_PAGE_SIZE', default=50, cast=int)
+MESSAGE_HISTORY_MAX_PAGE_SIZE = config('MESSAGE_HISTORY_MAX_PAGE_SIZE', default=200, cast=int)
+
+# Bearer token required by /metrics (which is disabled while it is empty)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# Write-behind persistence of chat messages (see app/helpers/message_writer.py)
+MESSAGE_WRITE_QUEUE_SIZE = config('MESSAGE_WRITE_QUEUE_SIZE', default=10000, cast=int)
+MESSAGE_WRITE_FLUSH_INTERVAL = config('MESSAGE_WRITE_FLUSH_INTERVAL', default=0.05, cast=float)
+MESSAGE_WRITE_ENQUEUE_TIMEOUT = config('MESSAGE_WRITE_ENQUEUE_TIMEOUT', default=5, cast=float)
+
+# Outbound WhatsApp delivery (see app/helpers/whatsapp_sender.py). Point
+# WA_GRAPH_API_URL at a local stub (python manage.py fake_graph_api) to test
+# without calling Meta.
+WA_GRAPH_API_URL = config('WA_GRAPH_API_URL', default='https://graph.facebook.com/v20.0')
+WHATSAPP_SENDER_WORKERS = config('WHATSAPP_SENDER_WORKERS', default=4, cast=int)
+WHATSAPP_SENDER_QUEUE_SIZE = config('WHATSAPP_SENDER_QUEUE_SIZE', default=1000, cast=int)
+WHATSAPP_SEND_RATE = config('WHATSAPP_SEND_RATE', default=20, cast=float)
+WHATSAPP_SEND_MAX_RETRIES = config('WHATSAPP_SEND_MAX_RETRIES', default=5, cast=int)
+
+# In-process customer_id -> conversation_id cache (see app/helpers/conversation.py)
+CONVERSATION_CACHE_SIZE = config('CONVERSATION_CACHE_SIZE', default=10000, cast=int)
+CONVERSATION_CACHE_TTL = config('CONVERSATION_CACHE_TTL', default=300, cast=int)
+
+# Page size of the cursor-paginated conversation list endpoints
+CONVERSATION_PAGE_SIZE = config('CONVERSATION_PAGE_SIZE', default=20, cast=int)
+CONVERSATION_MAX_PAGE_SIZE = config('CONVERSATION_MAX_PAGE_SIZE', default=100, cast=int)
+
+# Bulk conversation updates (see app/helpers/bulk_updates.py); batches larger
+# than the threshold run as background jobs, whose status is kept (in the
+# BulkJobs DynamoDB table) for BULK_JOB_TTL seconds. Running jobs are
+# refreshed every BULK_JOB_HEARTBEAT seconds and reported as failed once
+# their heartbeat is three intervals old.
+BULK_UPDATE_CONCURRENCY = config('BULK_UPDATE_CONCURRENCY', default=16, cast=int)
+BULK_STATUS_ASYNC_THRESHOLD = config('BULK_STATUS_ASYNC_THRESHOLD', default=200, cast=int)
+BULK_JOB_TTL = config('BULK_JOB_TTL', default=3600, cast=int)
+BULK_JOB_HEARTBEAT = config('BULK_JOB_HEARTBEAT', default=30, cast=int)
+
+# WhatsApp webhook ingestion (see app/helpers/webhook_pipeline.py). "queued"
+# stores the payload in the WebhookEvent table and acknowledges immediately;
+# "sync" processes it before answering. WEBHOOK_INGEST_WORKERS threads per
+# process drain the queue (0 leaves it to `manage.py process_webhooks`); they start
+# with the server process and first drain events left pending by a restart.
+# An event is only done once its messages are stored; processing waits up to
+# WEBHOOK_WRITE_TIMEOUT seconds for the message writer and retries otherwise.
+WEBHOOK_INGEST_MODE = config('WEBHOOK_INGEST_MODE', default='queued')
+WEBHOOK_INGEST_WORKERS = config('WEBHOOK_INGEST_WORKERS', default=4, cast=int)
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', default=5, cast=int)
+WEBHOOK_WRITE_TIMEOUT = config('WEBHOOK_WRITE_TIMEOUT', default=30, cast=float)
+
+# How long WhatsApp message ids are remembered for webhook deduplication.
+# A claimed id that is not stored within WEBHOOK_CLAIM_LEASE seconds (its
+# process died) can be claimed again; keep it above WEBHOOK_WRITE_TIMEOUT and
+# below the worker's 300 second claim timeout.
+WEBHOOK_DEDUPE_CACHE_SIZE = config('WEBHOOK_DEDUPE_CACHE_SIZE', default=100000, cast=int)
+WEBHOOK_DEDUPE_TTL = config('WEBHOOK_DEDUPE_TTL', default=7 * 86400, cast=int)
+WEBHOOK_CLAIM_LEASE = config('WEBHOOK_CLAIM_LEASE', default=120, cast=int)
+
+# Serve the webhook and conversation endpoints with the async views in
+# app/views/async_api.py (for ASGI/daphne).
+ASYNC_API_VIEWS = config('ASYNC_API_VIEWS', default=False, cast=bool)
+
+# Threads for the blocking DynamoDB calls of the async views and ChatConsumer
+# (see app/helpers/io_executor.py)
+IO_EXECUTOR_WORKERS = config('IO_EXECUTOR_WORKERS', default=32, cast=int)
+
+# Per-process cache of the newest messages of recently opened conversations
+# (see app/helpers/recent_messages.py)
+RECENT_MESSAGE_CACHE_CONVERSATIONS = config('RECENT_MESSAGE_CACHE_CONVERSATIONS', default=1000, cast=int)
+RECENT_MESSAGE_CACHE_SIZE = config('RECENT_MESSAGE_CACHE_SIZE', default=50, cast=int)
+RECENT_MESSAGE_CACHE_TTL = config('RECENT_MESSAGE_CACHE_TTL', default=30, cast=int)
+
+# Partition key of stored messages: "customer" keeps a customer's whole history
+# in one Messages partition; "monthly" writes to MessagesByMonth, keyed by
+# customer and month. Copy existing messages over with
+# `python manage.py migrate_message_buckets` when switching.
+MESSAGE_KEY_SCHEME = config('MESSAGE_KEY_SCHEME', default='customer')
+
+# Agent inbox sockets (ws/inbox/): how long a conversation's vendor/assignee/
+# collaborator routing is cached, and how many chats one socket may subscribe to
+INBOX_ROUTE_CACHE_TTL = config('INBOX_ROUTE_CACHE_TTL', default=30, cast=int)
+INBOX_MAX_SUBSCRIPTIONS = config('INBOX_MAX_SUBSCRIPTIONS', default=200, cast=int)
+
+# Read receipts (see app/helpers/read_receipts.py): seconds between writes of
+# coalesced read marks, and the highest unread count computed from them
+READ_RECEIPT_FLUSH_INTERVAL = config('READ_RECEIPT_FLUSH_INTERVAL', default=5, cast=float)
+UNREAD_COUNT_CAP = config('UNREAD_COUNT_CAP', default=100, cast=int)
+
+# Ephemeral chat socket events (see app/helpers/presence.py): seconds a user
+# stays present after their last presence frame, and the minimum interval
+# between repeated typing broadcasts of one user
+PRESENCE_TTL = config('PRESENCE_TTL', default=30, cast=int)
+TYPING_EVENT_INTERVAL = config('TYPING_EVENT_INTERVAL', default=1.0, cast=float)
+
+# WebSocket send buffers (see app/helpers/send_buffer.py): frames queued per
+# connection, what to do when the buffer is full (drop_oldest, coalesce or
+# close) and the close code used; connections whose buffer has not moved for
+# WS_STALL_TIMEOUT seconds, or that sent nothing for WS_IDLE_TIMEOUT seconds
+# (0 disables), are closed by a reaper running every WS_REAPER_INTERVAL seconds
+WS_SEND_BUFFER_SIZE = config('WS_SEND_BUFFER_SIZE', default=500, cast=int)
+WS_SEND_BUFFER_POLICY = config('WS_SEND_BUFFER_POLICY', default='drop_oldest')
+WS_SEND_BUFFER_CLOSE_CODE = config('WS_SEND_BUFFER_CLOSE_CODE', default=4008, cast=int)
+WS_STALL_TIMEOUT = config('WS_STALL_TIMEOUT', default=30, cast=float)
+WS_IDLE_TIMEOUT = config('WS_IDLE_TIMEOUT', default=0, cast=float)
+WS_IDLE_CLOSE_CODE = config('WS_IDLE_CLOSE_CODE', default=4000, cast=int)
+WS_REAPER_INTERVAL = config('WS_REAPER_INTERVAL', default=5, cast=float)
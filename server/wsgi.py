@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 
 application = get_wsgi_application()
+
+from app.helpers.webhook_pipeline import start_webhook_workers
+
+# Drain webhook events queued before this process started
+start_webhook_workers()